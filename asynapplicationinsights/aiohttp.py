@@ -11,13 +11,20 @@
 """
 import uuid
 import time
-from typing import Optional, Callable
+from random import getrandbits
+from typing import Optional, Callable, Dict
 from aiohttp import web, ClientSession
 from aiohttp.web_exceptions import HTTPException
-from datetime import datetime
+from aiohttp.web_urldispatcher import AbstractResource
+from datetime import datetime, timedelta
 from .telemetry import AsyncTelemetryClient
-from .entities import Application, LoggingDevice
+from .context import OperationContext, set_operation_context, reset_operation_context
+from .entities import Application, LoggingDevice, Operation, RequestData
+from .channel.abstractions import TelemetryChannel
 from .channel.aiohttpchannel import AiohttpTelemetryChannel
+from .channel.retry import RetryScheduler
+from .metrics import MetricsAggregator
+from .sampling import Sampler
 
 
 def default_time_getter():
@@ -40,10 +47,166 @@ def default_is_success_request(status):
     return False
 
 
+# names of requests by matched resource, computed once per route
+_request_names = {}  # type: Dict[AbstractResource, str]
+
+
+def to_ascii(value: str) -> str:
+    if value.isascii():
+        return value
+    return value.encode('ascii', 'backslashreplace').decode('ascii')
+
+
 def get_request_name(request):
-    ascii_encodable_path = request.path.encode('ascii', 'backslashreplace') \
-        .decode('ascii')
-    return ascii_encodable_path
+    """
+    Returns the name of a request: the canonical form of its route (e.g. /like/{id}), so that requests to the
+    same route share the same name; or its path, if it didn't match any route.
+    """
+    resource = request.match_info.route.resource
+    if resource is None:
+        return to_ascii(request.path)
+    try:
+        return _request_names[resource]
+    except KeyError:
+        name = _request_names[resource] = to_ascii(resource.canonical)
+        return name
+
+
+REQUEST_DURATION_METRIC = 'Request duration'
+UNMATCHED_REQUEST_NAME = '(unmatched)'
+
+# properties of request metrics by request name, response code and outcome, created once per combination
+_request_metric_properties = {}  # type: Dict[tuple, dict]
+
+
+def track_request_metrics(client: AsyncTelemetryClient, request, status: int, success: bool, duration: float):
+    """
+    Records the duration of a request, in milliseconds, in the histogram of its route, response code and outcome,
+    sent each interval by the metrics aggregator of the client: its count, sum, min, max, standard deviation and
+    percentiles are exact, regardless of sampling of requests. Requests that didn't match any route share the
+    same name, to bound the number of series.
+    """
+    if request.match_info.route.resource is None:
+        name = UNMATCHED_REQUEST_NAME
+    else:
+        name = get_request_name(request)
+
+    key = (request.method, name, status, success)
+    try:
+        properties = _request_metric_properties[key]
+    except KeyError:
+        properties = _request_metric_properties[key] = {
+            'Request name': f'{request.method} {name}',
+            'Response code': str(status),
+            'Success': str(success)
+        }
+    client.track_histogram_nowait(REQUEST_DURATION_METRIC, duration, properties)
+
+
+def new_telemetry_id() -> str:
+    # NB: 128 random bits, formatted like W3C trace ids; several times cheaper than str(uuid.uuid4())
+    return '%032x' % getrandbits(128)
+
+
+class RequestOperation(Operation):
+    """Operation of a web request, whose name is obtained from the request only when needed."""
+
+    __slots__ = ('_request', '_name')
+
+    def __init__(self, _id: str, request):
+        self.id = _id
+        self._request = request
+        self._name = None
+
+    @property
+    def name(self):
+        name = self._name
+        if name is None:
+            name = self._name = f'{self._request.method} {get_request_name(self._request)}'
+        return name
+
+
+def create_fast_path_middleware(client: AsyncTelemetryClient,
+                                time_getter: Optional[Callable] = None,
+                                user_getter: Optional[Callable] = None,
+                                is_success_request: Callable = default_is_success_request,
+                                is_handled_exception: Optional[Callable] = None,
+                                requests_filter: Optional[Callable] = None,
+                                request_metrics: bool = False):
+    """
+    Returns a middleware tracking requests with minimal overhead: the request is tracked without waiting,
+    and its url, name, start time and entity are obtained only if it is kept by the sampler of the client.
+    Parameters have the same meaning as in use_application_insights.
+    """
+
+    @web.middleware
+    async def application_insights_fast_path_middleware(request, handler):
+        if requests_filter and requests_filter(request):
+            return await handler(request)
+
+        telemetry_id = new_telemetry_id()
+        request.telemetry_id = telemetry_id
+        start_datetime = time_getter() if time_getter else None
+        start = time.perf_counter()
+
+        context_token = set_operation_context(OperationContext(RequestOperation(telemetry_id, request)))
+        status = None
+        exception = None
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except HTTPException as http_exception:
+            status = http_exception.status
+            raise
+        except Exception as error:
+            status = 500
+            exception = error
+            if is_handled_exception:
+                is_handled, handled_status = is_handled_exception(error)
+                if is_handled:
+                    status = handled_status
+                    exception = None
+            raise
+        finally:
+            if status is not None:
+                elapsed = time.perf_counter() - start
+                success = is_success_request(status)
+                user_data = None
+
+                if request_metrics:
+                    track_request_metrics(client, request, status, success, elapsed * 1000)
+
+                sample_rate = client.sample(RequestData.data_type_name, telemetry_id, not success)
+                if sample_rate:
+                    # restore user context if possible, this must happen here
+                    if user_getter:
+                        user_data = user_getter(request)
+
+                    client.push_nowait(client.create_request(telemetry_id,
+                                                             get_request_name(request),
+                                                             str(request.url),
+                                                             success,
+                                                             start_datetime or
+                                                             datetime.utcnow() - timedelta(seconds=elapsed),
+                                                             int(elapsed * 1000),
+                                                             status,
+                                                             request.method,
+                                                             user=user_data,
+                                                             sample_rate=sample_rate))
+
+                if exception is not None:
+                    if user_getter and user_data is None:
+                        user_data = user_getter(request)
+                    client.track_exception_nowait(exception.__class__,
+                                                  exception,
+                                                  exception.__traceback__,
+                                                  user=user_data,
+                                                  skip_frames=1)
+
+            reset_operation_context(context_token)
+
+    return application_insights_fast_path_middleware
 
 
 
@@ -57,7 +220,14 @@ def use_application_insights(app: web.Application,
                              is_handled_exception: Optional[Callable] = None,
                              requests_filter: Optional[Callable] = None,
                              client_session: ClientSession=None,
-                             loop=None):
+                             loop=None,
+                             background_sender: bool = False,
+                             channel: Optional[TelemetryChannel] = None,
+                             sampler: Optional[Sampler] = None,
+                             fast_path: bool = False,
+                             metrics: Optional[MetricsAggregator] = None,
+                             request_metrics: bool = False,
+                             retry: Optional[RetryScheduler] = None):
     """
     Integrates asynchronous client for Azure Application Insights into an aiohttp application.
 
@@ -72,21 +242,46 @@ def use_application_insights(app: web.Application,
     :param requests_filter: optional method to filter requests from ai logging
     :param loop: optional asyncio loop, if not specified asyncio.get_event_loop is used
     :param client_session: optionally, an http client session for web requests
+    :param background_sender: whether telemetry should be sent by a background task, instead of the request handling one
+    :param channel: optional telemetry channel; if not specified an AiohttpTelemetryChannel is created
+    :param sampler: optional sampler, deciding which requests and other telemetry items are sent
+    :param fast_path: whether requests should be tracked with minimal overhead, without waiting for telemetry to be
+    queued and obtaining request details only for requests kept by the sampler
+    :param metrics: optional metrics aggregator, to pre-aggregate metrics in process
+    :param request_metrics: whether the duration of every request is recorded in a histogram per route, response
+    code and outcome, so that request counts, failure rates and durations are exact even if requests are sampled;
+    if no metrics aggregator is specified, one is created
+    :param retry: optional scheduler to send again batches that failed for transient reasons, used by the channel
+    created when none is specified; by default one is created with the default retry policy, so that failures to
+    send telemetry are never propagated to request handlers
     :return:
     """
-    if loop is None:
-        loop = app.loop
-
-    if not time_getter:
-        time_getter = default_time_getter
-
     if not is_success_request:
         is_success_request = default_is_success_request
 
+    if request_metrics and metrics is None:
+        metrics = MetricsAggregator()
+
+    if channel is None:
+        if loop is None:
+            loop = app.loop
+
+        channel = AiohttpTelemetryChannel(loop,
+                                          client_session,
+                                          background_sender=background_sender,
+                                          retry=retry or RetryScheduler())
     client = AsyncTelemetryClient(instrumentation_key,
-                                  AiohttpTelemetryChannel(loop, client_session),
+                                  channel,
                                   app_metadata,
-                                  logging_device)
+                                  logging_device,
+                                  metrics=metrics,
+                                  sampler=sampler)
+
+    # on start up, bind the channel to the application loop, so executor threads can log from the start
+    async def on_startup_bind_ai_channel(_):
+        channel.bind()
+
+    app.on_startup.append(on_startup_bind_ai_channel)
 
     # on clean up, dispose the client
     async def on_clean_up_dispose_ai_client(_):
@@ -97,6 +292,20 @@ def use_application_insights(app: web.Application,
 
     setattr(app, 'ai_client', client)
 
+    if fast_path:
+        middleware = create_fast_path_middleware(client,
+                                                 time_getter,
+                                                 user_getter,
+                                                 is_success_request,
+                                                 is_handled_exception,
+                                                 requests_filter,
+                                                 request_metrics)
+        app.middlewares.append(middleware)
+        return middleware
+
+    if not time_getter:
+        time_getter = default_time_getter
+
     @web.middleware
     async def application_insights_middleware(request, handler):
 
@@ -112,6 +321,10 @@ def use_application_insights(app: web.Application,
 
         request.telemetry_id = telemetry_id
 
+        # telemetry tracked while handling the request is correlated with it, through the ambient context
+        context_token = set_operation_context(OperationContext(Operation(telemetry_id,
+                                                                         f'{request.method} {req_name}')))
+
         try:
             response = await handler(request)
 
@@ -123,6 +336,8 @@ def use_application_insights(app: web.Application,
             elapsed_ms = int(elapsed * 1000)
 
             success = is_success_request(response.status)
+            if request_metrics:
+                track_request_metrics(client, request, response.status, success, elapsed * 1000)
             await client.track_request(telemetry_id,
                                        req_name,
                                        req_url,
@@ -143,6 +358,8 @@ def use_application_insights(app: web.Application,
 
             status = http_exception.status
             success = is_success_request(status)
+            if request_metrics:
+                track_request_metrics(client, request, status, success, elapsed * 1000)
             await client.track_request(telemetry_id,
                                        req_name,
                                        req_url,
@@ -167,6 +384,8 @@ def use_application_insights(app: web.Application,
 
                 if is_handled:
                     success = is_success_request(status)
+                    if request_metrics:
+                        track_request_metrics(client, request, status, success, elapsed * 1000)
                     await client.track_request(telemetry_id,
                                                req_name,
                                                req_url,
@@ -180,6 +399,8 @@ def use_application_insights(app: web.Application,
 
             status = 500
             success = False
+            if request_metrics:
+                track_request_metrics(client, request, status, success, elapsed * 1000)
             await client.track_request(telemetry_id,
                                        req_name,
                                        req_url,
@@ -196,6 +417,8 @@ def use_application_insights(app: web.Application,
                                          user=user_data,
                                          skip_frames=1)
             raise
+        finally:
+            reset_operation_context(context_token)
 
     app.middlewares.append(application_insights_middleware)
 
@@ -1,13 +1,121 @@
-from asyncio import Queue, QueueEmpty
+import time
+import asyncio
+import logging
+import threading
+from asyncio import QueueEmpty
 from abc import ABC, abstractmethod
-from typing import List
+from collections import deque
+from typing import List, Optional, Dict
+from .batching import AdaptiveBatchSize
+from .queues import TelemetryQueue, get_type_name
+from .retry import RetryScheduler
+from ..exceptions import InvalidOperation, PartialSendFailed
+
+
+logger = logging.getLogger(__name__)
 
 
 class TelemetryChannel(ABC):
 
-    def __init__(self):
-        self._queue = Queue()
-        self._max_length = 500
+    def __init__(self,
+                 background_sender: bool = False,
+                 flush_interval: Optional[float] = 10.0,
+                 max_batch_size: int = 500,
+                 batch_size: Optional[AdaptiveBatchSize] = None,
+                 queue: Optional[TelemetryQueue] = None,
+                 retry: Optional[RetryScheduler] = None,
+                 max_concurrent_sends: int = 1):
+        """
+        :param background_sender: whether items should be sent by a dedicated background task, so that put only
+        enqueues items and never waits for network operations
+        :param flush_interval: maximum number of seconds an item waits in queue before being sent;
+        if None, items are sent only when a batch is full or when flush is called explicitly
+        :param max_batch_size: number of items that trigger a flush and maximum number of items sent in a batch
+        :param batch_size: optional strategy to adapt the batch size to observed send latency and payload size;
+        if given, max_batch_size is ignored
+        :param queue: optional queue for items waiting to be sent, to configure its size, overflow policy and
+        priorities; by default an unbounded queue is used
+        :param retry: optional scheduler to send again batches that failed for transient reasons; if given,
+        failures are never propagated to callers, and discarded items are counted in failed_items; without it,
+        items rejected in case of partial success are discarded and counted, and other failures are propagated
+        :param max_concurrent_sends: maximum number of batches being sent at the same time, also across concurrent
+        calls to flush
+        """
+        if max_concurrent_sends < 1:
+            raise ValueError('max_concurrent_sends must be greater than zero')
+
+        self._queue = queue if queue is not None else TelemetryQueue()
+        self._max_length = batch_size.size if batch_size else max_batch_size
+        self._batch_size = batch_size
+        self._retry = retry
+        self._max_concurrent_sends = max_concurrent_sends
+        self._send_slots = None  # type: Optional[asyncio.Semaphore]
+        self._background_sender = background_sender
+        self._flush_interval = flush_interval
+        self._sender_task = None  # type: Optional[asyncio.Task]
+        self._flush_requested = None  # type: Optional[asyncio.Event]
+        self._stopping = False
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._thread_id = None  # type: Optional[int]
+        self._pending = deque()
+        self._drain_scheduled = False
+        self._failed = {}  # type: Dict[Optional[str], int]
+
+    @property
+    def loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        """Returns the event loop that owns this channel, once bound."""
+        return self._loop
+
+    def bind(self):
+        """
+        Binds this channel to the event loop of the calling thread, which owns the queue and sends items;
+        items put from other threads or loops are then handed off to it. This happens automatically at the
+        first put in the event loop, but must be done explicitly if other threads might put items first.
+        """
+        self._loop = asyncio.get_event_loop()
+        self._thread_id = threading.get_ident()
+
+    def is_owner_thread(self) -> bool:
+        """
+        Returns a value indicating whether the calling thread is the one of the loop owning this channel.
+        An unbound channel is owned by the first running event loop that puts items in it; other threads cannot
+        put items in it until it is bound.
+        """
+        thread_id = self._thread_id
+        if thread_id is None:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                raise InvalidOperation('The channel must be bound to an event loop, '
+                                       'to accept items from threads without a running event loop')
+            return True
+        return thread_id == threading.get_ident()
+
+    def put_threadsafe(self, item):
+        """
+        Adds an item from any thread, without waiting: items are appended to a deque, and handed off to the
+        event loop owning the channel in batches, with a single call_soon_threadsafe for all the items appended
+        until the loop drains them.
+        """
+        if not item:
+            return
+
+        loop = self._loop
+        if loop is None:
+            raise InvalidOperation('The channel must be bound to an event loop, to accept items from other threads')
+
+        # NB: deque.append is atomic; the flag can only cause a redundant drain, never a missed one, because
+        # it is cleared before the deque is drained
+        self._pending.append(item)
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            loop.call_soon_threadsafe(self._drain_pending)
+
+    def _drain_pending(self):
+        self._drain_scheduled = False
+        pending = self._pending
+        while pending:
+            self.put_nowait(pending.popleft())
 
     def get(self):
         try:
@@ -18,27 +126,196 @@ class TelemetryChannel(ABC):
     async def put(self, item):
         if not item:
             return
+
+        if self._loop is None:
+            self.bind()
+
+        if self._background_sender:
+            if self._queue.full():
+                # NB: wakes the sender before waiting for free space, which it makes by draining the queue
+                self._request_flush()
+            await self._queue.put(item)
+            self._request_flush()
+            return
+
+        if self._queue.full():
+            await self.flush()
+
         await self._queue.put(item)
+        if self._flush_interval is not None:
+            # NB: in this mode the sender task only handles the time trigger
+            self._ensure_sender()
+
         if self.should_flush():
             await self.flush()
 
+    def put_nowait(self, item):
+        """
+        Adds an item to the queue without waiting, in O(1); sending is always left to the sender task, even when
+        the channel is not configured to use a background sender.
+        NB: this method must be called in the thread of the event loop; other threads use put_threadsafe.
+        """
+        if not item:
+            return
+
+        if self._loop is None:
+            self.bind()
+
+        self._queue.put_nowait(item)
+        self._request_flush()
+
+    def _request_flush(self):
+        self._ensure_sender()
+        if self._flush_requested is not None and self.should_flush():
+            self._flush_requested.set()
+
+    @property
+    def dropped_items(self) -> Dict[Optional[str], int]:
+        """Returns the number of items discarded because the queue was full, by data type name."""
+        return dict(self._queue.dropped)
+
+    @property
+    def failed_items(self) -> Dict[Optional[str], int]:
+        """Returns the number of items discarded because they could not be sent, by data type name."""
+        failed = dict(self._failed)
+        if self._retry is not None:
+            for type_name, count in self._retry.dropped.items():
+                failed[type_name] = failed.get(type_name, 0) + count
+        return failed
+
+    def _count_failed(self, type_name: Optional[str], count: int = 1):
+        self._failed[type_name] = self._failed.get(type_name, 0) + count
+
     def should_flush(self) -> bool:
-        return self._max_length <= self._queue.qsize()
+        # NB: a bounded queue can be full before a batch is
+        return self._max_length <= self._queue.qsize() or self._queue.full()
 
-    async def flush(self):
+    def take_batch(self) -> List:
+        """Removes from the queue and returns up to the current batch size of items."""
         data = []
-        while True:
+        for _ in range(self._max_length):
             item = self.get()
             if not item:
                 break
             data.append(item)
+        return data
+
+    def _get_send_slots(self) -> asyncio.Semaphore:
+        if self._send_slots is None:
+            self._send_slots = asyncio.Semaphore(self._max_concurrent_sends)
+        return self._send_slots
+
+    async def flush(self):
+        send_slots = self._get_send_slots()
+        sends = []
+        while True:
+            await send_slots.acquire()
+
+            # NB: items are taken from the queue only when a send slot is available, and synchronously,
+            # so concurrent flushes never interleave or duplicate items, and batches are as full as possible
+            data = self.take_batch()
+            if not data:
+                send_slots.release()
+                break
+            sends.append(asyncio.ensure_future(self._send_batch_in_slot(data)))
+
+        if sends:
+            for result in await asyncio.gather(*sends, return_exceptions=True):
+                if isinstance(result, Exception):
+                    raise result
 
-        if data:
-            await self.send(data)
+    async def _send_batch_in_slot(self, data: List):
+        try:
+            await self.send_batch(data)
+        finally:
+            self._send_slots.release()
+
+    async def _retry_batch(self, data: List, attempt: int):
+        # NB: retries share the send slots with flushes, so they never exceed max_concurrent_sends
+        async with self._get_send_slots():
+            await self.send_batch(data, attempt)
+
+    async def send_batch(self, data: List, attempt: int = 1) -> bool:
+        """Sends a batch of items, returning a value indicating whether all of them were accepted."""
+        start = time.perf_counter()
+        try:
+            payload_size = await self.send(data)
+        except Exception as error:
+            await self.on_send_failed(data, attempt, error)
+            return False
+
+        if self._batch_size is not None:
+            self._max_length = self._batch_size.observe(len(data),
+                                                        time.perf_counter() - start,
+                                                        payload_size)
+        return True
+
+    async def on_send_failed(self, data: List, attempt: int, error: Exception):
+        """
+        Handles a batch that could not be sent, or was accepted only in part: the batch is retried if a retry
+        scheduler is configured; otherwise items rejected in case of partial success are discarded and counted,
+        and other failures are propagated.
+        """
+        if self._retry is not None:
+            if not self._retry.schedule(data, attempt, error, self._retry_batch):
+                logger.warning('Discarded telemetry items that could not be sent after %d attempts, because of: %r',
+                               attempt, error)
+            return
+
+        if not isinstance(error, PartialSendFailed):
+            raise error
+
+        # NB: accepted items were stored, only rejected ones are lost
+        for index, _ in error.errors:
+            if 0 <= index < len(data):
+                self._count_failed(get_type_name(data[index]))
+        logger.warning('Discarded telemetry items rejected by the server: %r', error)
+
+    def _ensure_sender(self):
+        # NB: the sender is started lazily, since a running loop is needed to create tasks
+        if self._sender_task is not None or self._stopping:
+            return
+        self._flush_requested = asyncio.Event()
+        self._sender_task = asyncio.ensure_future(self._run_sender())
+
+    async def _run_sender(self):
+        flush_requested = self._flush_requested
+        while True:
+            try:
+                await asyncio.wait_for(flush_requested.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            flush_requested.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                # NB: the sender must survive failures, otherwise telemetry would pile up in memory
+                logger.exception('Failed to send telemetry')
+
+            if self._stopping:
+                break
+
+    async def stop_sender(self):
+        """Stops the background sender, if running, letting it drain the queue a last time."""
+        self._stopping = True
+        task = self._sender_task
+        if task is None:
+            return
+        self._sender_task = None
+        self._flush_requested.set()
+        await task
+
+    async def stop(self):
+        """Stops background tasks of this channel, sending pending items a last time."""
+        await self.stop_sender()
+
+        if self._retry is not None:
+            await self._retry.close()
 
     @abstractmethod
-    async def send(self, data: List):
-        pass
+    async def send(self, data: List) -> Optional[int]:
+        """Sends a batch of items, optionally returning the number of bytes of the payload."""
 
     @abstractmethod
     async def dispose(self):
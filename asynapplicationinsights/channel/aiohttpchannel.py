@@ -1,9 +1,14 @@
+import json
 import aiohttp
 import asyncio
 from typing import Optional, List
 from .abstractions import TelemetryChannel
-from ..exceptions import OperationFailed
-from ..utils.json import friendly_dumps
+from .batching import AdaptiveBatchSize
+from .queues import TelemetryQueue
+from .retry import RetryScheduler, parse_retry_after
+from ..exceptions import SendFailed, PartialSendFailed, exception_str
+from ..serialization import serialize_envelopes, iter_ndjson_envelopes
+from ..utils.compression import compress, get_compressor, validate_encoding
 
 
 class AiohttpTelemetryChannel(TelemetryChannel):
@@ -11,14 +16,67 @@ class AiohttpTelemetryChannel(TelemetryChannel):
     def __init__(self,
                  loop:Optional[asyncio.AbstractEventLoop]=None,
                  client:Optional[aiohttp.ClientSession]=None,
-                 endpoint:Optional[str]=None):
-        super().__init__()
+                 endpoint:Optional[str]=None,
+                 *,
+                 background_sender: bool = False,
+                 flush_interval: Optional[float] = 10.0,
+                 max_batch_size: int = 500,
+                 batch_size: Optional[AdaptiveBatchSize] = None,
+                 queue: Optional[TelemetryQueue] = None,
+                 retry: Optional[RetryScheduler] = None,
+                 max_concurrent_sends: int = 1,
+                 connection_limit: Optional[int] = None,
+                 timeout: float = 30.0,
+                 dns_cache_ttl: int = 300,
+                 keepalive_timeout: float = 60.0,
+                 compression: Optional[str] = None,
+                 compression_level: int = 6,
+                 compression_threshold: int = 1024,
+                 executor_compression_threshold: int = 256 * 1024,
+                 streaming: bool = False):
+        """
+        :param loop: optional asyncio loop, if not specified asyncio.get_event_loop is used
+        :param client: optionally, an http client session for web requests
+        :param endpoint: optional Application Insights track endpoint
+        :param max_concurrent_sends: maximum number of batches being sent at the same time
+        :param connection_limit: maximum number of connections of the http client session created by this channel;
+        by default equal to max_concurrent_sends
+        :param timeout: number of seconds after which a request made by the http client session created by this
+        channel is aborted
+        :param dns_cache_ttl: number of seconds DNS resolutions are cached by the http client session created by this
+        channel
+        :param keepalive_timeout: number of seconds idle connections are kept open by the http client session
+        created by this channel
+        :param compression: optional content encoding for request bodies, 'gzip' or 'deflate'
+        :param compression_level: compression level, from 1 (fastest) to 9 (smallest)
+        :param compression_threshold: minimum number of bytes of a request body to be compressed
+        :param executor_compression_threshold: minimum number of bytes of a request body to be compressed in the
+        default executor, to not block the event loop
+        :param streaming: whether request bodies should be serialized and compressed item by item while they are
+        sent, as newline delimited JSON, instead of being built entirely in memory before sending
+        """
+        super().__init__(background_sender,
+                         flush_interval,
+                         max_batch_size,
+                         batch_size,
+                         queue,
+                         retry,
+                         max_concurrent_sends)
+
+        if compression:
+            validate_encoding(compression)
 
         dispose_client = True
         if client is None:
             if loop is None:
                 loop = asyncio.get_event_loop()
-            client = aiohttp.ClientSession(loop=loop)
+            connector = aiohttp.TCPConnector(limit=connection_limit or max_concurrent_sends,
+                                             ttl_dns_cache=dns_cache_ttl,
+                                             keepalive_timeout=keepalive_timeout,
+                                             loop=loop)
+            client = aiohttp.ClientSession(loop=loop,
+                                           connector=connector,
+                                           timeout=aiohttp.ClientTimeout(total=timeout))
         else:
             dispose_client = False
 
@@ -29,18 +87,105 @@ class AiohttpTelemetryChannel(TelemetryChannel):
         self._http_client = client
         self._endpoint = endpoint
         self._headers = {'Accept': 'application/json', 'Content-Type': 'application/json; charset=utf-8'}
+        self._compression = compression
+        self._compression_level = compression_level
+        self._compression_threshold = compression_threshold
+        self._executor_compression_threshold = executor_compression_threshold
+        self._streaming = streaming
+        self._stream_headers = {'Accept': 'application/json', 'Content-Type': 'application/x-json-stream'}
+        self._compressed_headers = {}
+        self._compressed_stream_headers = {}
+        if compression:
+            self._compressed_headers = dict(self._headers, **{'Content-Encoding': compression})
+            self._compressed_stream_headers = dict(self._stream_headers, **{'Content-Encoding': compression})
+
+    async def compress(self, body: bytes) -> bytes:
+        if len(body) < self._executor_compression_threshold:
+            return compress(body, self._compression, self._compression_level)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None,
+                                          compress,
+                                          body,
+                                          self._compression,
+                                          self._compression_level)
+
+    async def stream(self, data: List, counter: List[int]):
+        """
+        Yields the request body for the given items, chunk by chunk, counting the bytes produced in counter.
+        """
+        compressor = get_compressor(self._compression, self._compression_level) if self._compression else None
+
+        for chunk in iter_ndjson_envelopes(data):
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            counter[0] += len(chunk)
+            yield chunk
+
+        if compressor is not None:
+            chunk = compressor.flush()
+            counter[0] += len(chunk)
+            yield chunk
+
+    async def send(self, data: List) -> int:
+        if self._streaming:
+            counter = [0]
+            headers = self._compressed_stream_headers if self._compression else self._stream_headers
+            await self.post(self.stream(data, counter), headers)
+            return counter[0]
+
+        return await self.send_payload(serialize_envelopes(data))
 
-    async def send(self, data: List):
-        body = friendly_dumps(data)
-        response = await self._http_client.post(self._endpoint,
-                                                data=body.encode('utf8'),
-                                                headers=self._headers)
+    async def send_payload(self, body: bytes, ndjson: bool = False) -> int:
+        """
+        Sends items already serialized, compressing them if configured, and returns the number of bytes sent.
+
+        :param body: a JSON array of envelopes, or envelopes as newline delimited JSON, encoded in UTF-8
+        :param ndjson: whether the body is newline delimited JSON
+        """
+        if self._compression and len(body) >= self._compression_threshold:
+            body = await self.compress(body)
+            headers = self._compressed_stream_headers if ndjson else self._compressed_headers
+        else:
+            headers = self._stream_headers if ndjson else self._headers
+
+        await self.post(body, headers)
+        return len(body)
+
+    async def post(self, body, headers):
+        try:
+            # NB: the response is always read, so the connection is released to the pool and kept alive
+            async with self._http_client.post(self._endpoint,
+                                              data=body,
+                                              headers=headers) as response:
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise SendFailed(f'Failed to send telemetry: {exception_str(error)}') from error
+
+        if response.status == 206:
+            raise self.get_partial_failure(text)
 
         if response.status != 200:
-            text = await response.text()
-            raise OperationFailed(f'Response status does not indicate success: {response.status}; response body: {text}')
+            raise SendFailed(f'Response status does not indicate success: {response.status}; response body: {text}',
+                             response.status,
+                             parse_retry_after(response.headers.get('Retry-After')))
+
+    @staticmethod
+    def get_partial_failure(text: str) -> SendFailed:
+        # NB: in case of partial success, the response body describes which items were rejected, by index
+        try:
+            errors = [(int(error['index']), int(error['statusCode']))
+                      for error in json.loads(text).get('errors') or []]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return SendFailed(f'Partial success with invalid response body: {text}', 206)
+
+        return PartialSendFailed(f'Some items were rejected; response body: {text}', errors)
 
     async def dispose(self):
+        await self.stop()
+
         # NB: the client is disposed only if it was instantiated
         if self._dispose_client:
             await self._http_client.close()
@@ -0,0 +1,80 @@
+from typing import Optional
+
+
+class AdaptiveBatchSize:
+    """
+    Adjusts the number of items sent in each batch, using observed send latency and payload size:
+    batches grow while uploads are fast and small, and shrink when they take longer than the target latency
+    or exceed the maximum payload size.
+    """
+
+    __slots__ = ('min_size',
+                 'max_size',
+                 'target_latency',
+                 'max_payload_size',
+                 'smoothing',
+                 'size',
+                 '_seconds_per_item',
+                 '_bytes_per_item')
+
+    def __init__(self,
+                 initial_size: int = 500,
+                 min_size: int = 50,
+                 max_size: int = 5000,
+                 target_latency: float = 1.0,
+                 max_payload_size: int = 3 * 1024 * 1024,
+                 smoothing: float = 0.3):
+        """
+        :param initial_size: batch size used before any observation
+        :param min_size: minimum batch size
+        :param max_size: maximum batch size
+        :param target_latency: desired number of seconds for a single batch upload
+        :param max_payload_size: desired maximum number of bytes for a single batch upload
+        :param smoothing: weight of the last observation in moving averages, between 0 and 1
+        """
+        if not 0 < min_size <= initial_size <= max_size:
+            raise ValueError('batch sizes must satisfy 0 < min_size <= initial_size <= max_size')
+
+        if not 0 < smoothing <= 1:
+            raise ValueError('smoothing must be greater than 0 and lesser or equal to 1')
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.max_payload_size = max_payload_size
+        self.smoothing = smoothing
+        self.size = initial_size
+        self._seconds_per_item = None  # type: Optional[float]
+        self._bytes_per_item = None  # type: Optional[float]
+
+    def _average(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return current + self.smoothing * (value - current)
+
+    def observe(self, count: int, elapsed: float, payload_size: Optional[int] = None) -> int:
+        """
+        Records the outcome of a batch upload and returns the updated batch size.
+
+        :param count: number of items sent
+        :param elapsed: number of seconds it took to send them
+        :param payload_size: optional number of bytes sent
+        :return: batch size to use for next uploads
+        """
+        if count <= 0:
+            return self.size
+
+        self._seconds_per_item = self._average(self._seconds_per_item, elapsed / count)
+        if payload_size:
+            self._bytes_per_item = self._average(self._bytes_per_item, payload_size / count)
+
+        target = self.max_size
+        if self._seconds_per_item > 0:
+            target = min(target, self.target_latency / self._seconds_per_item)
+        if self._bytes_per_item:
+            target = min(target, self.max_payload_size / self._bytes_per_item)
+
+        # NB: the size is at most doubled or halved at each step, to avoid oscillations caused by outliers
+        target = max(self.size / 2, min(self.size * 2, target))
+        self.size = int(max(self.min_size, min(self.max_size, target)))
+        return self.size
@@ -0,0 +1,111 @@
+"""
+This module defines a channel that forwards telemetry to a local collector process over a Unix domain socket,
+instead of sending it to Application Insights: with many worker processes, a single collector merges their
+metrics, batches and compresses their envelopes, and sends them upstream over few connections.
+
+Messages are frames made of a kind byte, the length of the payload as 32 bits unsigned integer, and the payload:
+- envelopes: serialized envelopes as newline delimited JSON, forwarded as-is by the collector;
+- metrics: JSON array of metric series deltas, merged by the collector with those of other workers.
+"""
+import struct
+import asyncio
+from typing import List, Optional, Tuple
+from .abstractions import TelemetryChannel
+from ..exceptions import SendFailed, exception_str
+from ..metrics import MetricSeries, HistogramSeries
+from ..serialization import dumps, iter_ndjson_envelopes
+
+
+FRAME_HEADER = struct.Struct('>cI')
+
+ENVELOPES_FRAME = b'E'
+
+METRICS_FRAME = b'M'
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode_frame(kind: bytes, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Tuple[bytes, bytes]]:
+    """Reads a single frame, returning its kind and payload, or None if the connection was closed."""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+
+    kind, length = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f'Frame exceeding the maximum size: {length}')
+    return kind, await reader.readexactly(length)
+
+
+def encode_metrics(series: List[Tuple[str, Optional[dict], MetricSeries]]) -> bytes:
+    return dumps([[name, properties, 'h' if isinstance(data, HistogramSeries) else 's', data.to_state()]
+                  for name, properties, data in series])
+
+
+def decode_metrics(items: list) -> List[Tuple[str, Optional[dict], MetricSeries]]:
+    return [(name, properties, (HistogramSeries if kind == 'h' else MetricSeries).from_state(state))
+            for name, properties, kind, state in items]
+
+
+class ForwardingTelemetryChannel(TelemetryChannel):
+    """
+    Telemetry channel forwarding serialized envelopes and metric deltas to a local collector, over a Unix
+    domain socket; the connection is opened lazily and opened again after failures, which are reported as
+    SendFailed, so they can be retried like failures of other channels.
+    """
+
+    def __init__(self,
+                 path: str,
+                 *,
+                 connect_timeout: float = 5.0,
+                 **options):
+        """
+        :param path: path of the Unix domain socket of the collector
+        :param connect_timeout: number of seconds after which connecting to the collector fails
+        :param options: other options of TelemetryChannel
+        """
+        super().__init__(**options)
+        self.path = path
+        self._connect_timeout = connect_timeout
+        self._writer = None  # type: Optional[asyncio.StreamWriter]
+        self._lock = None  # type: Optional[asyncio.Lock]
+
+    async def _write(self, kind: bytes, payload: bytes):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # NB: frames of concurrent sends must not interleave
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    _, self._writer = await asyncio.wait_for(asyncio.open_unix_connection(self.path),
+                                                             self._connect_timeout)
+                self._writer.write(encode_frame(kind, payload))
+                await self._writer.drain()
+            except (OSError, asyncio.TimeoutError) as error:
+                self._close_writer()
+                raise SendFailed(f'Failed to forward telemetry to the collector: {exception_str(error)}')
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def send(self, data: List) -> Optional[int]:
+        payload = b''.join(iter_ndjson_envelopes(data))
+        await self._write(ENVELOPES_FRAME, payload)
+        return len(payload)
+
+    async def forward_metrics(self, series: List[Tuple[str, Optional[dict], MetricSeries]]):
+        """Forwards aggregated metric series to the collector, to be merged with those of other workers."""
+        if series:
+            await self._write(METRICS_FRAME, encode_metrics(series))
+
+    async def dispose(self):
+        await self.stop()
+        self._close_writer()
@@ -0,0 +1,170 @@
+import asyncio
+from asyncio import QueueEmpty
+from collections import deque
+from enum import Enum
+from typing import Optional, Dict
+
+
+class OverflowPolicy(Enum):
+    """Describes what happens when an item is added to a full queue, and no item of lower priority can be shed."""
+
+    DROP_NEWEST = 'drop_newest'
+    """The new item is discarded."""
+
+    DROP_OLDEST = 'drop_oldest'
+    """The oldest item having the same priority of the new one is discarded."""
+
+    BLOCK = 'block'
+    """The caller waits for free space, up to a timeout; then the new item is discarded."""
+
+
+DEFAULT_PRIORITIES = {
+    'ExceptionData': 2,
+    'RequestData': 2,
+    'EventData': 1,
+    'MessageData': 0,
+    'MetricData': 0
+}
+
+
+def get_type_name(item) -> Optional[str]:
+    return getattr(item, 'data_type_name', None)
+
+
+class TelemetryQueue:
+    """
+    Queue of telemetry items, optionally bounded, supporting priorities by telemetry type:
+    items of higher priority are returned first, and when the queue is full, items of lower priority
+    are discarded to make room for the new ones.
+    """
+
+    def __init__(self,
+                 maxsize: int = 0,
+                 overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+                 block_timeout: float = 1.0,
+                 priorities: Optional[Dict[str, int]] = None,
+                 default_priority: int = 1):
+        """
+        :param maxsize: maximum number of items in queue; if lesser or equal to zero, the queue is unbounded
+        :param overflow_policy: what to do when the queue is full and no item of lower priority can be discarded
+        :param block_timeout: maximum number of seconds to wait for free space, with OverflowPolicy.BLOCK
+        :param priorities: priorities by data type name (e.g. 'ExceptionData'), the greater the more important
+        :param default_priority: priority of items whose type is not configured in priorities
+        """
+        if priorities is None:
+            priorities = DEFAULT_PRIORITIES
+
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self._priorities = dict(priorities)
+        self._default_priority = default_priority
+        self._queues = {priority: deque()
+                        for priority in set(self._priorities.values()) | {default_priority}}
+        # NB: sorted from the highest priority to the lowest
+        self._levels = sorted(self._queues, reverse=True)
+        self._size = 0
+        self._putters = deque()
+        self.dropped = {}  # type: Dict[Optional[str], int]
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self._size
+
+    @property
+    def dropped_count(self) -> int:
+        return sum(self.dropped.values())
+
+    def get_priority(self, item) -> int:
+        return self._priorities.get(get_type_name(item), self._default_priority)
+
+    def _drop(self, item):
+        type_name = get_type_name(item)
+        self.dropped[type_name] = self.dropped.get(type_name, 0) + 1
+
+    def _evict(self, max_priority: int) -> bool:
+        # discards the oldest item of the lowest priority, if not greater than the given one
+        for priority in reversed(self._levels):
+            if priority > max_priority:
+                return False
+            queue = self._queues[priority]
+            if queue:
+                self._drop(queue.popleft())
+                self._size -= 1
+                return True
+        return False
+
+    def _offer(self, item) -> bool:
+        priority = self.get_priority(item)
+
+        if self.full():
+            # items of lower priority are shed first, regardless of the overflow policy
+            if not self._evict(priority - 1):
+                if self.overflow_policy is not OverflowPolicy.DROP_OLDEST or not self._evict(priority):
+                    return False
+
+        self._queues[priority].append(item)
+        self._size += 1
+        return True
+
+    def put_nowait(self, item) -> bool:
+        """
+        Adds an item to the queue without waiting, returning a value indicating whether it was added.
+        With OverflowPolicy.BLOCK, an item that doesn't fit in the queue is discarded.
+        """
+        if self._offer(item):
+            return True
+        self._drop(item)
+        return False
+
+    async def put(self, item) -> bool:
+        """Adds an item to the queue, returning a value indicating whether it was added."""
+        if self._offer(item):
+            return True
+
+        if self.overflow_policy is OverflowPolicy.BLOCK and self.block_timeout > 0:
+            loop = asyncio.get_event_loop()
+            deadline = loop.time() + self.block_timeout
+
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+
+                putter = loop.create_future()
+                self._putters.append(putter)
+                try:
+                    await asyncio.wait_for(putter, remaining)
+                except asyncio.TimeoutError:
+                    break
+                finally:
+                    if not putter.done():
+                        putter.cancel()
+
+                if self._offer(item):
+                    return True
+
+        self._drop(item)
+        return False
+
+    def _wakeup_next_putter(self):
+        while self._putters:
+            putter = self._putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
+                break
+
+    def get_nowait(self):
+        for priority in self._levels:
+            queue = self._queues[priority]
+            if queue:
+                self._size -= 1
+                item = queue.popleft()
+                self._wakeup_next_putter()
+                return item
+        raise QueueEmpty()
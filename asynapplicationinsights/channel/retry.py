@@ -0,0 +1,214 @@
+import random
+import asyncio
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from .queues import get_type_name
+from ..exceptions import SendFailed, PartialSendFailed
+
+
+logger = logging.getLogger(__name__)
+
+
+# NB: 439 is returned by Application Insights when the daily quota is exceeded
+RETRIABLE_STATUSES = frozenset({408, 429, 439, 500, 502, 503, 504})
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses the value of a Retry-After header, either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryPolicy:
+    """Describes which failures are retried, how many times, and after how long."""
+
+    __slots__ = ('max_attempts',
+                 'base_delay',
+                 'max_delay',
+                 'jitter',
+                 'max_retry_after',
+                 'retriable_statuses')
+
+    def __init__(self,
+                 max_attempts: int = 5,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 jitter: float = 0.5,
+                 max_retry_after: float = 600.0,
+                 retriable_statuses=RETRIABLE_STATUSES):
+        """
+        :param max_attempts: maximum number of attempts to send a batch, including the first one
+        :param base_delay: number of seconds before the first retry; the delay doubles at each attempt
+        :param max_delay: maximum number of seconds between attempts, unless the server requests a longer delay
+        :param jitter: fraction of the delay randomly subtracted from it, to spread retries from many clients
+        :param max_retry_after: maximum number of seconds a batch waits for a retry requested by the server with
+        Retry-After; batches the server asks to retry later than that are discarded
+        :param retriable_statuses: response statuses that indicate a transient failure
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+        self.retriable_statuses = retriable_statuses
+
+    def is_retriable(self, error: Exception) -> bool:
+        if not isinstance(error, SendFailed):
+            return False
+        # NB: a failure without response status is a connection error or a timeout
+        return error.status is None or error.status in self.retriable_statuses
+
+    def split(self, data: List, error: Exception) -> Tuple[List, List]:
+        """
+        Returns the items of a failed batch that can be sent again, and those that must be discarded;
+        in case of partial success, items that were accepted are not returned at all.
+        """
+        if isinstance(error, PartialSendFailed):
+            retriable = []
+            rejected = []
+            for index, status in error.errors:
+                if 0 <= index < len(data):
+                    if status in self.retriable_statuses:
+                        retriable.append(data[index])
+                    else:
+                        rejected.append(data[index])
+            return retriable, rejected
+
+        if self.is_retriable(error):
+            return data, []
+        return [], data
+
+    def get_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Returns the number of seconds to wait before the next attempt.
+
+        :param attempt: number of the failed attempt, starting from 1
+        :param retry_after: optional number of seconds requested by the server
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay -= delay * self.jitter * random.random()
+
+        if retry_after is not None:
+            # NB: the server indication wins over the policy, and is never shortened by max_delay
+            delay = max(delay, retry_after)
+        return delay
+
+
+class RetryScheduler:
+    """
+    Keeps batches whose sending failed for a transient reason, and sends them again after a delay;
+    in case of partial success, only rejected items that can be retried are sent again.
+    The number of batches and items waiting to be retried is capped, to bound memory usage:
+    batches that cannot be retried are discarded and counted.
+    """
+
+    def __init__(self,
+                 policy: Optional[RetryPolicy] = None,
+                 max_pending_batches: int = 20,
+                 max_pending_items: int = 20000):
+        """
+        :param policy: optional retry policy, if not specified a default one is used
+        :param max_pending_batches: maximum number of batches waiting to be retried
+        :param max_pending_items: maximum number of items waiting to be retried
+        """
+        self.policy = policy or RetryPolicy()
+        self.max_pending_batches = max_pending_batches
+        self.max_pending_items = max_pending_items
+        self.pending_batches = 0
+        self.pending_items = 0
+        self.dropped = {}  # type: Dict[Optional[str], int]
+        self._tasks = set()  # type: Set[asyncio.Task]
+        self._retry_now = None  # type: Optional[asyncio.Event]
+        self._closing = False
+
+    @property
+    def dropped_count(self) -> int:
+        return sum(self.dropped.values())
+
+    def drop(self, data: List):
+        for item in data:
+            type_name = get_type_name(item)
+            self.dropped[type_name] = self.dropped.get(type_name, 0) + 1
+
+    def schedule(self,
+                 data: List,
+                 attempt: int,
+                 error: Exception,
+                 send: Callable[[List, int], Awaitable]) -> bool:
+        """
+        Schedules a new attempt to send a batch, if the failure is transient and limits allow it;
+        otherwise discards the batch.
+
+        :param data: items of the batch
+        :param attempt: number of the failed attempt, starting from 1
+        :param error: the exception that caused the failure
+        :param send: function to send the batch again, receiving items and attempt number
+        :return: a value indicating whether a new attempt was scheduled
+        """
+        data, rejected = self.policy.split(data, error)
+        if rejected:
+            self.drop(rejected)
+
+        count = len(data)
+        if not data:
+            return False
+
+        retry_after = getattr(error, 'retry_after', None)
+        if self._closing \
+                or attempt >= self.policy.max_attempts \
+                or (retry_after is not None and retry_after > self.policy.max_retry_after) \
+                or self.pending_batches >= self.max_pending_batches \
+                or self.pending_items + count > self.max_pending_items:
+            self.drop(data)
+            return False
+
+        if self._retry_now is None:
+            self._retry_now = asyncio.Event()
+
+        delay = self.policy.get_delay(attempt, retry_after)
+        self.pending_batches += 1
+        self.pending_items += count
+
+        task = asyncio.ensure_future(self._retry_later(data, attempt, delay, send))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _retry_later(self, data, attempt, delay, send):
+        try:
+            await asyncio.wait_for(self._retry_now.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.pending_batches -= 1
+            self.pending_items -= len(data)
+
+        try:
+            await send(data, attempt + 1)
+        except Exception:
+            logger.exception('Failed to send telemetry')
+
+    async def close(self):
+        """Sends pending batches immediately, a last time, discarding those that fail again."""
+        self._closing = True
+        if not self._tasks:
+            return
+        self._retry_now.set()
+        await asyncio.gather(*self._tasks)
@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import List, Optional
+from .aiohttpchannel import AiohttpTelemetryChannel
+from .queues import get_type_name
+from .retry import RetryPolicy
+from ..exceptions import InvalidArgument, InvalidOperation, PartialSendFailed
+from ..serialization import iter_ndjson_envelopes
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+SEGMENT_EXTENSION = '.ndjson'
+LOCK_FILE_NAME = '.lock'
+
+
+class SegmentSpool:
+    """
+    Directory of append-only segment files, each containing serialized envelopes as newline delimited JSON.
+    Items are appended to the current segment, which is closed when it exceeds a maximum size; when the spool
+    exceeds its maximum size, or segments are older than a maximum age, the oldest segments are discarded.
+
+    A directory must not be shared by processes running at the same time, since segments are sent and removed
+    without coordination with other processes: processes that spool telemetry use a directory each, or forward
+    their telemetry to a single collector (refer to collector.py). Where file locks are available, the directory
+    is locked while the spool is open, and opening it again raises InvalidOperation; the lock is released when
+    the spool is closed, or when the process ends, so a restarted process sends the segments left by its
+    predecessor.
+
+    NB: methods of this class perform blocking disk operations, and are meant to be run in an executor.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 max_segment_size: int = 1024 * 1024,
+                 max_size: int = 50 * 1024 * 1024,
+                 max_age: float = 48 * 3600):
+        """
+        :param directory: path to the directory of segment files, created if it doesn't exist
+        :param max_segment_size: number of bytes after which a segment is closed and a new one is started
+        :param max_size: maximum number of bytes of all segments
+        :param max_age: maximum number of seconds a segment is kept
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = self._lock_directory(directory)
+        self.directory = directory
+        self.max_segment_size = max_segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.discarded_segments = 0
+        self._current = None  # type: Optional[str]
+        self._current_size = 0
+        self._counter = 0
+        self._size = sum(os.path.getsize(path) for path in self._list())
+
+    @staticmethod
+    def _lock_directory(directory: str):
+        if fcntl is None:
+            return None
+
+        lock_file = open(os.path.join(directory, LOCK_FILE_NAME), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise InvalidOperation(f'The spool directory is in use by another spool: {directory}')
+        return lock_file
+
+    def close(self):
+        """Releases the directory of the spool, so another spool can use it."""
+        if self._lock_file is not None:
+            # NB: closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _list(self) -> List[str]:
+        # NB: segment names start with their creation time, so sorting by name returns the oldest first
+        return [os.path.join(self.directory, name)
+                for name in sorted(os.listdir(self.directory))
+                if name.endswith(SEGMENT_EXTENSION)]
+
+    def _new_segment_path(self) -> str:
+        self._counter += 1
+        name = f'{int(time.time() * 1000):013d}-{os.getpid()}-{self._counter:06d}{SEGMENT_EXTENSION}'
+        return os.path.join(self.directory, name)
+
+    def append(self, data: bytes):
+        """Appends lines of newline delimited JSON to the current segment."""
+        if self._current is None or self._current_size >= self.max_segment_size:
+            self._current = self._new_segment_path()
+            self._current_size = 0
+
+        with open(self._current, 'ab') as segment:
+            segment.write(data)
+
+        self._current_size += len(data)
+        self._size += len(data)
+        self._enforce_max_size()
+
+    def _enforce_max_size(self):
+        for path in self._list():
+            if self._size <= self.max_size or path == self._current:
+                break
+            self.remove(path)
+            self.discarded_segments += 1
+
+    def rotate(self) -> List[str]:
+        """Closes the current segment and returns the paths of all segments, from the oldest to the newest."""
+        self._current = None
+        self._current_size = 0
+
+        paths = []
+        expiration = time.time() - self.max_age
+        for path in self._list():
+            if os.path.getmtime(path) < expiration:
+                self.remove(path)
+                self.discarded_segments += 1
+            else:
+                paths.append(path)
+        return paths
+
+    @staticmethod
+    def read(path: str) -> bytes:
+        with open(path, 'rb') as segment:
+            return segment.read()
+
+    def remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        self._size -= size
+        if path == self._current:
+            self._current = None
+            self._current_size = 0
+
+    def is_empty(self) -> bool:
+        return self._size <= 0
+
+
+def get_line_type_name(line: bytes) -> Optional[str]:
+    try:
+        return json.loads(line.decode('utf8'))['data']['baseType']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class SpoolingTelemetryChannel(AiohttpTelemetryChannel):
+    """
+    Telemetry channel that writes to disk the items that could not be sent because of transient failures,
+    like endpoint outages or throttling, and sends them again in background once sending succeeds;
+    spooled items survive process restarts, since they are sent by the next channel using the same directory.
+    A directory is used by a single channel at a time: refer to SegmentSpool.
+    Disk operations are executed in the default executor, to not block the event loop.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 loop: Optional[asyncio.AbstractEventLoop] = None,
+                 client=None,
+                 endpoint: Optional[str] = None,
+                 *,
+                 max_segment_size: int = 1024 * 1024,
+                 max_spool_size: int = 50 * 1024 * 1024,
+                 max_spool_age: float = 48 * 3600,
+                 replay_interval: float = 30.0,
+                 policy: Optional[RetryPolicy] = None,
+                 **options):
+        """
+        :param directory: path to the directory where items are spooled
+        :param loop: optional asyncio loop, if not specified asyncio.get_event_loop is used
+        :param client: optionally, an http client session for web requests
+        :param endpoint: optional Application Insights track endpoint
+        :param max_segment_size: number of bytes after which a segment file is closed and a new one is started
+        :param max_spool_size: maximum number of bytes of spooled items; the oldest are discarded first
+        :param max_spool_age: maximum number of seconds items are kept in the spool
+        :param replay_interval: number of seconds between attempts to send spooled items
+        :param policy: optional retry policy, describing which failures are transient
+        :param options: other options of AiohttpTelemetryChannel, except retry
+        """
+        if 'retry' in options:
+            # NB: a retry scheduler would handle every failure, and nothing would be spooled
+            raise InvalidArgument('A spooling channel retries failed items from its spool: retry is not supported')
+        super().__init__(loop, client, endpoint, **options)
+        self.spool = SegmentSpool(directory, max_segment_size, max_spool_size, max_spool_age)
+        self._policy = policy or RetryPolicy()
+        self._replay_interval = replay_interval
+        self._replay_task = None  # type: Optional[asyncio.Task]
+        self._replay_requested = None  # type: Optional[asyncio.Event]
+        self._spool_lock = None  # type: Optional[asyncio.Lock]
+
+    async def _run_in_executor(self, func, *args):
+        loop = asyncio.get_event_loop()
+        if self._spool_lock is None:
+            self._spool_lock = asyncio.Lock()
+        async with self._spool_lock:
+            return await loop.run_in_executor(None, func, *args)
+
+    async def put(self, item):
+        await super().put(item)
+        self._ensure_replayer()
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        self._ensure_replayer()
+
+    async def send_batch(self, data: List, attempt: int = 1) -> bool:
+        sent = await super().send_batch(data, attempt)
+        if sent and not self.spool.is_empty() and self._replay_requested is not None:
+            # sending succeeds again: spooled items can be sent
+            self._replay_requested.set()
+        return sent
+
+    async def on_send_failed(self, data: List, attempt: int, error: Exception):
+        retriable, rejected = self._policy.split(data, error)
+        for item in rejected:
+            self._count_failed(get_type_name(item))
+
+        if retriable:
+            await self.spill(retriable)
+
+    async def spill(self, data: List):
+        """Writes items to the spool, to be sent later."""
+        await self._run_in_executor(self.spool.append, b''.join(iter_ndjson_envelopes(data)))
+        self._ensure_replayer()
+
+    def _ensure_replayer(self):
+        if self._replay_task is not None or self._stopping:
+            return
+        self._replay_requested = asyncio.Event()
+        self._replay_task = asyncio.ensure_future(self._run_replayer())
+
+    async def _run_replayer(self):
+        replay_requested = self._replay_requested
+        while not self._stopping:
+            try:
+                await self.replay()
+            except Exception:
+                logger.exception('Failed to send spooled telemetry')
+
+            try:
+                await asyncio.wait_for(replay_requested.wait(), self._replay_interval)
+            except asyncio.TimeoutError:
+                pass
+            replay_requested.clear()
+
+    async def replay(self) -> bool:
+        """
+        Sends spooled items, from the oldest to the newest, stopping at the first transient failure.
+
+        :return: a value indicating whether all spooled items were handled
+        """
+        paths = await self._run_in_executor(self.spool.rotate)
+
+        for path in paths:
+            body = await self._run_in_executor(self.spool.read, path)
+            lines = body.splitlines(keepends=True)
+
+            try:
+                if lines:
+                    # NB: replays share the send slots with flushes, so they never exceed max_concurrent_sends
+                    async with self._get_send_slots():
+                        await self.send_payload(b''.join(lines), ndjson=True)
+            except Exception as error:
+                retriable, rejected = self._policy.split(lines, error)
+                for line in rejected:
+                    self._count_failed(get_line_type_name(line))
+
+                if retriable and not isinstance(error, PartialSendFailed):
+                    # the failure is transient: the segment is kept to be sent later
+                    return False
+
+                if retriable:
+                    await self._run_in_executor(self.spool.append, b''.join(retriable))
+
+            await self._run_in_executor(self.spool.remove, path)
+        return True
+
+    async def stop(self):
+        await super().stop()
+
+        task = self._replay_task
+        if task is None:
+            return
+        self._replay_task = None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def dispose(self):
+        try:
+            await super().dispose()
+        finally:
+            self.spool.close()
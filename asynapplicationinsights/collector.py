@@ -0,0 +1,141 @@
+"""
+This module defines the local collector, receiving telemetry forwarded by worker processes over a Unix domain
+socket (refer to channel.forwarding): envelopes are queued as they are, already serialized, in the channel of a
+telemetry client, which batches, compresses and sends them upstream; metric series are merged across workers
+and sent once per interval by the client metrics aggregator.
+
+The collector can run in its own process:
+
+    python -m asynapplicationinsights.collector --socket /tmp/ai.sock --key <instrumentation key>
+"""
+import os
+import json
+import asyncio
+import logging
+from typing import Optional, Set
+from .channel.forwarding import ENVELOPES_FRAME, METRICS_FRAME, read_frame, decode_metrics
+from .telemetry import AsyncTelemetryClient
+
+
+logger = logging.getLogger(__name__)
+
+
+class TelemetryCollector:
+    """Server receiving telemetry from worker processes, and sending it with a single telemetry client."""
+
+    def __init__(self, client: AsyncTelemetryClient, path: str):
+        """
+        :param client: telemetry client used to send telemetry upstream; it must have a metrics aggregator,
+        to merge metrics of workers
+        :param path: path of the Unix domain socket to listen to
+        """
+        self.client = client
+        self.path = path
+        self.received_envelopes = 0
+        self.received_series = 0
+        self._server = None  # type: Optional[asyncio.AbstractServer]
+        self._connections = set()  # type: Set[asyncio.Task]
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # NB: a socket file left by a collector that didn't stop cleanly
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_connection, self.path)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                self.receive(*frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception('Closed a collector connection, because of invalid data')
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    def receive(self, kind: bytes, payload: bytes):
+        """Handles a frame received from a worker."""
+        if kind == ENVELOPES_FRAME:
+            for line in payload.splitlines():
+                if line:
+                    self.client.push_nowait(line)
+                    self.received_envelopes += 1
+        elif kind == METRICS_FRAME:
+            series = decode_metrics(json.loads(payload))
+            self.client.merge_metrics(series)
+            self.received_series += len(series)
+        else:
+            raise ValueError(f'Unknown frame kind: {kind!r}')
+
+    async def stop(self):
+        """Stops listening, and closes connections with workers; the telemetry client must be disposed apart."""
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+        for task in list(self._connections):
+            task.cancel()
+        if self._connections:
+            await asyncio.gather(*self._connections, return_exceptions=True)
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def run_collector(instrumentation_key: str,
+                        path: str,
+                        endpoint: Optional[str] = None,
+                        metrics_interval: float = 60.0,
+                        compression: Optional[str] = 'gzip'):
+    from .channel.aiohttpchannel import AiohttpTelemetryChannel
+    from .metrics import MetricsAggregator
+
+    client = AsyncTelemetryClient(instrumentation_key,
+                                  AiohttpTelemetryChannel(endpoint=endpoint,
+                                                          background_sender=True,
+                                                          compression=compression),
+                                  metrics=MetricsAggregator(metrics_interval))
+    try:
+        async with TelemetryCollector(client, path):
+            await asyncio.Event().wait()
+    finally:
+        await client.dispose()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Collects telemetry forwarded by local worker processes, '
+                                                 'and sends it to Azure Application Insights.')
+    parser.add_argument('--socket', required=True, help='path of the Unix domain socket to listen to')
+    parser.add_argument('--key', required=True, help='Application Insights instrumentation key')
+    parser.add_argument('--endpoint', help='optional Application Insights track endpoint')
+    parser.add_argument('--metrics-interval', type=float, default=60.0,
+                        help='number of seconds between sending of aggregated metrics')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run_collector(args.key, args.socket, args.endpoint, args.metrics_interval))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
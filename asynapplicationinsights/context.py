@@ -0,0 +1,75 @@
+"""
+This module defines the ambient operation context: operation, session and user of the code being executed,
+carried in a context variable so that every telemetry item tracked within an operation (for example, the
+handling of a web request) is correlated with it, without passing tags to each track_* call.
+Since asyncio tasks copy the context when they are created, the ambient context of a task is not shared with
+concurrent ones.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Optional
+from .entities import Operation, Session, User
+
+
+class OperationContext:
+    """Operation, session and user of the code being executed, with their tags computed once."""
+
+    __slots__ = ('operation', 'session', 'user', '_tags')
+
+    def __init__(self,
+                 operation: Optional[Operation] = None,
+                 session: Optional[Session] = None,
+                 user: Optional[User] = None):
+        self.operation = operation
+        self.session = session
+        self.user = user
+        self._tags = None  # type: Optional[dict]
+
+    @property
+    def tags(self) -> dict:
+        """
+        Returns the tags of the operation, computed the first time they are needed;
+        shared by all envelopes of the operation, they must not be modified.
+        """
+        tags = self._tags
+        if tags is None:
+            tags = {}
+            if self.operation:
+                tags.update(self.operation.to_dict())
+            if self.user:
+                tags.update(self.user.to_dict())
+            if self.session:
+                tags.update(self.session.to_dict())
+            self._tags = tags
+        return tags
+
+
+_current_context = ContextVar('asynapplicationinsights_operation', default=None)  # type: ContextVar
+
+
+def get_operation_context() -> Optional[OperationContext]:
+    """Returns the ambient operation context, if any."""
+    return _current_context.get()
+
+
+def set_operation_context(context: Optional[OperationContext]) -> Token:
+    """Sets the ambient operation context, returning a token to restore the previous one."""
+    return _current_context.set(context)
+
+
+def reset_operation_context(token: Token):
+    """Restores the ambient operation context that was current before the call that returned the token."""
+    _current_context.reset(token)
+
+
+@contextmanager
+def operation_context(operation: Optional[Operation] = None,
+                      session: Optional[Session] = None,
+                      user: Optional[User] = None):
+    """Sets an ambient operation context for the duration of a with block."""
+    context = OperationContext(operation, session, user)
+    token = set_operation_context(context)
+    try:
+        yield context
+    finally:
+        reset_operation_context(token)
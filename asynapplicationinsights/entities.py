@@ -1,8 +1,9 @@
 import logging
 import locale
 import platform
-import traceback
-from typing import Optional, List
+import linecache
+from functools import lru_cache
+from typing import Optional, List, Tuple, Union
 from datetime import datetime
 from enum import Enum
 
@@ -106,6 +107,36 @@ class Context:
         self.device = device or LoggingDevice()
 
 
+class StaticTags:
+    """
+    Tags that never change for the life of a telemetry client, like device and application information;
+    computed once and shared by all envelopes. Serializers can cache their JSON representation in fragment.
+    """
+    __slots__ = ('values', 'fragment')
+
+    def __init__(self, values: dict):
+        self.values = values
+        self.fragment = None
+
+    def to_dict(self):
+        return dict(self.values)
+
+
+class EnvelopeTags:
+    """Tags of a single envelope: static tags shared by all envelopes, plus optional tags specific to it."""
+    __slots__ = ('static', 'extra')
+
+    def __init__(self, static: StaticTags, extra: Optional[dict] = None):
+        self.static = static
+        self.extra = extra
+
+    def to_dict(self):
+        tags = dict(self.static.values)
+        if self.extra:
+            tags.update(self.extra)
+        return tags
+
+
 class TraceSeverity:
     verbose = 0
 
@@ -209,6 +240,20 @@ class StackFrame:
         }
 
 
+# maximum number of frames recorded for an exception; the innermost frames are kept
+MAX_STACK_DEPTH = 100
+
+
+@lru_cache(maxsize=4096)
+def get_frame_info(code, line: int) -> Tuple[str, int, str, str]:
+    """
+    Returns the file name, line, function name and source text of a location in code;
+    cached with LRU eviction, so source lines of frequent locations are read once.
+    """
+    file_name = code.co_filename
+    return file_name, line, code.co_name, linecache.getline(file_name, line).strip()
+
+
 class ExceptionDetails:
 
     __slots__ = ('id',
@@ -236,38 +281,45 @@ class ExceptionDetails:
         self.texts = texts
 
     @classmethod
-    def from_exception(cls, type, value, tb, skip_frames=0):
+    def from_exception(cls, type, value, tb, skip_frames=0, max_depth: int = MAX_STACK_DEPTH):
         _id = 1
         outer_id = 0
         type_name = type.__name__
         message = str(value)
 
-        stack = []
-        texts = []
-        index = 0
-        for tb_frame_file, tb_frame_line, tb_frame_function, tb_frame_text in traceback.extract_tb(tb):
+        # NB: the traceback is walked directly, collecting only code objects and lines;
+        # skipped frames and frames beyond the maximum depth cost nothing else
+        locations = []
+        while tb is not None:
             if skip_frames:
                 skip_frames -= 1
-                continue
+            else:
+                locations.append((tb.tb_frame.f_code, tb.tb_lineno))
+            tb = tb.tb_next
 
-            texts.append(tb_frame_text)
+        has_full_stack = len(locations) <= max_depth
+        if not has_full_stack:
+            locations = locations[-max_depth:]
 
-            stack.append(StackFrame(index,
-                                    tb_frame_function,
+        # the innermost frame goes first
+        stack = []
+        texts = []
+        for level in range(len(locations) - 1, -1, -1):
+            file_name, line, function, text = get_frame_info(*locations[level])
+            texts.append(text)
+            stack.append(StackFrame(level,
+                                    function,
                                     ' ',
-                                    tb_frame_file,
-                                    tb_frame_line))
-            index += 1
+                                    file_name,
+                                    line))
 
-        stack.reverse()
-        texts.reverse()
         return cls(_id,
                    type_name,
                    message,
                    stack,
                    texts,
                    outer_id,
-                   True)
+                   has_full_stack)
 
     def to_dict(self):
         return {
@@ -310,15 +362,16 @@ class ExceptionData:
 
 
 class DataPointKind(Enum):
-    Measurement = 1,
-    Aggregation = 2
+    # NB: values of DataPointType in the Application Insights schema
+    Measurement = 0
+    Aggregation = 1
 
     def __int__(self):
-        return self.value[0]
+        return self.value
 
 class DataPointTypes:
-    Measurement = 1
-    Aggregation = 2
+    Measurement = 0
+    Aggregation = 1
 
 
 class DataPoint:
@@ -472,18 +525,21 @@ class Envelope:
                  'data_type_name',
                  'time',
                  'instrumentation_key',
-                 'tags')
+                 'tags',
+                 'sample_rate')
 
     def __init__(self,
                  instrumentation_key: str,
                  data,
-                 tags: dict):
+                 tags: Union[dict, EnvelopeTags],
+                 sample_rate: float = 100.0):
         self.data = data
         self.name = data.envelope_type_name
         self.data_type_name = data.data_type_name
         self.time = datetime.utcnow()
         self.instrumentation_key = instrumentation_key
         self.tags = tags
+        self.sample_rate = sample_rate
 
     def __repr__(self):
         return f'<Envelope {self.data_type_name}>'
@@ -495,7 +551,7 @@ class Envelope:
             'ver': 1,
             'name': self.name,
             'time': self.time,
-            'sampleRate': 100.00,
+            'sampleRate': self.sample_rate,
             'iKey': self.instrumentation_key,
             'tags': self.tags,
             'data': {
@@ -8,6 +8,24 @@ class OperationFailed(Exception):
         super().__init__(message)
 
 
+class SendFailed(OperationFailed):
+    """An exception risen when a batch of telemetry items could not be sent."""
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class PartialSendFailed(SendFailed):
+    """
+    An exception risen when only some items of a batch were accepted; errors contains the indexes of rejected
+    items in the batch, with their status.
+    """
+    def __init__(self, message, errors):
+        super().__init__(message, 206)
+        self.errors = errors
+
+
 class InvalidOperation(Exception):
     """An exception risen in case of an operation that doesn't make sense in a certain context."""
 
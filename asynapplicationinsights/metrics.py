@@ -0,0 +1,433 @@
+"""
+This module defines classes to pre-aggregate metrics in process: samples are accumulated in running statistics
+per series (metric name and properties), and sent as a single aggregated data point per series per interval.
+Histogram series also keep a quantile sketch of their samples, sent as one data point per percentile.
+"""
+import math
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from .entities import DataPoint, DataPointKind
+
+
+class MetricSeries:
+    """Running statistics of the samples of a metric series, in constant memory."""
+
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        # NB: Welford's algorithm, numerically stable
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'MetricSeries'):
+        """Merges the statistics of another series into this one."""
+        if not other.count:
+            return
+        if not self.count:
+            self.count, self.mean, self.m2, self.min, self.max = \
+                other.count, other.mean, other.m2, other.min, other.max
+            return
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def sum(self) -> float:
+        return self.mean * self.count
+
+    @property
+    def std_dev(self) -> float:
+        if not self.count:
+            return 0.0
+        return math.sqrt(self.m2 / self.count)
+
+    def to_state(self) -> list:
+        """Returns the statistics of this series as a list of JSON native values, to be merged elsewhere."""
+        return [self.count, self.mean, self.m2, self.min, self.max]
+
+    @classmethod
+    def from_state(cls, state: list) -> 'MetricSeries':
+        series = cls()
+        series.count, series.mean, series.m2, series.min, series.max = state
+        return series
+
+    def to_data_point(self, name: str) -> DataPoint:
+        # NB: the value of an aggregated data point is the sum of samples
+        return DataPoint(name,
+                         self.sum,
+                         DataPointKind.Aggregation,
+                         self.count,
+                         self.min,
+                         self.max,
+                         self.std_dev)
+
+
+class QuantileSketch:
+    """
+    Mergeable sketch of a distribution, answering quantiles with a bounded relative error, in bounded memory.
+    Values are counted in buckets whose boundaries grow geometrically (like in DDSketch): a quantile is
+    estimated within relative_accuracy of its true value, as long as the number of buckets doesn't exceed
+    max_buckets; beyond that limit, the lowest buckets are collapsed, preserving the accuracy of high quantiles.
+    Sketches with the same relative accuracy can be merged, for example to combine samples of many workers.
+    """
+
+    __slots__ = ('relative_accuracy',
+                 'max_buckets',
+                 'min_value',
+                 'count',
+                 'zero_count',
+                 '_gamma',
+                 '_log_gamma',
+                 '_positive',
+                 '_negative')
+
+    def __init__(self,
+                 relative_accuracy: float = 0.01,
+                 max_buckets: int = 2048,
+                 min_value: float = 1e-9):
+        """
+        :param relative_accuracy: maximum relative error of estimated quantiles
+        :param max_buckets: maximum number of buckets, for positive and negative values each
+        :param min_value: values whose absolute value is smaller than this are counted as zero
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.min_value = min_value
+        self.count = 0
+        self.zero_count = 0
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._positive = {}  # type: Dict[int, int]
+        self._negative = {}  # type: Dict[int, int]
+
+    def _get_index(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _get_value(self, index: int) -> float:
+        # NB: the estimate with the lowest relative error for values in (gamma^(i-1), gamma^i]
+        return 2 * self._gamma ** index / (1 + self._gamma)
+
+    def _collapse(self, buckets: Dict[int, int]):
+        if len(buckets) <= self.max_buckets:
+            return
+        indexes = sorted(buckets)
+        excess = len(indexes) - self.max_buckets
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            buckets[target] += buckets.pop(index)
+
+    def add(self, value: float, count: int = 1):
+        self.count += count
+        if value > self.min_value:
+            buckets = self._positive
+        elif value < -self.min_value:
+            buckets = self._negative
+            value = -value
+        else:
+            self.zero_count += count
+            return
+
+        index = self._get_index(value)
+        try:
+            buckets[index] += count
+        except KeyError:
+            buckets[index] = count
+            self._collapse(buckets)
+
+    def merge(self, other: 'QuantileSketch'):
+        """Merges the samples of another sketch with the same relative accuracy into this one."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different relative accuracy')
+
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for buckets, other_buckets in ((self._positive, other._positive), (self._negative, other._negative)):
+            for index, count in other_buckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+            self._collapse(buckets)
+
+    def to_state(self) -> dict:
+        """Returns the buckets of this sketch as a dictionary of JSON native values, to be merged elsewhere."""
+        return {
+            'accuracy': self.relative_accuracy,
+            'zero': self.zero_count,
+            'positive': list(self._positive.items()),
+            'negative': list(self._negative.items())
+        }
+
+    @classmethod
+    def from_state(cls, state: dict, max_buckets: int = 2048) -> 'QuantileSketch':
+        sketch = cls(state['accuracy'], max_buckets)
+        sketch.zero_count = state['zero']
+        sketch._positive = {index: count for index, count in state['positive']}
+        sketch._negative = {index: count for index, count in state['negative']}
+        sketch.count = sketch.zero_count + sum(sketch._positive.values()) + sum(sketch._negative.values())
+        return sketch
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Returns the estimated value at the given quantile, between 0 and 1, or None if the sketch is empty."""
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+
+        # negative values, from the lowest to the highest
+        for index in sorted(self._negative, reverse=True):
+            seen += self._negative[index]
+            if seen > rank:
+                return -self._get_value(index)
+
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+
+        value = 0.0
+        for index in sorted(self._positive):
+            value = self._get_value(index)
+            seen += self._positive[index]
+            if seen > rank:
+                break
+        return value
+
+
+class HistogramSeries(MetricSeries):
+    """Running statistics of the samples of a metric series, with a quantile sketch of their distribution."""
+
+    __slots__ = ('sketch',)
+
+    def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 2048):
+        super().__init__()
+        self.sketch = QuantileSketch(relative_accuracy, max_buckets)
+
+    def add(self, value: float):
+        super().add(value)
+        self.sketch.add(value)
+
+    def merge(self, other: 'HistogramSeries'):
+        super().merge(other)
+        self.sketch.merge(other.sketch)
+
+    def to_state(self) -> list:
+        state = super().to_state()
+        state.append(self.sketch.to_state())
+        return state
+
+    @classmethod
+    def from_state(cls, state: list) -> 'HistogramSeries':
+        series = super().from_state(state[:5])
+        series.sketch = QuantileSketch.from_state(state[5])
+        return series
+
+    def get_percentile_points(self, name: str, percentiles: Iterable[float]) -> List[DataPoint]:
+        """Returns a data point for each percentile, named after the metric and the percentile, e.g. `latency_p99`."""
+        points = []
+        if not self.count:
+            return points
+
+        for percentile in percentiles:
+            value = self.sketch.quantile(percentile / 100)
+            # NB: the sketch estimate can slightly exceed the observed range
+            value = min(self.max, max(self.min, value))
+            points.append(DataPoint(f'{name}_p{percentile:g}', value, DataPointKind.Measurement))
+        return points
+
+
+SeriesKey = Tuple[str, tuple]
+
+
+def get_series_key(name: str, properties: Optional[dict]) -> SeriesKey:
+    if not properties:
+        return name, ()
+    items = tuple(sorted(properties.items()))
+    try:
+        hash(items)
+    except TypeError:
+        # unhashable property values
+        items = tuple((key, repr(value)) for key, value in items)
+    return name, items
+
+
+OVERFLOW_VALUE = 'other'
+
+
+def get_dimensions_hash(properties: dict) -> int:
+    # NB: a frozenset doesn't require sorting properties, and its hash doesn't depend on their order
+    try:
+        return hash(frozenset(properties.items()))
+    except TypeError:
+        # unhashable property values
+        return hash(frozenset((key, repr(value)) for key, value in properties.items()))
+
+
+class CardinalityLimiter:
+    """
+    Caps the number of distinct combinations of properties (dimensions) per metric or event name, to bound
+    the number of series under free-form or adversarial values, like user ids or full urls. Once a name reaches
+    its maximum number of combinations, properties of new combinations are collapsed into an overflow bucket,
+    where every value is replaced by `other`; collapsed items are counted by name.
+    Properties can be limited from any thread.
+    Only hashes of combinations are kept in memory.
+    """
+
+    __slots__ = ('max_combinations',
+                 'max_names',
+                 'overflow_value',
+                 'collapsed',
+                 '_seen',
+                 '_lock')
+
+    def __init__(self,
+                 max_combinations: int = 1000,
+                 max_names: int = 1000,
+                 overflow_value: str = OVERFLOW_VALUE):
+        """
+        :param max_combinations: maximum number of distinct combinations of properties per name
+        :param max_names: maximum number of names whose combinations are tracked; properties of further names
+        are always collapsed
+        :param overflow_value: value replacing the values of collapsed properties
+        """
+        self.max_combinations = max_combinations
+        self.max_names = max_names
+        self.overflow_value = overflow_value
+        self.collapsed = {}  # type: Dict[str, int]
+        self._seen = {}  # type: Dict[str, set]
+        self._lock = threading.Lock()
+
+    @property
+    def collapsed_count(self) -> int:
+        with self._lock:
+            return sum(self.collapsed.values())
+
+    def limit(self, name: str, properties: Optional[dict]) -> Optional[dict]:
+        """Returns the given properties if their combination is allowed for the name, otherwise the overflow ones."""
+        if not properties:
+            return properties
+
+        dimensions_hash = get_dimensions_hash(properties)
+        with self._lock:
+            return self._limit(name, properties, dimensions_hash)
+
+    def _limit(self, name: str, properties: dict, dimensions_hash: int) -> dict:
+        try:
+            seen = self._seen[name]
+        except KeyError:
+            if len(self._seen) >= self.max_names:
+                return self._collapse(name, properties)
+            seen = self._seen[name] = set()
+
+        if dimensions_hash in seen:
+            return properties
+
+        if len(seen) >= self.max_combinations:
+            return self._collapse(name, properties)
+
+        seen.add(dimensions_hash)
+        return properties
+
+    def _collapse(self, name: str, properties: dict) -> dict:
+        self.collapsed[name] = self.collapsed.get(name, 0) + 1
+        return dict.fromkeys(properties, self.overflow_value)
+
+
+class MetricsAggregator:
+    """Accumulates metric samples by series, until they are collected to be sent."""
+
+    def __init__(self,
+                 interval: float = 60.0,
+                 percentiles: Iterable[float] = (50, 90, 95, 99),
+                 relative_accuracy: float = 0.01,
+                 max_buckets: int = 2048):
+        """
+        :param interval: number of seconds between sending of aggregated data points
+        :param percentiles: percentiles sent for histogram series
+        :param relative_accuracy: maximum relative error of percentiles of histogram series
+        :param max_buckets: maximum number of buckets of the quantile sketch of each histogram series
+        """
+        self.interval = interval
+        self.percentiles = tuple(percentiles)
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self._series = {}  # type: Dict[SeriesKey, Tuple[Optional[dict], MetricSeries]]
+        self._histograms = {}  # type: Dict[SeriesKey, Tuple[Optional[dict], HistogramSeries]]
+
+    def __len__(self):
+        return len(self._series) + len(self._histograms)
+
+    def track(self, name: str, value: float, properties: Optional[dict] = None):
+        """Adds a sample to the series of the given metric name and properties."""
+        key = get_series_key(name, properties)
+        try:
+            series = self._series[key][1]
+        except KeyError:
+            series = MetricSeries()
+            self._series[key] = (dict(properties) if properties else None, series)
+        series.add(value)
+
+    def track_histogram(self, name: str, value: float, properties: Optional[dict] = None):
+        """Adds a sample to the histogram series of the given metric name and properties."""
+        key = get_series_key(name, properties)
+        try:
+            series = self._histograms[key][1]
+        except KeyError:
+            series = HistogramSeries(self.relative_accuracy, self.max_buckets)
+            self._histograms[key] = (dict(properties) if properties else None, series)
+        series.add(value)
+
+    def merge(self, name: str, other: MetricSeries, properties: Optional[dict] = None):
+        """
+        Merges a series, for example aggregated by another worker, into the one of this aggregator with the
+        same metric name and properties; histogram series are merged with histogram series.
+        """
+        key = get_series_key(name, properties)
+        if isinstance(other, HistogramSeries):
+            store = self._histograms
+        else:
+            store = self._series
+        try:
+            series = store[key][1]
+        except KeyError:
+            if isinstance(other, HistogramSeries):
+                series = HistogramSeries(other.sketch.relative_accuracy, self.max_buckets)
+            else:
+                series = MetricSeries()
+            store[key] = (dict(properties) if properties else None, series)
+        series.merge(other)
+
+    def collect_series(self) -> List[Tuple[str, Optional[dict], MetricSeries]]:
+        """Returns the series aggregated so far, with their metric name and properties, and starts a new interval."""
+        series, self._series = self._series, {}
+        histograms, self._histograms = self._histograms, {}
+        return [(key[0], properties, data)
+                for store in (series, histograms)
+                for key, (properties, data) in store.items()]
+
+    def collect(self) -> List[Tuple[DataPoint, Optional[dict]]]:
+        """Returns aggregated data points with their properties, and starts a new interval."""
+        points = []
+        for name, properties, data in self.collect_series():
+            points.append((data.to_data_point(name), properties))
+            if isinstance(data, HistogramSeries):
+                for point in data.get_percentile_points(name, self.percentiles):
+                    points.append((point, properties))
+        return points
@@ -0,0 +1,207 @@
+"""
+This module defines samplers, which decide which telemetry items are sent and which are discarded.
+Decisions are taken on a score computed from the operation id, so the items of an operation (its request,
+traces and exceptions) are kept or discarded together; kept items carry the sampling percentage in their
+envelope sampleRate, so counts can be extrapolated by Application Insights.
+"""
+import math
+import time
+import random
+import zlib
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, Optional
+
+
+def get_sampling_score(operation_id: Optional[str]) -> float:
+    """
+    Returns a score between 0 and 100 for an operation id, the same in every process;
+    items without operation id get a random score.
+    """
+    if not operation_id:
+        return random.random() * 100
+    return zlib.crc32(operation_id.encode('utf8')) / 0x100000000 * 100
+
+
+class Sampler(ABC):
+    """Base class for samplers, deciding the percentage of items of each type that are kept."""
+
+    # whether failed items, like failed requests, are always kept
+    keep_failures = False
+
+    @abstractmethod
+    def get_percentage(self, type_name: str) -> float:
+        """Returns the percentage of items kept for a telemetry type, between 0 and 100."""
+
+    def sample(self, type_name: str, operation_id: Optional[str], failed: bool = False) -> float:
+        """
+        Decides whether an item is kept.
+
+        :param type_name: telemetry type name, e.g. RequestData
+        :param operation_id: optional id of the operation of the item
+        :param failed: whether the item describes a failure, like a failed request
+        :return: the sampling percentage if the item is kept, otherwise 0
+        """
+        percentage = self.get_percentage(type_name)
+        if failed and self.keep_failures:
+            return 100.0
+        if percentage >= 100:
+            return 100.0
+        if get_sampling_score(operation_id) < percentage:
+            return percentage
+        return 0.0
+
+
+class FixedRateSampler(Sampler):
+    """Sampler keeping a fixed percentage of items."""
+
+    __slots__ = ('percentage', 'excluded_types')
+
+    def __init__(self, percentage: float = 100.0, excluded_types=()):
+        """
+        :param percentage: percentage of items kept, between 0 and 100
+        :param excluded_types: names of telemetry types that are never sampled, e.g. ExceptionData
+        """
+        if not 0 <= percentage <= 100:
+            raise ValueError('percentage must be between 0 and 100')
+        self.percentage = float(percentage)
+        self.excluded_types = frozenset(excluded_types)
+
+    def get_percentage(self, type_name: str) -> float:
+        if type_name in self.excluded_types:
+            return 100.0
+        return self.percentage
+
+
+class SlidingWindowRate:
+    """Counts events over a sliding window of time, divided in buckets, to measure their rate per second."""
+
+    __slots__ = ('window',
+                 'bucket_duration',
+                 'total',
+                 '_counts',
+                 '_bucket',
+                 '_started')
+
+    def __init__(self, window: float = 10.0, buckets: int = 10):
+        """
+        :param window: duration of the window, in seconds
+        :param buckets: number of buckets of the window; the window slides by one bucket at a time
+        """
+        self.window = window
+        self.bucket_duration = window / buckets
+        self.total = 0
+        self._counts = [0] * buckets
+        self._bucket = None  # type: Optional[int]
+        self._started = 0.0
+
+    def add(self, now: float) -> bool:
+        """Counts an event, returning a value indicating whether the window slid to a new bucket."""
+        counts = self._counts
+        size = len(counts)
+        bucket = int(now / self.bucket_duration)
+        if bucket == self._bucket:
+            counts[bucket % size] += 1
+            self.total += 1
+            return False
+
+        if self._bucket is None or bucket - self._bucket >= size:
+            for index in range(size):
+                counts[index] = 0
+            self.total = 0
+            if self._bucket is None:
+                self._started = now
+        else:
+            for expired in range(self._bucket + 1, bucket + 1):
+                index = expired % size
+                self.total -= counts[index]
+                counts[index] = 0
+
+        self._bucket = bucket
+        counts[bucket % size] += 1
+        self.total += 1
+        return True
+
+    def get_rate(self, now: float) -> float:
+        """Returns the number of events per second in the window."""
+        # NB: the window covers the previous buckets and the elapsed part of the current one;
+        # until the window is full, the rate is measured on the time elapsed since the first event, but never
+        # on less than a bucket, so that the first events don't look like a burst
+        current = now - self._bucket * self.bucket_duration
+        covered = self.window - self.bucket_duration + current
+        elapsed = max(min(covered, now - self._started), self.bucket_duration)
+        return self.total / elapsed
+
+
+class AdaptiveSampler(Sampler):
+    """
+    Sampler adjusting the percentage of items kept for each telemetry type, to stay under a maximum number of
+    items per second: the incoming rate of each type is measured over a sliding window, and the percentage
+    is updated every time the window slides. Failed requests and exceptions are always kept, by default.
+
+    NB: percentages are rounded so that each kept item represents a whole number of items; the items of an
+    operation are kept together, unless their types are sampled at different percentages, in which case the
+    items of the types with the lowest percentage are a subset of the others.
+    Rates are measured under a lock, since items can be tracked from any thread.
+    """
+
+    keep_failures = True
+
+    def __init__(self,
+                 max_items_per_second: float = 5.0,
+                 window: float = 10.0,
+                 buckets: int = 10,
+                 min_percentage: float = 0.1,
+                 limits: Optional[Dict[str, float]] = None,
+                 excluded_types: Iterable[str] = ('ExceptionData',),
+                 keep_failures: bool = True):
+        """
+        :param max_items_per_second: maximum number of items per second kept for each telemetry type
+        :param window: duration of the window to measure incoming rates, in seconds
+        :param buckets: number of buckets of the window; percentages are updated once per bucket
+        :param min_percentage: minimum percentage of items kept
+        :param limits: optional maximum number of items per second by telemetry type name, e.g. RequestData
+        :param excluded_types: names of telemetry types that are never sampled
+        :param keep_failures: whether failed requests are always kept
+        """
+        self.max_items_per_second = max_items_per_second
+        self.window = window
+        self.buckets = buckets
+        self.min_percentage = min_percentage
+        self.limits = dict(limits or {})
+        self.excluded_types = frozenset(excluded_types)
+        self.keep_failures = keep_failures
+        self._rates = {}  # type: Dict[str, SlidingWindowRate]
+        self._percentages = {}  # type: Dict[str, float]
+        self._lock = threading.Lock()
+
+    @property
+    def percentages(self) -> Dict[str, float]:
+        """Returns the current percentage of items kept, by telemetry type name."""
+        with self._lock:
+            return dict(self._percentages)
+
+    def get_percentage(self, type_name: str) -> float:
+        if type_name in self.excluded_types:
+            return 100.0
+
+        now = time.monotonic()
+        with self._lock:
+            try:
+                rate = self._rates[type_name]
+            except KeyError:
+                rate = self._rates[type_name] = SlidingWindowRate(self.window, self.buckets)
+                self._percentages[type_name] = 100.0
+
+            if rate.add(now):
+                self._percentages[type_name] = self._get_target_percentage(type_name, rate.get_rate(now))
+            return self._percentages[type_name]
+
+    def _get_target_percentage(self, type_name: str, rate: float) -> float:
+        limit = self.limits.get(type_name, self.max_items_per_second)
+        if rate <= limit:
+            return 100.0
+
+        percentage = max(self.min_percentage, limit / rate * 100)
+        # NB: rounded down to 100 / N, so each kept item represents N items
+        return 100 / math.ceil(100 / percentage)
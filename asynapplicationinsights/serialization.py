@@ -0,0 +1,233 @@
+"""
+This module defines a fast serializer for telemetry envelopes: known entities are converted directly to
+structures of JSON native types, without passing through the to_dict methods and the dispatch of
+FriendlyEncoder.default for each nested object. If orjson is installed, it is used to produce JSON
+(pip install asynapplicationinsights[fast]).
+Static tags shared by envelopes are serialized once, and their JSON fragment is reused for each envelope.
+"""
+import json
+from uuid import UUID
+from datetime import time, date, datetime
+from typing import Iterable, Iterator
+from .entities import (Envelope,
+                       EnvelopeTags,
+                       StaticTags,
+                       EventData,
+                       TraceData,
+                       MetricData,
+                       DataPoint,
+                       RequestData,
+                       ExceptionData,
+                       ExceptionDetails)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def default(obj):
+    """Handles objects that are not JSON serializable by default, like FriendlyEncoder."""
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    if isinstance(obj, time):
+        return obj.strftime('%H:%M:%S')
+    if isinstance(obj, datetime):
+        return obj.isoformat() + 'Z'
+    if isinstance(obj, date):
+        return obj.strftime('%Y-%m-%d')
+    if isinstance(obj, bytes):
+        return obj.decode('utf8')
+    if isinstance(obj, UUID):
+        return str(obj)
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    _orjson_options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj) -> bytes:
+        """Serializes an object to JSON, encoded in UTF-8."""
+        return orjson.dumps(obj, default=default, option=_orjson_options)
+else:  # pragma: no cover
+    _encoder = json.JSONEncoder(ensure_ascii=False, default=default)
+
+    def dumps(obj) -> bytes:
+        """Serializes an object to JSON, encoded in UTF-8."""
+        return _encoder.encode(obj).encode('utf8')
+
+
+def _event_data(data: EventData) -> dict:
+    return {
+        'name': data.name,
+        'properties': data.properties,
+        'measurements': data.measurements,
+        'ver': 2
+    }
+
+
+def _trace_data(data: TraceData) -> dict:
+    return {
+        'message': data.message,
+        'properties': data.properties,
+        'severityLevel': data.severity,
+        'ver': 2
+    }
+
+
+def _data_point(point: DataPoint) -> dict:
+    item = {
+        'name': point.name,
+        'value': point.value,
+        'kind': int(point.kind)
+    }
+    if point.count is not None:
+        item['count'] = point.count
+    if point.min is not None:
+        item['min'] = point.min
+    if point.max is not None:
+        item['max'] = point.max
+    if point.std_dev is not None:
+        item['stdDev'] = point.std_dev
+    return item
+
+
+def _metric_data(data: MetricData) -> dict:
+    return {
+        'metrics': [_data_point(data.item)],
+        'properties': data.properties,
+        'ver': 2
+    }
+
+
+def _exception_details(details: ExceptionDetails) -> dict:
+    return {
+        'id': details.id,
+        'outerId': details.outer_id,
+        'typeName': details.type_name,
+        'message': details.message,
+        'hasFullStack': details.has_full_stack,
+        'parsedStack': [{
+            'level': frame.level,
+            'method': frame.method,
+            'assembly': frame.module,
+            'fileName': frame.file_name,
+            'line': frame.line
+        } for frame in details.stack]
+    }
+
+
+def _exception_data(data: ExceptionData) -> dict:
+    item = {
+        'handledAt': 'UserCode',
+        'exceptions': [_exception_details(details) for details in data.exceptions]
+    }
+    if data.properties:
+        item['properties'] = data.properties
+    if data.measurements:
+        item['measurements'] = data.measurements
+    item['ver'] = 2
+    return item
+
+
+def _request_data(data: RequestData) -> dict:
+    item = {
+        'id': data.id,
+        'name': data.name,
+        'startTime': data.start_time.isoformat() + 'Z',
+        'duration': data.format_duration(data.duration),
+        'responseCode': str(data.response_code),
+        'success': data.success,
+        'httpMethod': data.http_method,
+        'url': data.url
+    }
+    if data.properties:
+        item['properties'] = data.properties
+    if data.measurements:
+        item['measurements'] = data.measurements
+    item['ver'] = 2
+    return item
+
+
+def _generic_data(data) -> dict:
+    item = data.to_dict()
+    item['ver'] = 2
+    return item
+
+
+_data_serializers = {
+    EventData: _event_data,
+    TraceData: _trace_data,
+    MetricData: _metric_data,
+    ExceptionData: _exception_data,
+    RequestData: _request_data
+}
+
+
+def _envelope_body(envelope: Envelope) -> dict:
+    data = envelope.data
+    return {
+        'ver': 1,
+        'name': envelope.name,
+        'time': envelope.time.isoformat() + 'Z',
+        'sampleRate': envelope.sample_rate,
+        'iKey': envelope.instrumentation_key,
+        'data': {
+            'baseType': envelope.data_type_name,
+            'baseData': _data_serializers.get(type(data), _generic_data)(data)
+        }
+    }
+
+
+def envelope_to_dict(envelope: Envelope) -> dict:
+    """Returns a dictionary of JSON native types, equivalent to the one returned by Envelope.to_dict."""
+    item = _envelope_body(envelope)
+    tags = envelope.tags
+    item['tags'] = tags.to_dict() if type(tags) is EnvelopeTags else tags
+    return item
+
+
+def get_fragment(tags: StaticTags) -> bytes:
+    """Returns the members of a JSON object of static tags, without braces; computed once and cached."""
+    fragment = tags.fragment
+    if fragment is None:
+        fragment = tags.fragment = dumps(tags.values)[1:-1]
+    return fragment
+
+
+def _serialize_tags(tags) -> bytes:
+    if type(tags) is not EnvelopeTags:
+        return dumps(tags)
+
+    fragment = get_fragment(tags.static)
+    if not tags.extra:
+        return b'{' + fragment + b'}'
+
+    extra = dumps(tags.extra)[1:-1]
+    if not fragment:
+        return b'{' + extra + b'}'
+    return b'{' + fragment + b',' + extra + b'}'
+
+
+def serialize_envelope(envelope: Envelope) -> bytes:
+    """Serializes a single envelope to JSON, encoded in UTF-8; envelopes already serialized are returned as-is."""
+    if type(envelope) is not Envelope:
+        if type(envelope) is bytes:
+            # NB: envelopes serialized elsewhere, for example forwarded by another process
+            return envelope
+        return dumps(envelope)
+
+    # NB: tags are appended as last member of the envelope object, to reuse the fragment of static tags
+    body = dumps(_envelope_body(envelope))
+    return body[:-1] + b',"tags":' + _serialize_tags(envelope.tags) + b'}'
+
+
+def serialize_envelopes(envelopes: Iterable[Envelope]) -> bytes:
+    """Serializes envelopes to a JSON array, encoded in UTF-8."""
+    return b'[' + b','.join([serialize_envelope(envelope) for envelope in envelopes]) + b']'
+
+
+def iter_ndjson_envelopes(envelopes: Iterable[Envelope]) -> Iterator[bytes]:
+    """Serializes envelopes one by one, yielding each as a line of newline delimited JSON, encoded in UTF-8."""
+    for envelope in envelopes:
+        yield serialize_envelope(envelope) + b'\n'
@@ -1,27 +1,39 @@
 import sys
 import uuid
 import asyncio
+import logging
 from datetime import datetime
-from typing import Optional, Union
+from typing import List, Optional, Tuple, Union
 from .channel.abstractions import TelemetryChannel
+from .context import get_operation_context
 from .entities import (Application,
                        LoggingDevice,
                        Context,
+                       StaticTags,
+                       EnvelopeTags,
                        Operation,
                        Session,
                        User,
                        Envelope,
                        EventData,
                        TraceData,
+                       TraceSeverity,
                        MetricData,
                        DataPoint,
                        DataPointKind,
                        RequestData,
                        ExceptionData,
                        ExceptionDetails)
+from .exceptions import InvalidOperation
+from .metrics import CardinalityLimiter, MetricSeries, MetricsAggregator
+from .sampling import Sampler
+from .throttling import ExceptionThrottle, get_exception_fingerprint
 from .utils import require_params
 
 
+logger = logging.getLogger(__name__)
+
+
 COMMON_TAGS = {
     'ai.internal.sdkVersion': 'asynpy3:0.0.1'
 }
@@ -31,18 +43,51 @@ class AsyncTelemetryClient:
     """Azure Application Insights client using asyncio"""
     __slots__ = ('instrumentation_key',
                  '_context',
-                 '_channel')
+                 '_channel',
+                 '_static_tags',
+                 '_metrics',
+                 '_metrics_task',
+                 '_limiter',
+                 '_sampler',
+                 '_exceptions',
+                 '_exceptions_task')
 
     def __init__(self,
                  instrumentation_key: str,
                  channel: TelemetryChannel,
                  application: Optional[Application]=None,
-                 device: Optional[LoggingDevice]=None):
+                 device: Optional[LoggingDevice]=None,
+                 metrics: Optional[MetricsAggregator]=None,
+                 limiter: Optional[CardinalityLimiter]=None,
+                 sampler: Optional[Sampler]=None,
+                 exceptions: Optional[ExceptionThrottle]=None):
+        """
+        :param instrumentation_key: application insights instrumentation key
+        :param channel: channel used to send telemetry
+        :param application: optional metadata about the application
+        :param device: optional metadata about the logging device; if not specified one is created with platform
+        information
+        :param metrics: optional aggregator, to pre-aggregate metric measurements in process and send a single
+        aggregated data point per metric name and properties per interval
+        :param limiter: optional cardinality limiter, capping the distinct combinations of properties of
+        metrics and events per name
+        :param sampler: optional sampler, deciding which events, traces, exceptions and requests are sent;
+        metrics are never sampled
+        :param exceptions: optional throttle, to send in full only the first exceptions of each fingerprint per
+        window, and a periodic summary of the others
+        """
         require_params(instrumentation_key=instrumentation_key,
                        channel=channel)
         self.instrumentation_key = instrumentation_key
         self._context = Context(application, device)
         self._channel = channel
+        self._static_tags = StaticTags(self._get_static_tags())
+        self._metrics = metrics
+        self._metrics_task = None
+        self._limiter = limiter
+        self._sampler = sampler
+        self._exceptions = exceptions
+        self._exceptions_task = None
 
     def handle_unhandled_exceptions(self, loop=None):
         """
@@ -62,8 +107,13 @@ class AsyncTelemetryClient:
             await self.flush()
 
         def local_excepthook(type, value, traceback):
-            #
-            loop.run_until_complete(log_exception_async(type, value, traceback))
+            if loop.is_running():
+                # NB: the loop cannot be run again, nor waited from its own thread: the exception is handed off
+                # to the loop, and sent by the channel sender or at dispose
+                self.track_exception_nowait(type, value, traceback)
+                asyncio.run_coroutine_threadsafe(self.flush(), loop)
+            elif not loop.is_closed():
+                loop.run_until_complete(log_exception_async(type, value, traceback))
 
             # call the original method
             current_excepthook(type, value, traceback)
@@ -72,10 +122,35 @@ class AsyncTelemetryClient:
         pass
 
     async def push(self, data):
-        await self._channel.put(data)
+        channel = self._channel
+        if channel.is_owner_thread():
+            await channel.put(data)
+        else:
+            channel.put_threadsafe(data)
+
+    def push_nowait(self, data):
+        channel = self._channel
+        if channel.is_owner_thread():
+            channel.put_nowait(data)
+        else:
+            channel.put_threadsafe(data)
+
+    def _call_in_loop(self, callback, *args):
+        # NB: state owned by the loop of the channel, like aggregated metrics, is modified only in its thread
+        channel = self._channel
+        if channel.is_owner_thread():
+            callback(*args)
+        else:
+            channel.loop.call_soon_threadsafe(callback, *args)
 
     async def flush(self):
-        await self._channel.flush()
+        channel = self._channel
+        if channel.is_owner_thread():
+            await channel.flush()
+        else:
+            # flushing from another thread or loop: the flush runs in the loop owning the channel,
+            # after the items handed off so far
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(channel.flush(), channel.loop))
 
     async def __aenter__(self):
         return self
@@ -86,26 +161,52 @@ class AsyncTelemetryClient:
                         exc_tb):
         await self.dispose()
 
-    def get_tags(self,
-                 operation: Optional[Operation]=None,
-                 session: Optional[Session]=None,
-                 user: Optional[User]=None
-                 ) -> dict:
+    def sample(self, type_name: str, operation_id: Optional[str], failed: bool=False) -> float:
         """
-        Returns meta tags to be included in any log.
-        ref.
-        https://github.com/Microsoft/ApplicationInsights-Home/blob/master/EndpointSpecs/Schemas/Docs/ContextTagKeys.md
+        Decides whether an item is kept, before creating it, without the ambient operation context.
 
-        :param operation: optional operation data to log.
-        :param session: optional session data to log.
-        :param user: optional user data to log.
-        :return:
+        :param type_name: telemetry type name, e.g. RequestData
+        :param operation_id: optional id of the operation of the item
+        :param failed: whether the item describes a failure, like a failed request
+        :return: the sampling percentage if the item is kept, otherwise 0; always 100 without a sampler
         """
+        if self._sampler is None:
+            return 100.0
+        return self._sampler.sample(type_name, operation_id, failed)
+
+    def _sample(self,
+                type_name: str,
+                operation: Optional[Operation],
+                default_id: Optional[str]=None,
+                failed: bool=False) -> float:
+        # NB: called before creating entities, so discarded items cost as little as possible
+        if self._sampler is None:
+            return 100.0
+        if operation is None:
+            context = get_operation_context()
+            if context is not None and context.operation is not None:
+                operation = context.operation
+        return self._sampler.sample(type_name, operation.id if operation else default_id, failed)
+
+    def _get_static_tags(self) -> dict:
         tags = self._context.device.to_dict()
 
         if self._context.application:
             tags.update(self._context.application.to_dict())
 
+        tags.update(COMMON_TAGS)
+        return tags
+
+    @staticmethod
+    def _get_extra_tags(operation: Optional[Operation]=None,
+                        session: Optional[Session]=None,
+                        user: Optional[User]=None
+                        ) -> Optional[dict]:
+        if not operation and not session and not user:
+            return None
+
+        tags = {}
+
         if operation:
             tags.update(operation.to_dict())
 
@@ -115,9 +216,50 @@ class AsyncTelemetryClient:
         if session:
             tags.update(session.to_dict())
 
-        tags.update(COMMON_TAGS)
         return tags
 
+    def get_tags(self,
+                 operation: Optional[Operation]=None,
+                 session: Optional[Session]=None,
+                 user: Optional[User]=None
+                 ) -> dict:
+        """
+        Returns meta tags to be included in any log.
+        ref.
+        https://github.com/Microsoft/ApplicationInsights-Home/blob/master/EndpointSpecs/Schemas/Docs/ContextTagKeys.md
+
+        :param operation: optional operation data to log.
+        :param session: optional session data to log.
+        :param user: optional user data to log.
+        :return:
+        """
+        return self.get_envelope_tags(operation, session, user).to_dict()
+
+    def get_envelope_tags(self,
+                          operation: Optional[Operation]=None,
+                          session: Optional[Session]=None,
+                          user: Optional[User]=None
+                          ) -> EnvelopeTags:
+        """
+        Returns meta tags to be included in a single envelope, sharing the static tags of this client
+        (device, application and sdk information) without copying them.
+        Tags of the ambient operation context, if any, are included; those given explicitly take precedence.
+
+        :param operation: optional operation data to log.
+        :param session: optional session data to log.
+        :param user: optional user data to log.
+        :return:
+        """
+        extra = self._get_extra_tags(operation, session, user)
+        context = get_operation_context()
+        if context is not None:
+            if extra is None:
+                # NB: tags of the ambient context are computed once and shared by all its envelopes
+                extra = context.tags
+            else:
+                extra = {**context.tags, **extra}
+        return EnvelopeTags(self._static_tags, extra)
+
     async def track_event(self,
                           name,
                           properties=None,
@@ -137,11 +279,43 @@ class AsyncTelemetryClient:
         :param user: optional user tags to log
         :return:
         """
-        data = Envelope(self.instrumentation_key,
+        sample_rate = self._sample(EventData.data_type_name, operation)
+        if sample_rate:
+            await self.push(self.create_event(name, properties, measurements,
+                                              operation=operation, session=session, user=user,
+                                              sample_rate=sample_rate))
+
+    def track_event_nowait(self,
+                           name,
+                           properties=None,
+                           measurements=None,
+                           *,
+                           operation: Optional[Operation] = None,
+                           session: Optional[Session] = None,
+                           user: Optional[User] = None):
+        """Logs a single event without waiting, deferring its sending; refer to track_event."""
+        sample_rate = self._sample(EventData.data_type_name, operation)
+        if sample_rate:
+            self.push_nowait(self.create_event(name, properties, measurements,
+                                               operation=operation, session=session, user=user,
+                                               sample_rate=sample_rate))
+
+    def create_event(self,
+                     name,
+                     properties=None,
+                     measurements=None,
+                     *,
+                     operation: Optional[Operation] = None,
+                     session: Optional[Session] = None,
+                     user: Optional[User] = None,
+                     sample_rate: float = 100.0) -> Envelope:
+        """Creates the envelope of a single event; refer to track_event."""
+        if self._limiter is not None:
+            properties = self._limiter.limit(name, properties)
+        return Envelope(self.instrumentation_key,
                         EventData(name, properties, measurements),
-                        self.get_tags(operation, session, user))
-
-        await self.push(data)
+                        self.get_envelope_tags(operation, session, user),
+                        sample_rate)
 
     async def track_exception(self,
                               type=None,
@@ -168,6 +342,84 @@ class AsyncTelemetryClient:
         :param user: optional user tags to log
         :param skip_frames: optional number of stack frames to be skipped from log
         """
+        sample_rate = self._sample(ExceptionData.data_type_name, operation)
+        if sample_rate and self._throttle_exception(type, tb):
+            await self.push(self.create_exception(type, value, tb, properties, measurements,
+                                                  operation=operation, session=session, user=user,
+                                                  skip_frames=skip_frames, sample_rate=sample_rate))
+
+    def track_exception_nowait(self,
+                               type=None,
+                               value=None,
+                               tb=None,
+                               properties=None,
+                               measurements=None,
+                               *,
+                               operation: Optional[Operation] = None,
+                               session: Optional[Session] = None,
+                               user: Optional[User] = None,
+                               skip_frames: Optional[int] = None):
+        """Tracks a single exception without waiting, deferring its sending; refer to track_exception."""
+        sample_rate = self._sample(ExceptionData.data_type_name, operation)
+        if sample_rate and self._throttle_exception(type, tb):
+            self.push_nowait(self.create_exception(type, value, tb, properties, measurements,
+                                                   operation=operation, session=session, user=user,
+                                                   skip_frames=skip_frames, sample_rate=sample_rate))
+
+    def _throttle_exception(self, type, tb) -> bool:
+        # NB: returns a value indicating whether the exception is sent in full
+        if self._exceptions is None:
+            return True
+
+        if not type or not tb:
+            type, _, tb = sys.exc_info()
+            if not type or not tb:
+                return True
+
+        if self._exceptions.should_send(get_exception_fingerprint(type, tb)):
+            return True
+
+        if self._exceptions_task is None:
+            self._call_in_loop(self._ensure_exceptions_summary)
+        return False
+
+    def _ensure_exceptions_summary(self):
+        if self._exceptions_task is None:
+            self._exceptions_task = asyncio.ensure_future(self._run_exceptions_summary())
+
+    async def _run_exceptions_summary(self):
+        while True:
+            await asyncio.sleep(self._exceptions.window)
+            try:
+                await self.flush_exceptions_summary()
+            except Exception:
+                logger.exception('Failed to send the summary of suppressed exceptions')
+
+    async def flush_exceptions_summary(self):
+        """Sends a trace for each fingerprint of exceptions that were suppressed, with their count."""
+        if self._exceptions is None:
+            return
+
+        for summary in self._exceptions.collect():
+            await self.push(Envelope(self.instrumentation_key,
+                                     TraceData(f'Suppressed {summary.count} occurrences of {summary.type_name}',
+                                               summary.to_properties(),
+                                               TraceSeverity.warning),
+                                     EnvelopeTags(self._static_tags)))
+
+    def create_exception(self,
+                         type=None,
+                         value=None,
+                         tb=None,
+                         properties=None,
+                         measurements=None,
+                         *,
+                         operation: Optional[Operation] = None,
+                         session: Optional[Session] = None,
+                         user: Optional[User] = None,
+                         skip_frames: Optional[int] = None,
+                         sample_rate: float = 100.0) -> Envelope:
+        """Creates the envelope of a single exception; refer to track_exception."""
         if not type or not value or not tb:
             type, value, tb = sys.exc_info()
 
@@ -193,13 +445,12 @@ class AsyncTelemetryClient:
         else:
             properties = text_portions
 
-        data = Envelope(self.instrumentation_key,
+        return Envelope(self.instrumentation_key,
                         ExceptionData([details],
                                       properties,
                                       measurements),
-                        self.get_tags(operation, session, user))
-
-        await self.push(data)
+                        self.get_envelope_tags(operation, session, user),
+                        sample_rate)
 
     async def track_trace(self,
                           name,
@@ -219,11 +470,41 @@ class AsyncTelemetryClient:
         :param session: optional session tags to log
         :param user: optional user tags to log
         """
-        data = Envelope(self.instrumentation_key,
+        sample_rate = self._sample(TraceData.data_type_name, operation)
+        if sample_rate:
+            await self.push(self.create_trace(name, properties, severity,
+                                              operation=operation, session=session, user=user,
+                                              sample_rate=sample_rate))
+
+    def track_trace_nowait(self,
+                           name,
+                           properties=None,
+                           severity: int=1,
+                           *,
+                           operation: Optional[Operation] = None,
+                           session: Optional[Session] = None,
+                           user: Optional[User] = None):
+        """Logs a single trace without waiting, deferring its sending; refer to track_trace."""
+        sample_rate = self._sample(TraceData.data_type_name, operation)
+        if sample_rate:
+            self.push_nowait(self.create_trace(name, properties, severity,
+                                               operation=operation, session=session, user=user,
+                                               sample_rate=sample_rate))
+
+    def create_trace(self,
+                     name,
+                     properties=None,
+                     severity: int=1,
+                     *,
+                     operation: Optional[Operation] = None,
+                     session: Optional[Session] = None,
+                     user: Optional[User] = None,
+                     sample_rate: float = 100.0) -> Envelope:
+        """Creates the envelope of a single trace; refer to track_trace."""
+        return Envelope(self.instrumentation_key,
                         TraceData(name, properties, severity),
-                        self.get_tags(operation, session, user))
-
-        await self.push(data)
+                        self.get_envelope_tags(operation, session, user),
+                        sample_rate)
 
     async def track_metric(self,
                            name: str,
@@ -255,13 +536,149 @@ class AsyncTelemetryClient:
         :param user: optional user tags to log
         :return:
         """
+        if self._aggregate_metric(name, value, kind, count, properties):
+            return
+
+        await self.push(self.create_metric(name, value, kind, count, min, max, std_dev, properties,
+                                           operation=operation, session=session, user=user))
+
+    def track_metric_nowait(self,
+                            name: str,
+                            value: float,
+                            kind: DataPointKind = None,
+                            count: Optional[int] = None,
+                            min: Optional[float] = None,
+                            max: Optional[float] = None,
+                            std_dev: Optional[float] = None,
+                            properties: Optional[dict] = None,
+                            *,
+                            operation: Optional[Operation] = None,
+                            session: Optional[Session] = None,
+                            user: Optional[User] = None):
+        """Logs a single metric without waiting, deferring its sending; refer to track_metric."""
+        if self._aggregate_metric(name, value, kind, count, properties):
+            return
+
+        self.push_nowait(self.create_metric(name, value, kind, count, min, max, std_dev, properties,
+                                            operation=operation, session=session, user=user))
+
+    def _aggregate_metric(self,
+                          name: str,
+                          value: float,
+                          kind: Optional[DataPointKind],
+                          count: Optional[int],
+                          properties: Optional[dict]) -> bool:
+        # NB: only single measurements are pre-aggregated; operation, session and user tags are not kept,
+        # since samples of many operations are merged in the same data point
+        if self._metrics is None or count is not None or kind is DataPointKind.Aggregation:
+            return False
+
+        if self._limiter is not None:
+            properties = self._limiter.limit(name, properties)
+        self._call_in_loop(self._track_aggregated, self._metrics.track, name, value, properties)
+        return True
+
+    def _track_aggregated(self, track, name: str, value: float, properties: Optional[dict]):
+        track(name, value, properties)
+        self._ensure_metrics_sender()
+
+    async def track_histogram(self,
+                              name: str,
+                              value: float,
+                              properties: Optional[dict]=None):
+        """
+        Records a sample of a metric whose distribution is of interest, like a duration: samples are
+        pre-aggregated in process and sent periodically as an aggregated data point, plus one data point per
+        configured percentile, named after the metric, e.g. `latency_p99`.
+        Requires a metrics aggregator.
+
+        :param name: metric name
+        :param value: sample value
+        :param properties: optional properties
+        """
+        self._aggregate_histogram(name, value, properties)
+
+    def track_histogram_nowait(self,
+                               name: str,
+                               value: float,
+                               properties: Optional[dict]=None):
+        """Records a sample of a histogram metric without waiting; refer to track_histogram."""
+        self._aggregate_histogram(name, value, properties)
+
+    def _aggregate_histogram(self, name: str, value: float, properties: Optional[dict]):
+        if self._metrics is None:
+            raise InvalidOperation('Histograms require a metrics aggregator')
+
+        if self._limiter is not None:
+            properties = self._limiter.limit(name, properties)
+        self._call_in_loop(self._track_aggregated, self._metrics.track_histogram, name, value, properties)
+
+    def _ensure_metrics_sender(self):
+        if self._metrics_task is None:
+            self._metrics_task = asyncio.ensure_future(self._run_metrics_sender())
+
+    async def _run_metrics_sender(self):
+        while True:
+            await asyncio.sleep(self._metrics.interval)
+            try:
+                await self.flush_metrics()
+            except Exception:
+                logger.exception('Failed to send aggregated metrics')
+
+    async def flush_metrics(self):
+        """
+        Sends the data points aggregated so far, if metrics are pre-aggregated; if the channel forwards
+        telemetry to a collector, aggregated series are forwarded as they are, to be merged with those of
+        other processes.
+        """
+        if self._metrics is None:
+            return
+
+        forward_metrics = getattr(self._channel, 'forward_metrics', None)
+        if forward_metrics is not None:
+            await forward_metrics(self._metrics.collect_series())
+            return
+
+        for item, properties in self._metrics.collect():
+            await self.push(Envelope(self.instrumentation_key,
+                                     MetricData(item, properties),
+                                     EnvelopeTags(self._static_tags)))
+
+    def merge_metrics(self, series: List[Tuple[str, Optional[dict], MetricSeries]]):
+        """
+        Merges metric series aggregated elsewhere, for example by other processes, into the ones of this client,
+        to be sent at the next interval. Requires a metrics aggregator.
+
+        :param series: list of metric names, properties and series
+        """
+        if self._metrics is None:
+            raise InvalidOperation('Merging metrics requires a metrics aggregator')
+
+        for name, properties, data in series:
+            self._metrics.merge(name, data, properties)
+        self._ensure_metrics_sender()
+
+    def create_metric(self,
+                      name: str,
+                      value: float,
+                      kind: DataPointKind = None,
+                      count: Optional[int] = None,
+                      min: Optional[float] = None,
+                      max: Optional[float] = None,
+                      std_dev: Optional[float] = None,
+                      properties: Optional[dict] = None,
+                      *,
+                      operation: Optional[Operation] = None,
+                      session: Optional[Session] = None,
+                      user: Optional[User] = None) -> Envelope:
+        """Creates the envelope of a single metric; refer to track_metric."""
+        if self._limiter is not None:
+            properties = self._limiter.limit(name, properties)
         item = DataPoint(name, value, kind, count, min, max, std_dev)
 
-        data = Envelope(self.instrumentation_key,
+        return Envelope(self.instrumentation_key,
                         MetricData(item, properties),
-                        self.get_tags(operation, session, user))
-
-        await self.push(data)
+                        self.get_envelope_tags(operation, session, user))
 
     async def track_request(self,
                             _id: str,
@@ -294,17 +711,64 @@ class AsyncTelemetryClient:
         :param measurements: set of custom measurements to store
         :return:
         """
+        sample_rate = self._sample(RequestData.data_type_name, operation, _id, not success)
+        if sample_rate:
+            await self.push(self.create_request(_id, name, url, success, start_time, duration, response_code,
+                                                http_method, properties, measurements,
+                                                operation=operation, session=session, user=user,
+                                                sample_rate=sample_rate))
+
+    def track_request_nowait(self,
+                             _id: str,
+                             name: str,
+                             url: str,
+                             success: bool,
+                             start_time: datetime=None,
+                             duration:Optional[int]=None,
+                             response_code:Union[str, int]=None,
+                             http_method: str=None,
+                             properties: Optional[dict]=None,
+                             measurements: Optional[dict]=None,
+                             *,
+                             operation: Optional[Operation] = None,
+                             session: Optional[Session] = None,
+                             user: Optional[User] = None):
+        """Logs a single HTTP request without waiting, deferring its sending; refer to track_request."""
+        sample_rate = self._sample(RequestData.data_type_name, operation, _id, not success)
+        if sample_rate:
+            self.push_nowait(self.create_request(_id, name, url, success, start_time, duration, response_code,
+                                                 http_method, properties, measurements,
+                                                 operation=operation, session=session, user=user,
+                                                 sample_rate=sample_rate))
+
+    def create_request(self,
+                       _id: str,
+                       name: str,
+                       url: str,
+                       success: bool,
+                       start_time: datetime=None,
+                       duration:Optional[int]=None,
+                       response_code:Union[str, int]=None,
+                       http_method: str=None,
+                       properties: Optional[dict]=None,
+                       measurements: Optional[dict]=None,
+                       *,
+                       operation: Optional[Operation] = None,
+                       session: Optional[Session] = None,
+                       user: Optional[User] = None,
+                       sample_rate: float = 100.0) -> Envelope:
+        """Creates the envelope of a single HTTP request; refer to track_request."""
         if not start_time:
             start_time = datetime.utcnow()
 
         request_id = _id or str(uuid.uuid4())
 
-        if not operation:
+        if not operation and get_operation_context() is None:
             # in this case, operation tags can be configured automatically if not specified
-            # in caller method
+            # in caller method, nor by the ambient operation context
             operation = Operation(request_id, f'{http_method} {name}')
 
-        data = Envelope(self.instrumentation_key,
+        return Envelope(self.instrumentation_key,
                         RequestData(request_id,
                                     name,
                                     http_method,
@@ -315,13 +779,26 @@ class AsyncTelemetryClient:
                                     duration or 0,
                                     properties,
                                     measurements),
-                        self.get_tags(operation, session, user))
-
-        await self.push(data)
+                        self.get_envelope_tags(operation, session, user),
+                        sample_rate)
 
     async def dispose(self):
+        tasks = [task for task in (self._metrics_task, self._exceptions_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        self._metrics_task = None
+        self._exceptions_task = None
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
         try:
+            await self.flush_metrics()
+            await self.flush_exceptions_summary()
             await self._channel.flush()
         finally:
-            await self._channel.dispose()
+            # NB: channels might not stop their background tasks when disposed
+            try:
+                await self._channel.stop()
+            finally:
+                await self._channel.dispose()
         return self
@@ -0,0 +1,150 @@
+import asyncio
+import unittest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from .test_channel import InMemoryTelemetryChannel, run
+from ..aiohttp import use_application_insights
+from ..channel.retry import RetryScheduler
+from ..sampling import FixedRateSampler
+from ..serialization import envelope_to_dict
+
+
+async def hello(request):
+    request.app.ai_client.track_trace_nowait('Hello')
+    return web.Response(text='Hello')
+
+
+async def fail(request):
+    raise ValueError('Example')
+
+
+async def not_found(request):
+    raise web.HTTPNotFound()
+
+
+async def item(request):
+    return web.Response(text=request.match_info['id'])
+
+
+def create_app(**options):
+    app = web.Application()
+    app.router.add_get('/hello', hello)
+    app.router.add_get('/fail', fail)
+    app.router.add_get('/missing', not_found)
+    app.router.add_get('/items/{id}', item)
+    channel = InMemoryTelemetryChannel(flush_interval=None)
+    use_application_insights(app, '<KEY>', channel=channel, **options)
+    return app, channel
+
+
+async def get_all(app, *paths):
+    async with TestClient(TestServer(app)) as client:
+        for path in paths:
+            response = await client.get(path)
+            await response.read()
+
+
+def get_items(channel):
+    return [envelope_to_dict(item) for item in channel.sent_items]
+
+
+class TestMiddleware(unittest.TestCase):
+
+    def test_middleware(self):
+        async def go():
+            app, channel = create_app()
+            await get_all(app, '/hello', '/fail', '/missing')
+
+            items = get_items(channel)
+            requests = [item['data']['baseData'] for item in items if item['data']['baseType'] == 'RequestData']
+            self.assertEqual([('/hello', '200', True), ('/fail', '500', False), ('/missing', '404', True)],
+                             [(data['name'], data['responseCode'], data['success']) for data in requests])
+
+        run(go())
+
+    def test_request_name_by_route(self):
+        async def go():
+            for fast_path in (False, True):
+                app, channel = create_app(fast_path=fast_path)
+                await get_all(app, '/items/1', '/items/2', '/unknown')
+
+                items = [item for item in get_items(channel) if item['data']['baseType'] == 'RequestData']
+                self.assertEqual(['/items/{id}', '/items/{id}', '/unknown'],
+                                 [item['data']['baseData']['name'] for item in items])
+                self.assertEqual('GET /items/{id}', items[0]['tags']['ai.operation.name'])
+                self.assertEqual('http', items[0]['data']['baseData']['url'][:4])
+
+        run(go())
+
+    def test_fast_path(self):
+        async def go():
+            app, channel = create_app(fast_path=True)
+            await get_all(app, '/hello', '/fail', '/missing')
+
+            items = get_items(channel)
+            by_type = {}
+            for item in items:
+                by_type.setdefault(item['data']['baseType'], []).append(item)
+
+            requests = {item['data']['baseData']['name']: item for item in by_type['RequestData']}
+            self.assertEqual({'/hello', '/fail', '/missing'}, set(requests))
+            self.assertEqual('500', requests['/fail']['data']['baseData']['responseCode'])
+            self.assertEqual('GET /hello', requests['/hello']['tags']['ai.operation.name'])
+
+            # items tracked by handlers are correlated with their request
+            trace, = by_type['MessageData']
+            exception, = by_type['ExceptionData']
+            self.assertEqual(requests['/hello']['tags']['ai.operation.id'], trace['tags']['ai.operation.id'])
+            self.assertEqual(requests['/fail']['tags']['ai.operation.id'], exception['tags']['ai.operation.id'])
+
+        run(go())
+
+    def test_fast_path_sampled_out(self):
+        async def go():
+            app, channel = create_app(fast_path=True, sampler=FixedRateSampler(0, ['ExceptionData']))
+            await get_all(app, '/hello', '/hello', '/fail')
+
+            # traces of discarded requests are discarded too
+            self.assertEqual(['ExceptionData'], [item.data_type_name for item in channel.sent_items])
+
+        run(go())
+
+    def test_request_metrics(self):
+        async def go():
+            for fast_path in (False, True):
+                app, channel = create_app(fast_path=fast_path,
+                                          request_metrics=True,
+                                          sampler=FixedRateSampler(0, ['ExceptionData']))
+                await get_all(app, '/items/1', '/items/2', '/items/3', '/fail', '/unknown')
+
+                items = get_items(channel)
+                self.assertNotIn('RequestData', {item['data']['baseType'] for item in items})
+
+                # every request is counted, even if sampled out
+                counts = {(item['data']['baseData']['properties']['Request name'],
+                           item['data']['baseData']['properties']['Response code'],
+                           item['data']['baseData']['properties']['Success']):
+                          item['data']['baseData']['metrics'][0]['count']
+                          for item in items
+                          if item['data']['baseType'] == 'MetricData'
+                          and item['data']['baseData']['metrics'][0]['name'] == 'Request duration'}
+                self.assertEqual({('GET /items/{id}', '200', 'True'): 3,
+                                  ('GET /fail', '500', 'False'): 1,
+                                  ('GET (unmatched)', '404', 'True'): 1}, counts)
+
+        run(go())
+
+    def test_default_channel_retries_failures(self):
+        async def go():
+            retry = RetryScheduler()
+            for options, expected in (({}, None), ({'retry': retry}, retry)):
+                app = web.Application()
+                use_application_insights(app, '<KEY>', loop=asyncio.get_event_loop(), **options)
+
+                channel = app.ai_client._channel
+                self.assertIsInstance(channel._retry, RetryScheduler)
+                if expected is not None:
+                    self.assertIs(expected, channel._retry)
+                await channel.dispose()
+
+        run(go())
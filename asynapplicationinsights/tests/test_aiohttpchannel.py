@@ -0,0 +1,200 @@
+import json
+import asyncio
+import unittest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from .test_channel import run
+from ..telemetry import AsyncTelemetryClient
+from ..channel.aiohttpchannel import AiohttpTelemetryChannel
+from ..channel.retry import RetryPolicy, RetryScheduler
+from ..exceptions import InvalidArgument, SendFailed
+
+
+class Collector:
+    """Local stand-in for the Application Insights track endpoint."""
+
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+        self.app = web.Application()
+        self.app.router.add_post('/v2/track', self.track)
+        self.server = None
+
+    async def track(self, request):
+        body = await request.read()
+        self.requests.append((request.headers, body))
+
+        if self.responses:
+            status, payload, headers = self.responses.pop(0)
+        else:
+            status, payload, headers = 200, None, None
+
+        if payload is None:
+            items = len(self.get_items(request.headers, body))
+            payload = {'itemsReceived': items, 'itemsAccepted': items, 'errors': []}
+
+        return web.json_response(payload, status=status, headers=headers)
+
+    @staticmethod
+    def get_items(headers, body):
+        text = body.decode('utf8')
+        if headers.get('Content-Type', '').startswith('application/x-json-stream'):
+            return [json.loads(line) for line in text.splitlines() if line]
+        return json.loads(text)
+
+    @property
+    def items(self):
+        return [item for headers, body in self.requests for item in self.get_items(headers, body)]
+
+    @property
+    def endpoint(self):
+        return str(self.server.make_url('/v2/track'))
+
+    async def __aenter__(self):
+        self.server = TestServer(self.app)
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.server.close()
+
+
+class TestAiohttpTelemetryChannel(unittest.TestCase):
+
+    def send_events(self, count, responses=None, **channel_options):
+        async def go():
+            async with Collector() as collector:
+                collector.responses.extend(responses or [])
+                channel = AiohttpTelemetryChannel(endpoint=collector.endpoint, **channel_options)
+
+                async with AsyncTelemetryClient('<KEY>', channel) as client:
+                    for i in range(count):
+                        await client.track_event('Example', {'url': f'http://localhost/like/{i}'})
+
+                return collector
+
+        return run(go())
+
+    def test_send(self):
+        collector = self.send_events(3)
+
+        self.assertEqual(1, len(collector.requests))
+        headers, _ = collector.requests[0]
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(['Example'] * 3, [item['data']['baseData']['name'] for item in collector.items])
+
+    def test_send_concurrently(self):
+        collector = self.send_events(10, max_batch_size=2, max_concurrent_sends=3)
+
+        self.assertEqual(5, len(collector.requests))
+        self.assertEqual(10, len(collector.items))
+
+    def test_send_compressed(self):
+        for encoding in ('gzip', 'deflate'):
+            collector = self.send_events(50, compression=encoding)
+
+            headers, _ = collector.requests[0]
+            self.assertEqual(encoding, headers['Content-Encoding'])
+            self.assertEqual(50, len(collector.items))
+
+    def test_send_compressed_in_executor(self):
+        collector = self.send_events(50, compression='gzip', executor_compression_threshold=0)
+
+        headers, _ = collector.requests[0]
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        self.assertEqual(50, len(collector.items))
+
+    def test_compression_threshold(self):
+        collector = self.send_events(1, compression='gzip', compression_threshold=100000)
+
+        headers, _ = collector.requests[0]
+        self.assertNotIn('Content-Encoding', headers)
+
+    def test_send_streaming(self):
+        for compression in (None, 'gzip', 'deflate'):
+            collector = self.send_events(20, streaming=True, compression=compression)
+
+            headers, _ = collector.requests[0]
+            self.assertEqual('application/x-json-stream', headers['Content-Type'])
+            self.assertEqual(compression, headers.get('Content-Encoding'))
+            self.assertEqual('chunked', headers['Transfer-Encoding'])
+            self.assertEqual(20, len(collector.items))
+
+    def test_send_failure(self):
+        async def go():
+            async with Collector() as collector:
+                collector.responses.append((429, {}, {'Retry-After': '30'}))
+                channel = AiohttpTelemetryChannel(endpoint=collector.endpoint)
+
+                async with AsyncTelemetryClient('<KEY>', channel) as client:
+                    await client.track_event('Example')
+                    with self.assertRaises(SendFailed) as context:
+                        await client.flush()
+
+                    self.assertEqual(429, context.exception.status)
+                    self.assertEqual(30, context.exception.retry_after)
+
+        run(go())
+
+    def test_send_retry(self):
+        retry = RetryScheduler(RetryPolicy(base_delay=60))
+        collector = self.send_events(3,
+                                     responses=[(503, {}, {'Retry-After': '0'})],
+                                     retry=retry)
+
+        # NB: the second attempt happens on dispose, without waiting for the delay
+        self.assertEqual(2, len(collector.requests))
+        self.assertEqual(6, len(collector.items))
+        self.assertEqual(0, retry.dropped_count)
+
+    def test_send_partial_success(self):
+        retry = RetryScheduler(RetryPolicy(base_delay=60))
+        errors = [{'index': 0, 'statusCode': 400, 'message': 'Invalid'},
+                  {'index': 2, 'statusCode': 429, 'message': 'Throttled'},
+                  {'index': 3, 'statusCode': 500, 'message': 'Error'}]
+        collector = self.send_events(4,
+                                     responses=[(206, {'itemsReceived': 4, 'itemsAccepted': 1, 'errors': errors},
+                                                 None)],
+                                     retry=retry)
+
+        self.assertEqual(2, len(collector.requests))
+        _, body = collector.requests[1]
+        resent = Collector.get_items({}, body)
+        self.assertEqual(['http://localhost/like/2', 'http://localhost/like/3'],
+                         [item['data']['baseData']['properties']['url'] for item in resent])
+        self.assertEqual({'EventData': 1}, retry.dropped)
+
+    def test_send_partial_success_without_retry(self):
+        async def go():
+            async with Collector() as collector:
+                collector.responses.append((206, {'errors': [{'index': 0, 'statusCode': 400}]}, None))
+                channel = AiohttpTelemetryChannel(endpoint=collector.endpoint)
+
+                async with AsyncTelemetryClient('<KEY>', channel) as client:
+                    await client.track_event('Example')
+                    await client.track_trace('Example')
+                    await client.flush()
+
+                # rejected items are discarded and counted, accepted ones are not sent again
+                self.assertEqual({'EventData': 1}, channel.failed_items)
+                self.assertEqual(1, len(collector.requests))
+
+        run(go())
+
+    def test_send_retry_connection_error(self):
+        async def go():
+            retry = RetryScheduler(RetryPolicy(base_delay=0.01))
+            channel = AiohttpTelemetryChannel(endpoint='http://127.0.0.1:9/v2/track', retry=retry)
+
+            async with AsyncTelemetryClient('<KEY>', channel) as client:
+                await client.track_event('Example')
+                await client.flush()
+                self.assertEqual(1, retry.pending_batches)
+
+            self.assertEqual({'EventData': 1}, channel.failed_items)
+
+        run(go())
+
+    def test_unsupported_compression(self):
+        with self.assertRaises(InvalidArgument):
+            AiohttpTelemetryChannel(asyncio.new_event_loop(), object(), compression='br')
@@ -0,0 +1,487 @@
+import asyncio
+import unittest
+from typing import List
+from ..channel.abstractions import TelemetryChannel
+from ..channel.batching import AdaptiveBatchSize
+from ..channel.queues import TelemetryQueue, OverflowPolicy
+from ..channel.retry import RetryPolicy, RetryScheduler, parse_retry_after
+from ..exceptions import SendFailed, PartialSendFailed
+
+
+class InMemoryTelemetryChannel(TelemetryChannel):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = []
+        self.send_delay = 0
+        self.failures = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def send(self, data: List):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.send_delay:
+                await asyncio.sleep(self.send_delay)
+        finally:
+            self.in_flight -= 1
+        if self.failures:
+            raise self.failures.pop(0)
+        self.batches.append(data)
+        return 100 * len(data)
+
+    async def dispose(self):
+        await self.stop()
+
+    @property
+    def sent_items(self):
+        return [item for batch in self.batches for item in batch]
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestChannel(unittest.TestCase):
+
+    def test_inline_put_flushes_on_max_length(self):
+        async def go():
+            channel = InMemoryTelemetryChannel()
+            channel._max_length = 3
+
+            for i in range(7):
+                await channel.put(i + 1)
+
+            self.assertEqual([[1, 2, 3], [4, 5, 6]], channel.batches)
+            await channel.flush()
+            self.assertEqual([7], channel.batches[-1])
+            await channel.dispose()
+
+        run(go())
+
+    def test_inline_put_flushes_on_interval(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=0.02)
+
+            await channel.put(1)
+            self.assertEqual([], channel.batches)
+            await asyncio.sleep(0.06)
+            self.assertEqual([1], channel.sent_items)
+
+            await channel.dispose()
+
+        run(go())
+
+    def test_flush_splits_batches(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None, max_batch_size=2)
+            channel._queue.put_nowait(1)
+            channel._queue.put_nowait(2)
+            channel._queue.put_nowait(3)
+
+            await channel.flush()
+            self.assertEqual([[1, 2], [3]], channel.batches)
+
+        run(go())
+
+    def test_concurrent_sends_are_bounded(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None, max_batch_size=2, max_concurrent_sends=2)
+            channel.send_delay = 0.02
+
+            for i in range(20):
+                channel._queue.put_nowait(i + 1)
+
+            await asyncio.gather(channel.flush(), channel.flush(), channel.flush())
+
+            self.assertEqual(2, channel.max_in_flight)
+            self.assertEqual(list(range(1, 21)), sorted(channel.sent_items))
+
+        run(go())
+
+    def test_sequential_sends(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None, max_batch_size=2)
+            channel.send_delay = 0.01
+
+            for i in range(6):
+                channel._queue.put_nowait(i + 1)
+
+            await asyncio.gather(channel.flush(), channel.flush())
+
+            self.assertEqual(1, channel.max_in_flight)
+            self.assertEqual([[1, 2], [3, 4], [5, 6]], channel.batches)
+
+        run(go())
+
+    def test_adaptive_batch_size_is_applied(self):
+        async def go():
+            batch_size = AdaptiveBatchSize(initial_size=2, min_size=1, max_size=8)
+            channel = InMemoryTelemetryChannel(flush_interval=None, batch_size=batch_size)
+
+            for i in range(2):
+                await channel.put(i + 1)
+
+            self.assertEqual(4, channel._max_length)
+
+        run(go())
+
+    def test_background_put_does_not_wait_for_send(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(background_sender=True, flush_interval=60)
+            channel._max_length = 2
+            channel.send_delay = 0.05
+
+            await channel.put(1)
+            await channel.put(2)
+
+            # the item is only enqueued: the background sender did not have a chance to run yet
+            self.assertEqual([], channel.batches)
+
+            await asyncio.sleep(0.1)
+            self.assertEqual([1, 2], channel.sent_items)
+
+            await channel.dispose()
+
+        run(go())
+
+    def test_background_sender_flushes_on_interval(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(background_sender=True, flush_interval=0.02)
+
+            await channel.put(1)
+            await asyncio.sleep(0.06)
+            self.assertEqual([1], channel.sent_items)
+
+            await channel.dispose()
+
+        run(go())
+
+    def test_dispose_stops_background_sender_draining_queue(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(background_sender=True, flush_interval=60)
+
+            await channel.put(1)
+            await channel.put(2)
+            await channel.dispose()
+
+            self.assertEqual([1, 2], channel.sent_items)
+            self.assertIsNone(channel._sender_task)
+
+        run(go())
+
+
+class TestAdaptiveBatchSize(unittest.TestCase):
+
+    def test_grows_while_sends_are_fast(self):
+        batch_size = AdaptiveBatchSize(initial_size=100, max_size=1000, target_latency=1.0)
+
+        self.assertEqual(200, batch_size.observe(100, 0.01, 10000))
+        self.assertEqual(400, batch_size.observe(200, 0.02, 20000))
+
+        for _ in range(10):
+            batch_size.observe(batch_size.size, 0.01, 1000)
+        self.assertEqual(1000, batch_size.size)
+
+    def test_shrinks_when_sends_are_slow(self):
+        batch_size = AdaptiveBatchSize(initial_size=400, min_size=50, target_latency=1.0)
+
+        self.assertEqual(200, batch_size.observe(400, 8.0))
+
+        for _ in range(10):
+            batch_size.observe(batch_size.size, batch_size.size * 0.02)
+        self.assertEqual(50, batch_size.size)
+
+    def test_converges_to_target_latency(self):
+        batch_size = AdaptiveBatchSize(initial_size=100, max_size=10000, target_latency=1.0)
+
+        for _ in range(20):
+            batch_size.observe(batch_size.size, batch_size.size * 0.004)
+        self.assertEqual(250, batch_size.size)
+
+    def test_respects_max_payload_size(self):
+        batch_size = AdaptiveBatchSize(initial_size=100, max_payload_size=100 * 1024)
+
+        for _ in range(10):
+            batch_size.observe(batch_size.size, 0.001, batch_size.size * 2048)
+        self.assertEqual(50, batch_size.size)
+
+    def test_validates_sizes(self):
+        with self.assertRaises(ValueError):
+            AdaptiveBatchSize(initial_size=10, min_size=20)
+
+
+class Item:
+
+    def __init__(self, data_type_name, value=None):
+        self.data_type_name = data_type_name
+        self.value = value
+
+    def __repr__(self):
+        return f'<Item {self.data_type_name} {self.value}>'
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+class TestTelemetryQueue(unittest.TestCase):
+
+    def test_returns_items_by_priority(self):
+        queue = TelemetryQueue()
+        trace = Item('MessageData')
+        event = Item('EventData')
+        exception = Item('ExceptionData')
+
+        for item in (trace, event, exception):
+            queue.put_nowait(item)
+
+        self.assertEqual([exception, event, trace], drain(queue))
+
+    def test_sheds_lower_priority_items_first(self):
+        queue = TelemetryQueue(maxsize=2, overflow_policy=OverflowPolicy.DROP_NEWEST)
+        trace = Item('MessageData')
+        metric = Item('MetricData')
+        request = Item('RequestData')
+        exception = Item('ExceptionData')
+
+        for item in (trace, metric, request, exception):
+            self.assertTrue(queue.put_nowait(item))
+
+        self.assertEqual([request, exception], drain(queue))
+        self.assertEqual({'MessageData': 1, 'MetricData': 1}, queue.dropped)
+
+    def test_drop_newest(self):
+        queue = TelemetryQueue(maxsize=2, overflow_policy=OverflowPolicy.DROP_NEWEST)
+        items = [Item('RequestData', i) for i in range(3)]
+
+        results = [queue.put_nowait(item) for item in items]
+
+        self.assertEqual([True, True, False], results)
+        self.assertEqual(items[:2], drain(queue))
+        self.assertEqual(1, queue.dropped_count)
+
+    def test_drop_oldest(self):
+        queue = TelemetryQueue(maxsize=2, overflow_policy=OverflowPolicy.DROP_OLDEST)
+        items = [Item('RequestData', i) for i in range(3)]
+
+        for item in items:
+            self.assertTrue(queue.put_nowait(item))
+
+        self.assertEqual(items[1:], drain(queue))
+
+    def test_drop_oldest_never_discards_higher_priority_items(self):
+        queue = TelemetryQueue(maxsize=1, overflow_policy=OverflowPolicy.DROP_OLDEST)
+        exception = Item('ExceptionData')
+
+        queue.put_nowait(exception)
+        self.assertFalse(queue.put_nowait(Item('MessageData')))
+        self.assertEqual([exception], drain(queue))
+
+    def test_block_waits_for_free_space(self):
+        async def go():
+            queue = TelemetryQueue(maxsize=1, overflow_policy=OverflowPolicy.BLOCK, block_timeout=1)
+            first, second = Item('EventData', 1), Item('EventData', 2)
+            await queue.put(first)
+
+            asyncio.get_event_loop().call_later(0.01, queue.get_nowait)
+            self.assertTrue(await queue.put(second))
+            self.assertEqual([second], drain(queue))
+
+        run(go())
+
+    def test_block_times_out(self):
+        async def go():
+            queue = TelemetryQueue(maxsize=1, overflow_policy=OverflowPolicy.BLOCK, block_timeout=0.01)
+            await queue.put(Item('EventData', 1))
+
+            self.assertFalse(await queue.put(Item('EventData', 2)))
+            self.assertEqual({'EventData': 1}, queue.dropped)
+
+        run(go())
+
+    def test_channel_flushes_queue_smaller_than_batch(self):
+        async def go():
+            for background_sender in (False, True):
+                channel = InMemoryTelemetryChannel(background_sender=background_sender,
+                                                   flush_interval=None,
+                                                   max_batch_size=10,
+                                                   queue=TelemetryQueue(maxsize=5,
+                                                                        overflow_policy=OverflowPolicy.BLOCK,
+                                                                        block_timeout=1))
+                loop = asyncio.get_event_loop()
+                start = loop.time()
+                for index in range(105):
+                    await channel.put(Item('EventData', index))
+                await channel.dispose()
+
+                self.assertEqual(105, len(channel.sent_items))
+                self.assertEqual({}, channel.dropped_items)
+                self.assertLess(loop.time() - start, 0.5)
+
+        run(go())
+
+    def test_channel_exposes_dropped_items(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(background_sender=True,
+                                               queue=TelemetryQueue(maxsize=1))
+            await channel.put(Item('MessageData'))
+            await channel.put(Item('MessageData'))
+
+            self.assertEqual({'MessageData': 1}, channel.dropped_items)
+            await channel.dispose()
+
+        run(go())
+
+
+class TestRetry(unittest.TestCase):
+
+    def test_parse_retry_after(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertEqual(120, parse_retry_after('120'))
+        self.assertEqual(0, parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+        self.assertGreater(parse_retry_after('Wed, 21 Oct 2099 07:28:00 GMT'), 0)
+
+    def test_policy_delays(self):
+        policy = RetryPolicy(base_delay=1, max_delay=10, jitter=0)
+
+        self.assertEqual([1, 2, 4, 8, 10], [policy.get_delay(attempt) for attempt in range(1, 6)])
+        self.assertEqual(5, policy.get_delay(1, retry_after=5))
+        self.assertEqual(500, policy.get_delay(1, retry_after=500))
+
+    def test_policy_jitter(self):
+        policy = RetryPolicy(base_delay=4, jitter=0.5)
+
+        for _ in range(20):
+            self.assertTrue(2 <= policy.get_delay(1) <= 4)
+
+    def test_policy_retriable_failures(self):
+        policy = RetryPolicy()
+
+        self.assertTrue(policy.is_retriable(SendFailed('Throttled', 429)))
+        self.assertTrue(policy.is_retriable(SendFailed('Connection error')))
+        self.assertFalse(policy.is_retriable(SendFailed('Bad request', 400)))
+        self.assertFalse(policy.is_retriable(ValueError()))
+
+    def test_policy_split_partial_failure(self):
+        policy = RetryPolicy()
+        error = PartialSendFailed('Partial', [(0, 400), (2, 503), (3, 439), (10, 500)])
+
+        self.assertEqual(([3, 4], [1]), policy.split([1, 2, 3, 4], error))
+        self.assertEqual(([1, 2], []), policy.split([1, 2], SendFailed('Throttled', 429)))
+        self.assertEqual(([], [1, 2]), policy.split([1, 2], SendFailed('Bad request', 400)))
+
+    def test_channel_retries_transient_failures(self):
+        async def go():
+            retry = RetryScheduler(RetryPolicy(base_delay=0.01))
+            channel = InMemoryTelemetryChannel(flush_interval=None, retry=retry)
+            channel.failures = [SendFailed('Throttled', 429, 0.01), SendFailed('Unavailable', 503)]
+
+            await channel.put(1)
+            await channel.flush()
+            self.assertEqual(1, retry.pending_batches)
+
+            await asyncio.sleep(0.1)
+            self.assertEqual([[1]], channel.batches)
+            self.assertEqual(0, retry.pending_batches)
+            self.assertEqual({}, channel.failed_items)
+
+        run(go())
+
+    def test_retries_share_send_slots(self):
+        async def go():
+            retry = RetryScheduler(RetryPolicy(base_delay=0.001, jitter=0))
+            channel = InMemoryTelemetryChannel(flush_interval=None, max_batch_size=1, retry=retry)
+            channel.send_delay = 0.01
+            channel.failures = [SendFailed('Unavailable', 503)] * 2
+
+            for i in range(6):
+                channel._queue.put_nowait(i + 1)
+            await channel.flush()
+            await asyncio.sleep(0.05)
+
+            self.assertEqual([1, 2, 3, 4, 5, 6], sorted(channel.sent_items))
+            self.assertEqual(1, channel.max_in_flight)
+
+        run(go())
+
+    def test_channel_drops_permanent_failures(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None, retry=RetryScheduler())
+            channel.failures = [SendFailed('Bad request', 400)]
+
+            await channel.put(1)
+            await channel.flush()
+
+            self.assertEqual([], channel.batches)
+            self.assertEqual({None: 1}, channel.failed_items)
+
+        run(go())
+
+    def test_channel_drops_after_max_attempts(self):
+        async def go():
+            retry = RetryScheduler(RetryPolicy(max_attempts=2, base_delay=0.01))
+            channel = InMemoryTelemetryChannel(flush_interval=None, retry=retry)
+            channel.failures = [SendFailed('Throttled', 429)] * 2
+
+            await channel.put(1)
+            await channel.flush()
+            await asyncio.sleep(0.05)
+
+            self.assertEqual([], channel.batches)
+            self.assertEqual(1, retry.dropped_count)
+
+        run(go())
+
+    def test_channel_drops_when_retry_after_exceeds_limit(self):
+        async def go():
+            retry = RetryScheduler(RetryPolicy(max_retry_after=60))
+            channel = InMemoryTelemetryChannel(flush_interval=None, retry=retry)
+            channel.failures = [SendFailed('Quota exceeded', 439, 3600)]
+
+            await channel.put(1)
+            await channel.flush()
+
+            self.assertEqual(0, retry.pending_batches)
+            self.assertEqual({None: 1}, channel.failed_items)
+
+        run(go())
+
+    def test_pending_items_are_capped(self):
+        async def go():
+            retry = RetryScheduler(RetryPolicy(base_delay=60), max_pending_items=2)
+            channel = InMemoryTelemetryChannel(flush_interval=None, max_batch_size=2, retry=retry)
+            channel.failures = [SendFailed('Throttled', 429)] * 2
+
+            for i in range(4):
+                channel._queue.put_nowait(i + 1)
+            await channel.flush()
+
+            self.assertEqual(1, retry.pending_batches)
+            self.assertEqual(2, retry.dropped_count)
+
+            # on dispose, pending batches are sent immediately
+            await channel.dispose()
+            self.assertEqual([[1, 2]], channel.batches)
+
+        run(go())
+
+    def test_failures_propagate_without_retry(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            channel.failures = [SendFailed('Throttled', 429)]
+
+            await channel.put(1)
+            with self.assertRaises(SendFailed):
+                await channel.flush()
+
+        run(go())
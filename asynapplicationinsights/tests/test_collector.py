@@ -0,0 +1,84 @@
+import os
+import json
+import asyncio
+import tempfile
+import unittest
+from .test_channel import InMemoryTelemetryChannel, run
+from ..channel.forwarding import ForwardingTelemetryChannel, decode_metrics, encode_metrics
+from ..collector import TelemetryCollector
+from ..exceptions import SendFailed
+from ..metrics import HistogramSeries, MetricSeries, MetricsAggregator
+from ..serialization import serialize_envelopes
+from ..telemetry import AsyncTelemetryClient
+
+
+class TestMetricsEncoding(unittest.TestCase):
+
+    def test_round_trip(self):
+        series = MetricSeries()
+        histogram = HistogramSeries()
+        for value in (1, 2, 30):
+            series.add(value)
+            histogram.add(value)
+
+        decoded = decode_metrics(json.loads(encode_metrics([('a', None, series), ('b', {'x': '1'}, histogram)])))
+
+        self.assertEqual(['a', 'b'], [name for name, _, _ in decoded])
+        self.assertEqual(series.to_state(), decoded[0][2].to_state())
+        self.assertIsInstance(decoded[1][2], HistogramSeries)
+        self.assertEqual(histogram.sketch.quantile(0.99), decoded[1][2].sketch.quantile(0.99))
+        self.assertEqual({'x': '1'}, decoded[1][1])
+
+
+class TestTelemetryCollector(unittest.TestCase):
+
+    def test_workers_forward_to_collector(self):
+        async def go():
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'collector.sock')
+                channel = InMemoryTelemetryChannel(flush_interval=None)
+                client = AsyncTelemetryClient('<KEY>', channel, metrics=MetricsAggregator())
+
+                async with TelemetryCollector(client, path) as collector:
+                    for worker in range(2):
+                        worker_client = AsyncTelemetryClient('<KEY>',
+                                                             ForwardingTelemetryChannel(path, flush_interval=None),
+                                                             metrics=MetricsAggregator())
+                        await worker_client.track_event(f'Worker {worker}')
+                        for value in range(10):
+                            await worker_client.track_metric('Example', value)
+                            await worker_client.track_histogram('Latency', value * 10)
+                        await worker_client.dispose()
+
+                    await asyncio.sleep(0.05)
+                    self.assertEqual(2, collector.received_envelopes)
+                    self.assertEqual(4, collector.received_series)
+
+                await client.dispose()
+
+                items = json.loads(serialize_envelopes(channel.sent_items))
+                names = sorted(item['data']['baseData'].get('name') or item['data']['baseData']['metrics'][0]['name']
+                               for item in items)
+                self.assertEqual(['Example', 'Latency', 'Latency_p50', 'Latency_p90', 'Latency_p95', 'Latency_p99',
+                                  'Worker 0', 'Worker 1'], names)
+
+                metrics = {item['data']['baseData']['metrics'][0]['name']: item['data']['baseData']['metrics'][0]
+                           for item in items if item['data']['baseType'] == 'MetricData'}
+                self.assertEqual(20, metrics['Example']['count'])
+                self.assertEqual(90, metrics['Example']['value'])
+                self.assertEqual(20, metrics['Latency']['count'])
+
+        run(go())
+
+    def test_collector_unavailable(self):
+        async def go():
+            with tempfile.TemporaryDirectory() as directory:
+                channel = ForwardingTelemetryChannel(os.path.join(directory, 'missing.sock'), flush_interval=None)
+                client = AsyncTelemetryClient('<KEY>', channel)
+
+                await client.track_event('Example')
+                with self.assertRaises(SendFailed):
+                    await client.flush()
+                await client.dispose()
+
+        run(go())
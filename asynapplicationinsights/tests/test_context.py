@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+from .test_channel import InMemoryTelemetryChannel, run
+from ..context import OperationContext, get_operation_context, operation_context
+from ..entities import Operation, User
+from ..telemetry import AsyncTelemetryClient
+
+
+def get_tags(item):
+    return item.tags.to_dict()
+
+
+class TestOperationContext(unittest.TestCase):
+
+    def test_items_are_correlated_with_ambient_operation(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            client = AsyncTelemetryClient('<KEY>', channel)
+
+            with operation_context(Operation('1', 'GET /')) as context:
+                await client.track_trace('Example')
+                client.track_event_nowait('Example')
+                await client.track_request('1', '/', 'http://localhost/', True,
+                                           response_code=200, http_method='GET')
+                await client.track_event('Example', user=User('account', 'user', 'session'))
+            await client.track_trace('Outside')
+            await client.dispose()
+
+            items = channel.sent_items
+            self.assertEqual(['1'] * 4 + [None], [get_tags(item).get('ai.operation.id') for item in items])
+            # tags of the ambient context are shared, not rebuilt
+            self.assertIs(context.tags, items[0].tags.extra)
+            self.assertEqual(['user'], [get_tags(item)['ai.user.id'] for item in items
+                                        if 'ai.user.id' in get_tags(item)])
+
+        run(go())
+
+    def test_explicit_tags_take_precedence(self):
+        client = AsyncTelemetryClient('<KEY>', InMemoryTelemetryChannel(flush_interval=None))
+
+        with operation_context(Operation('1', 'GET /')):
+            tags = client.get_tags(Operation('2', 'GET /other'))
+
+        self.assertEqual('2', tags['ai.operation.id'])
+
+    def test_context_is_isolated_between_tasks(self):
+        async def handle(operation_id):
+            with operation_context(Operation(operation_id, 'GET /')):
+                await asyncio.sleep(0.01)
+                return get_operation_context().operation.id
+
+        async def go():
+            self.assertEqual(['1', '2'], list(await asyncio.gather(handle('1'), handle('2'))))
+            self.assertIsNone(get_operation_context())
+
+        run(go())
+
+    def test_tags(self):
+        context = OperationContext(Operation('1', 'GET /'), user=User('account', 'user', 'session'))
+
+        self.assertEqual('1', context.tags['ai.operation.id'])
+        self.assertEqual('user', context.tags['ai.user.id'])
@@ -1,5 +1,8 @@
+import sys
+import unittest
+import traceback
 from . import Theory, cases
-from ..entities import RequestData
+from ..entities import ExceptionDetails, RequestData
 
 
 class TestEntities(Theory):
@@ -15,3 +18,38 @@ class TestEntities(Theory):
     def test_request_duration_formatting(self, value, expected_format):
         formatted = RequestData.format_duration(value)
         self.assertEqual(expected_format, formatted)
+
+
+def recurse(depth):
+    if depth:
+        recurse(depth - 1)
+    raise ValueError('Example')
+
+
+def get_exc_info(depth=0):
+    try:
+        recurse(depth)
+    except ValueError:
+        return sys.exc_info()
+
+
+class TestExceptionDetails(unittest.TestCase):
+
+    def test_stack_matches_traceback(self):
+        type, value, tb = get_exc_info(3)
+        details = ExceptionDetails.from_exception(type, value, tb, skip_frames=1)
+
+        expected = list(reversed(traceback.extract_tb(tb)[1:]))
+        self.assertEqual([(frame.filename, frame.lineno, frame.name) for frame in expected],
+                         [(frame.file_name, frame.line, frame.method) for frame in details.stack])
+        self.assertEqual([frame.line for frame in expected], details.texts)
+        self.assertEqual([3, 2, 1, 0], [frame.level for frame in details.stack])
+        self.assertTrue(details.has_full_stack)
+
+    def test_max_depth_keeps_innermost_frames(self):
+        type, value, tb = get_exc_info(10)
+        details = ExceptionDetails.from_exception(type, value, tb, max_depth=3)
+
+        self.assertEqual(3, len(details.stack))
+        self.assertEqual("raise ValueError('Example')", details.texts[0])
+        self.assertFalse(details.has_full_stack)
@@ -0,0 +1,227 @@
+import math
+import statistics
+import unittest
+from .test_channel import InMemoryTelemetryChannel, run
+from ..entities import DataPointKind
+from ..exceptions import InvalidOperation
+from ..metrics import CardinalityLimiter, HistogramSeries, MetricSeries, MetricsAggregator, QuantileSketch
+from ..serialization import envelope_to_dict
+from ..telemetry import AsyncTelemetryClient
+
+
+VALUES = [12.5, 3.0, 7.25, 40.0, 0.5, 19.0]
+
+
+class TestMetricSeries(unittest.TestCase):
+
+    def test_statistics(self):
+        series = MetricSeries()
+        for value in VALUES:
+            series.add(value)
+
+        self.assertEqual(len(VALUES), series.count)
+        self.assertAlmostEqual(sum(VALUES), series.sum)
+        self.assertEqual(min(VALUES), series.min)
+        self.assertEqual(max(VALUES), series.max)
+        self.assertAlmostEqual(statistics.pstdev(VALUES), series.std_dev)
+
+    def test_merge(self):
+        first, second, merged = MetricSeries(), MetricSeries(), MetricSeries()
+        for value in VALUES[:2]:
+            first.add(value)
+        for value in VALUES[2:]:
+            second.add(value)
+
+        merged.merge(first)
+        merged.merge(second)
+        merged.merge(MetricSeries())
+
+        self.assertEqual(len(VALUES), merged.count)
+        self.assertAlmostEqual(sum(VALUES), merged.sum)
+        self.assertEqual(min(VALUES), merged.min)
+        self.assertEqual(max(VALUES), merged.max)
+        self.assertAlmostEqual(statistics.pstdev(VALUES), merged.std_dev)
+
+    def test_empty_series(self):
+        series = MetricSeries()
+        self.assertEqual(0, series.sum)
+        self.assertEqual(0, series.std_dev)
+        self.assertTrue(math.isinf(series.min))
+
+
+class TestMetricsAggregator(unittest.TestCase):
+
+    def test_collect_by_series(self):
+        aggregator = MetricsAggregator()
+        aggregator.track('Latency', 10, {'route': '/a', 'method': 'GET'})
+        aggregator.track('Latency', 20, {'method': 'GET', 'route': '/a'})
+        aggregator.track('Latency', 30, {'route': '/b'})
+        aggregator.track('Queue', 5)
+
+        self.assertEqual(3, len(aggregator))
+        points = {(point.name, tuple(sorted((properties or {}).items()))): point
+                  for point, properties in aggregator.collect()}
+
+        point = points[('Latency', (('method', 'GET'), ('route', '/a')))]
+        self.assertEqual(DataPointKind.Aggregation, point.kind)
+        self.assertEqual(30, point.value)
+        self.assertEqual(2, point.count)
+        self.assertEqual(10, point.min)
+        self.assertEqual(20, point.max)
+
+        self.assertEqual(1, points[('Queue', ())].count)
+        self.assertEqual(0, len(aggregator))
+
+    def test_unhashable_values(self):
+        aggregator = MetricsAggregator()
+        aggregator.track('Latency', 10, {'tags': ['a', 'b']})
+        aggregator.track('Latency', 20, {'tags': ['a', 'b']})
+        aggregator.track_histogram('Size', 1, {'options': {'a': 1}})
+
+        (point, properties), = [item for item in aggregator.collect() if item[0].name == 'Latency']
+        self.assertEqual(2, point.count)
+        self.assertEqual({'tags': ['a', 'b']}, properties)
+
+
+class TestTelemetryClientMetrics(unittest.TestCase):
+
+    def test_track_metric_is_aggregated(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            client = AsyncTelemetryClient('<KEY>', channel, metrics=MetricsAggregator(interval=60))
+
+            for value in VALUES:
+                await client.track_metric('Example', value)
+            client.track_metric_nowait('Example', 1)
+
+            # pre-aggregated data points are collected at dispose
+            await client.track_metric('Example', 1, count=3)
+            self.assertEqual(1, channel._queue.qsize())
+
+            await client.dispose()
+            self.assertEqual(2, len(channel.sent_items))
+
+            data = envelope_to_dict(channel.sent_items[1])['data']['baseData']
+            metric = data['metrics'][0]
+            self.assertEqual(int(DataPointKind.Aggregation), metric['kind'])
+            self.assertEqual(len(VALUES) + 1, metric['count'])
+            self.assertAlmostEqual(sum(VALUES) + 1, metric['value'])
+            self.assertEqual(40.0, metric['max'])
+
+        run(go())
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def test_quantiles_within_relative_accuracy(self):
+        values = [float(i) for i in range(1, 10001)]
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        for value in values:
+            sketch.add(value)
+
+        for q in (0.5, 0.9, 0.99):
+            expected = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(abs(sketch.quantile(q) - expected), expected * 0.01)
+
+    def test_merge(self):
+        first, second, whole = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for i in range(-100, 1000):
+            (first if i % 2 else second).add(i)
+            whole.add(i)
+
+        first.merge(second)
+        self.assertEqual(whole.count, first.count)
+        for q in (0, 0.05, 0.5, 0.99, 1):
+            self.assertEqual(whole.quantile(q), first.quantile(q))
+
+    def test_max_buckets_preserves_high_quantiles(self):
+        sketch = QuantileSketch(relative_accuracy=0.01, max_buckets=50)
+        for i in range(1, 100001):
+            sketch.add(i)
+
+        self.assertLessEqual(len(sketch._positive), 50)
+        self.assertLessEqual(abs(sketch.quantile(0.99) - 99000), 990)
+
+    def test_empty(self):
+        self.assertIsNone(QuantileSketch().quantile(0.5))
+
+
+class TestHistograms(unittest.TestCase):
+
+    def test_collect_percentiles(self):
+        aggregator = MetricsAggregator(percentiles=(50, 99))
+        for i in range(1, 101):
+            aggregator.track_histogram('latency', i, {'route': '/'})
+
+        points = {point.name: (point, properties) for point, properties in aggregator.collect()}
+        self.assertEqual({'latency', 'latency_p50', 'latency_p99'}, set(points))
+        self.assertEqual(100, points['latency'][0].count)
+        self.assertAlmostEqual(50, points['latency_p50'][0].value, delta=1)
+        self.assertAlmostEqual(99, points['latency_p99'][0].value, delta=1)
+        self.assertEqual({'route': '/'}, points['latency_p99'][1])
+
+    def test_merge_histogram(self):
+        aggregator = MetricsAggregator(percentiles=(100,))
+        other = HistogramSeries()
+        other.add(1000)
+        aggregator.track_histogram('latency', 1)
+        aggregator.merge('latency', other)
+
+        points = {point.name: point for point, _ in aggregator.collect()}
+        self.assertEqual(2, points['latency'].count)
+        self.assertEqual(1000, points['latency_p100'].value)
+
+    def test_client_requires_aggregator(self):
+        client = AsyncTelemetryClient('<KEY>', InMemoryTelemetryChannel(flush_interval=None))
+        with self.assertRaises(InvalidOperation):
+            client.track_histogram_nowait('latency', 10)
+        with self.assertRaises(InvalidOperation):
+            run(client.track_histogram('latency', 10))
+
+
+class TestCardinalityLimiter(unittest.TestCase):
+
+    def test_collapses_combinations_over_limit(self):
+        limiter = CardinalityLimiter(max_combinations=2)
+
+        self.assertEqual({'user': 'a'}, limiter.limit('Example', {'user': 'a'}))
+        self.assertEqual({'user': 'b'}, limiter.limit('Example', {'user': 'b'}))
+        self.assertEqual({'user': 'a'}, limiter.limit('Example', {'user': 'a'}))
+        self.assertEqual({'user': 'other'}, limiter.limit('Example', {'user': 'c'}))
+        self.assertEqual({'user': 'c'}, limiter.limit('Another', {'user': 'c'}))
+        self.assertIsNone(limiter.limit('Example', None))
+
+        self.assertEqual({'Example': 1}, limiter.collapsed)
+
+    def test_max_names(self):
+        limiter = CardinalityLimiter(max_names=1)
+        limiter.limit('Example', {'a': 1})
+
+        self.assertEqual({'a': 'other'}, limiter.limit('Another', {'a': 1}))
+        self.assertEqual(1, limiter.collapsed_count)
+
+    def test_unhashable_values(self):
+        limiter = CardinalityLimiter(max_combinations=1)
+        self.assertEqual({'a': [1]}, limiter.limit('Example', {'a': [1]}))
+        self.assertEqual({'a': [1]}, limiter.limit('Example', {'a': [1]}))
+
+    def test_bounds_aggregated_series(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            aggregator = MetricsAggregator()
+            client = AsyncTelemetryClient('<KEY>', channel,
+                                          metrics=aggregator,
+                                          limiter=CardinalityLimiter(max_combinations=10))
+
+            for i in range(1000):
+                client.track_metric_nowait('Example', i, properties={'url': f'/items/{i}'})
+                client.track_event_nowait('Example', {'url': f'/items/{i}'})
+
+            self.assertEqual(11, len(aggregator))
+            await client.dispose()
+
+            urls = {envelope_to_dict(item)['data']['baseData']['properties']['url']
+                    for item in channel.sent_items if item.data_type_name == 'EventData'}
+            self.assertEqual(11, len(urls))
+
+        run(go())
@@ -0,0 +1,144 @@
+import uuid
+import unittest
+from unittest import mock
+from .test_channel import InMemoryTelemetryChannel, run
+from ..entities import Operation
+from ..sampling import AdaptiveSampler, FixedRateSampler, SlidingWindowRate, get_sampling_score
+from ..serialization import envelope_to_dict, serialize_envelope
+from ..telemetry import AsyncTelemetryClient
+
+
+class TestFixedRateSampler(unittest.TestCase):
+
+    def test_sampling_score_is_stable(self):
+        operation_id = str(uuid.uuid4())
+        score = get_sampling_score(operation_id)
+
+        self.assertTrue(0 <= score < 100)
+        self.assertEqual(score, get_sampling_score(operation_id))
+
+    def test_keeps_percentage_of_operations(self):
+        sampler = FixedRateSampler(25)
+        kept = sum(1 for _ in range(10000) if sampler.sample('EventData', str(uuid.uuid4())))
+
+        self.assertAlmostEqual(2500, kept, delta=250)
+
+    def test_excluded_types(self):
+        sampler = FixedRateSampler(0, excluded_types=['ExceptionData'])
+
+        self.assertEqual(0, sampler.sample('EventData', 'a'))
+        self.assertEqual(100, sampler.sample('ExceptionData', 'a'))
+
+    def test_invalid_percentage(self):
+        with self.assertRaises(ValueError):
+            FixedRateSampler(101)
+
+
+class TestSlidingWindowRate(unittest.TestCase):
+
+    def test_rate(self):
+        rate = SlidingWindowRate(window=10, buckets=10)
+
+        for i in range(100):
+            rate.add(100 + i / 10)
+        self.assertAlmostEqual(10, rate.get_rate(110), delta=0.5)
+
+        # buckets older than the window expire
+        self.assertTrue(rate.add(115))
+        self.assertEqual(41, rate.total)
+        rate.add(200)
+        self.assertEqual(1, rate.total)
+
+
+class TestAdaptiveSampler(unittest.TestCase):
+
+    def run_items(self, sampler, type_name, per_second, seconds, start=1000.0, failed=False):
+        kept = 0
+        with mock.patch('time.monotonic') as monotonic:
+            for i in range(int(per_second * seconds)):
+                monotonic.return_value = start + i / per_second
+                if sampler.sample(type_name, str(uuid.uuid4()), failed):
+                    kept += 1
+        return kept
+
+    def test_adapts_to_target_rate(self):
+        sampler = AdaptiveSampler(max_items_per_second=10)
+
+        kept = self.run_items(sampler, 'RequestData', 1000, 20)
+        self.assertAlmostEqual(1, sampler.percentages['RequestData'], delta=0.05)
+        # the sampler converges after the first bucket
+        self.assertLess(kept, 1000 + 10 * 20 * 2)
+
+    def test_low_rates_are_not_sampled(self):
+        sampler = AdaptiveSampler(max_items_per_second=10)
+
+        self.assertEqual(50, self.run_items(sampler, 'EventData', 5, 10))
+
+    def test_first_items_are_not_sampled(self):
+        sampler = AdaptiveSampler(max_items_per_second=1)
+        self.assertEqual(1, self.run_items(sampler, 'EventData', 1, 1))
+        self.assertEqual(100, sampler.percentages['EventData'])
+
+        sampler = AdaptiveSampler()
+        self.assertEqual(10, self.run_items(sampler, 'EventData', 1, 10))
+        self.assertEqual(100, sampler.percentages['EventData'])
+
+    def test_keeps_failures_and_exceptions(self):
+        sampler = AdaptiveSampler(max_items_per_second=1)
+
+        self.assertEqual(2000, self.run_items(sampler, 'RequestData', 100, 20, failed=True))
+        self.assertEqual(2000, self.run_items(sampler, 'ExceptionData', 100, 20))
+
+    def test_limits_by_type(self):
+        sampler = AdaptiveSampler(max_items_per_second=100, limits={'MessageData': 10})
+
+        self.run_items(sampler, 'MessageData', 100, 5)
+        self.run_items(sampler, 'EventData', 50, 5)
+        self.assertAlmostEqual(10, sampler.percentages['MessageData'], delta=1)
+        self.assertEqual(100, sampler.percentages['EventData'])
+
+
+class TestTelemetryClientSampling(unittest.TestCase):
+
+    def test_items_of_an_operation_are_kept_together(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            client = AsyncTelemetryClient('<KEY>', channel, sampler=FixedRateSampler(50))
+
+            kept_operations = set()
+            for _ in range(200):
+                operation = Operation(str(uuid.uuid4()), 'GET /')
+                await client.track_trace('Example', operation=operation)
+                client.track_event_nowait('Example', operation=operation)
+                await client.track_request(operation.id, '/', 'http://localhost/', True,
+                                           response_code=200, http_method='GET')
+                try:
+                    raise ValueError('Example')
+                except ValueError:
+                    await client.track_exception(operation=operation)
+
+            await client.track_metric('Example', 1)
+            await client.dispose()
+
+            counts = {}
+            for item in channel.sent_items:
+                data = envelope_to_dict(item)
+                if item.data_type_name == 'MetricData':
+                    self.assertEqual(100, data['sampleRate'])
+                    continue
+                self.assertEqual(50, data['sampleRate'])
+                operation_id = data['tags']['ai.operation.id']
+                counts[operation_id] = counts.get(operation_id, 0) + 1
+                kept_operations.add(operation_id)
+
+            self.assertTrue(0 < len(kept_operations) < 200)
+            self.assertEqual({4}, set(counts.values()))
+
+        run(go())
+
+    def test_sample_rate_is_serialized(self):
+        client = AsyncTelemetryClient('<KEY>', InMemoryTelemetryChannel(flush_interval=None))
+        envelope = client.create_event('Example', sample_rate=12.5)
+
+        self.assertIn(b'"sampleRate":12.5', serialize_envelope(envelope))
+        self.assertEqual(12.5, envelope.to_dict()['sampleRate'])
@@ -0,0 +1,120 @@
+import sys
+import json
+import uuid
+import unittest
+from datetime import datetime, date
+from ..entities import (Envelope,
+                        EnvelopeTags,
+                        StaticTags,
+                        EventData,
+                        TraceData,
+                        MetricData,
+                        DataPoint,
+                        RequestData,
+                        ExceptionData,
+                        ExceptionDetails)
+from ..metrics import MetricsAggregator
+from ..serialization import serialize_envelope, serialize_envelopes, iter_ndjson_envelopes, envelope_to_dict
+from ..telemetry import AsyncTelemetryClient
+from ..utils.json import friendly_dumps
+
+
+STATIC_TAGS = StaticTags({'ai.device.id': 'example', 'ai.internal.sdkVersion': 'asynpy3:0.0.1'})
+
+TAGS = EnvelopeTags(STATIC_TAGS, {'ai.operation.id': '1'})
+
+
+def get_exception_details():
+    try:
+        raise ValueError('Example')
+    except ValueError:
+        return ExceptionDetails.from_exception(*sys.exc_info())
+
+
+def get_envelopes():
+    return [
+        Envelope('<KEY>', EventData('Example', {'when': datetime(2018, 5, 1, 10, 30), 'id': uuid.uuid4()},
+                                    {'speed': 55.5}), TAGS),
+        Envelope('<KEY>', TraceData('Example', {'day': date(2018, 5, 1)}, 2), TAGS),
+        Envelope('<KEY>', MetricData(DataPoint('Example', 10.5), None), TAGS),
+        Envelope('<KEY>', MetricData(DataPoint('Example', 10.5, count=3, min=1, max=20), {'a': 'b'}), TAGS),
+        Envelope('<KEY>', RequestData(str(uuid.uuid4()), 'Example', 'GET', 'http://localhost/like/1', 200,
+                                      True, datetime.utcnow(), 125, {'a': 'b'}, None), TAGS),
+        Envelope('<KEY>', ExceptionData([get_exception_details()], {'code_0': 'raise'}), TAGS),
+        Envelope('<KEY>', ExceptionData([get_exception_details()]), EnvelopeTags(STATIC_TAGS)),
+        Envelope('<KEY>', TraceData('Example'), {'ai.device.id': 'example', 'ai.operation.id': '1'}),
+    ]
+
+
+class TestSerialization(unittest.TestCase):
+
+    def test_serialize_envelope_like_friendly_dumps(self):
+        for envelope in get_envelopes():
+            with self.subTest(envelope=envelope):
+                expected = json.loads(friendly_dumps(envelope))
+                value = json.loads(serialize_envelope(envelope).decode('utf8'))
+                self.assertEqual(expected, value)
+
+    def test_serialize_envelopes(self):
+        envelopes = get_envelopes()
+
+        expected = json.loads(friendly_dumps(envelopes))
+        value = json.loads(serialize_envelopes(envelopes).decode('utf8'))
+        self.assertEqual(expected, value)
+
+    def test_iter_ndjson_envelopes(self):
+        envelopes = get_envelopes()
+
+        chunks = list(iter_ndjson_envelopes(envelopes))
+
+        self.assertEqual(len(envelopes), len(chunks))
+        for envelope, chunk in zip(envelopes, chunks):
+            self.assertTrue(chunk.endswith(b'\n'))
+            self.assertEqual(json.loads(friendly_dumps(envelope)), json.loads(chunk.decode('utf8')))
+
+    def test_envelope_to_dict(self):
+        for envelope in get_envelopes():
+            with self.subTest(envelope=envelope):
+                expected = json.loads(friendly_dumps(envelope))
+                self.assertEqual(expected, json.loads(friendly_dumps(envelope_to_dict(envelope))))
+
+    def test_static_tags_fragment_is_cached(self):
+        static_tags = StaticTags({'ai.device.id': 'example'})
+
+        serialize_envelope(Envelope('<KEY>', TraceData('Example'), EnvelopeTags(static_tags)))
+        self.assertEqual(b'"ai.device.id":"example"', static_tags.fragment)
+
+        static_tags.fragment = b'"ai.device.id":"cached"'
+        value = serialize_envelope(Envelope('<KEY>', TraceData('Example'), EnvelopeTags(static_tags, {'a': 'b'})))
+        self.assertEqual({'ai.device.id': 'cached', 'a': 'b'}, json.loads(value.decode('utf8'))['tags'])
+
+    def test_client_envelope_tags_share_static_tags(self):
+        client = AsyncTelemetryClient('<KEY>', object())
+
+        first = client.get_envelope_tags()
+        second = client.get_envelope_tags()
+
+        self.assertIs(first.static, second.static)
+        self.assertIsNone(first.extra)
+        self.assertEqual(client.get_tags(), first.to_dict())
+        self.assertIn('ai.device.id', client.get_tags())
+        self.assertIn('ai.internal.sdkVersion', client.get_tags())
+
+    def test_data_point_kinds(self):
+        aggregator = MetricsAggregator(percentiles=(50,))
+        aggregator.track_histogram('Latency', 5)
+
+        kinds = {}
+        for point, properties in aggregator.collect():
+            value = json.loads(serialize_envelope(Envelope('<KEY>', MetricData(point, properties), TAGS)))
+            metric, = value['data']['baseData']['metrics']
+            kinds[metric['name']] = metric['kind']
+
+        # Measurement = 0, Aggregation = 1, as DataPointType of the Application Insights schema
+        self.assertEqual({'Latency': 1, 'Latency_p50': 0}, kinds)
+        self.assertEqual(0, json.loads(serialize_envelope(get_envelopes()[2]))['data']['baseData']['metrics'][0]['kind'])
+
+    def test_non_ascii_characters(self):
+        envelope = Envelope('<KEY>', TraceData('Città 東京'), TAGS)
+
+        self.assertIn('Città 東京'.encode('utf8'), serialize_envelope(envelope))
@@ -0,0 +1,160 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from .test_channel import run
+from .test_aiohttpchannel import Collector
+from ..channel.retry import RetryScheduler
+from ..exceptions import InvalidArgument, InvalidOperation
+from ..telemetry import AsyncTelemetryClient
+from ..channel.spool import SegmentSpool, SpoolingTelemetryChannel
+
+
+class TestSegmentSpool(unittest.TestCase):
+
+    def test_append_rotates_segments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = SegmentSpool(directory, max_segment_size=10)
+
+            spool.append(b'{"a":1}\n')
+            spool.append(b'{"a":2}\n')
+            spool.append(b'{"a":3}\n')
+
+            paths = spool.rotate()
+            self.assertEqual(2, len(paths))
+            self.assertEqual(b'{"a":1}\n{"a":2}\n', spool.read(paths[0]))
+            self.assertEqual(b'{"a":3}\n', spool.read(paths[1]))
+            self.assertEqual(24, spool.size)
+
+    def test_max_size_discards_oldest_segments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = SegmentSpool(directory, max_segment_size=8, max_size=16)
+
+            for i in range(4):
+                spool.append(f'{{"a":{i}}}\n'.encode('utf8'))
+
+            paths = spool.rotate()
+            self.assertEqual([b'{"a":2}\n', b'{"a":3}\n'], [spool.read(path) for path in paths])
+            self.assertEqual(2, spool.discarded_segments)
+
+    def test_max_age_discards_old_segments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = SegmentSpool(directory, max_age=60)
+            spool.append(b'{"a":1}\n')
+
+            path = spool.rotate()[0]
+            os.utime(path, (0, 0))
+
+            self.assertEqual([], spool.rotate())
+            self.assertTrue(spool.is_empty())
+
+    def test_size_of_existing_segments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = SegmentSpool(directory)
+            spool.append(b'{"a":1}\n')
+            spool.close()
+
+            self.assertEqual(8, SegmentSpool(directory).size)
+
+    @unittest.skipIf(os.name != 'posix', 'directories are locked only where file locks are available')
+    def test_directory_is_not_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = SegmentSpool(directory)
+            with self.assertRaises(InvalidOperation):
+                SegmentSpool(directory)
+
+            spool.close()
+            SegmentSpool(directory).close()
+
+
+class TestSpoolingTelemetryChannel(unittest.TestCase):
+
+    def test_spills_and_replays_items(self):
+        async def go():
+            with tempfile.TemporaryDirectory() as directory:
+                async with Collector() as collector:
+                    collector.responses.append((503, {}, None))
+                    channel = SpoolingTelemetryChannel(directory,
+                                                       endpoint=collector.endpoint,
+                                                       replay_interval=60)
+
+                    async with AsyncTelemetryClient('<KEY>', channel) as client:
+                        await client.track_event('First')
+                        await client.flush()
+                        await asyncio.sleep(0.05)
+
+                        self.assertFalse(channel.spool.is_empty())
+                        self.assertEqual(1, len(collector.requests))
+
+                        # a successful send triggers the replay of spooled items
+                        await client.track_event('Second')
+                        await client.flush()
+                        await asyncio.sleep(0.05)
+
+                    self.assertTrue(channel.spool.is_empty())
+                    self.assertEqual(['Second', 'First'],
+                                     [item['data']['baseData']['name'] for item in collector.items[1:]])
+
+        run(go())
+
+    def test_replays_items_after_restart(self):
+        async def go():
+            with tempfile.TemporaryDirectory() as directory:
+                channel = SpoolingTelemetryChannel(directory, endpoint='http://127.0.0.1:9/v2/track')
+
+                async with AsyncTelemetryClient('<KEY>', channel) as client:
+                    await client.track_event('Example')
+                    await client.track_trace('Example')
+
+                async with Collector() as collector:
+                    channel = SpoolingTelemetryChannel(directory, endpoint=collector.endpoint)
+                    self.assertTrue(await channel.replay())
+                    await channel.dispose()
+
+                    self.assertEqual(2, len(collector.items))
+                    self.assertEqual('application/x-json-stream', collector.requests[0][0]['Content-Type'])
+                    self.assertTrue(channel.spool.is_empty())
+
+        run(go())
+
+    def test_replay_partial_success(self):
+        async def go():
+            with tempfile.TemporaryDirectory() as directory:
+                async with Collector() as collector:
+                    channel = SpoolingTelemetryChannel(directory, endpoint=collector.endpoint)
+                    channel.spool.append(b'{"data":{"baseType":"EventData"}}\n'
+                                         b'{"data":{"baseType":"MessageData"}}\n'
+                                         b'{"data":{"baseType":"MetricData"}}\n')
+
+                    errors = [{'index': 0, 'statusCode': 400}, {'index': 2, 'statusCode': 500}]
+                    collector.responses.append((206, {'errors': errors}, None))
+                    self.assertTrue(await channel.replay())
+                    self.assertEqual({'EventData': 1}, channel.failed_items)
+
+                    paths = channel.spool.rotate()
+                    self.assertEqual([b'{"data":{"baseType":"MetricData"}}\n'],
+                                     [channel.spool.read(path) for path in paths])
+                    await channel.dispose()
+
+        run(go())
+
+    def test_permanent_failures_are_not_spilled(self):
+        async def go():
+            with tempfile.TemporaryDirectory() as directory:
+                async with Collector() as collector:
+                    collector.responses.append((400, {}, None))
+                    channel = SpoolingTelemetryChannel(directory, endpoint=collector.endpoint)
+
+                    async with AsyncTelemetryClient('<KEY>', channel) as client:
+                        await client.track_event('Example')
+                        await client.flush()
+
+                    self.assertTrue(channel.spool.is_empty())
+                    self.assertEqual({'EventData': 1}, channel.failed_items)
+
+        run(go())
+
+    def test_retry_is_not_supported(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(InvalidArgument):
+                SpoolingTelemetryChannel(directory, retry=RetryScheduler())
@@ -0,0 +1,201 @@
+import sys
+import uuid
+import asyncio
+import unittest
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from .test_channel import InMemoryTelemetryChannel, run
+from ..channel.abstractions import TelemetryChannel
+from ..exceptions import InvalidOperation
+from ..metrics import MetricsAggregator
+from ..telemetry import AsyncTelemetryClient
+from ..throttling import ExceptionThrottle
+
+
+def get_type_names(items):
+    return [item.data_type_name for item in items]
+
+
+class ChannelWithoutStop(TelemetryChannel):
+
+    def __init__(self):
+        super().__init__()
+        self.sent_items = []
+
+    async def send(self, data: List):
+        self.sent_items.extend(data)
+
+    async def dispose(self):
+        pass
+
+
+class TestTelemetryClient(unittest.TestCase):
+
+    def test_dispose_stops_channel_tasks(self):
+        async def go():
+            channel = ChannelWithoutStop()
+            client = AsyncTelemetryClient('<KEY>', channel, metrics=MetricsAggregator())
+            client.track_event_nowait('Example')
+            await client.track_metric('Example', 1)
+
+            await client.dispose()
+            self.assertEqual(['EventData', 'MetricData'], get_type_names(channel.sent_items))
+            self.assertEqual([asyncio.current_task()], list(asyncio.all_tasks()))
+
+        run(go())
+
+    def test_track_nowait(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            client = AsyncTelemetryClient('<KEY>', channel)
+
+            client.track_event_nowait('Example')
+            client.track_trace_nowait('Example')
+            client.track_metric_nowait('Example', 10)
+            client.track_request_nowait(str(uuid.uuid4()), 'Example', 'http://localhost/', True,
+                                        duration=10, response_code=200, http_method='GET')
+            try:
+                raise ValueError('Example')
+            except ValueError:
+                client.track_exception_nowait()
+
+            # nothing is sent on the caller's task
+            self.assertEqual([], channel.batches)
+            self.assertEqual(5, channel._queue.qsize())
+
+            await client.dispose()
+            self.assertEqual(['RequestData', 'ExceptionData', 'EventData', 'MessageData', 'MetricData'],
+                             get_type_names(channel.sent_items))
+
+        run(go())
+
+    def test_track_nowait_defers_flush_to_sender(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None, max_batch_size=2)
+            client = AsyncTelemetryClient('<KEY>', channel)
+
+            client.track_event_nowait('Example')
+            client.track_event_nowait('Example')
+            self.assertEqual([], channel.batches)
+
+            await asyncio.sleep(0.01)
+            self.assertEqual(1, len(channel.batches))
+
+            await client.dispose()
+
+        run(go())
+
+    def test_track_from_threads(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None, max_batch_size=1000000)
+            client = AsyncTelemetryClient('<KEY>', channel)
+            channel.bind()
+
+            def produce(index):
+                for i in range(1000):
+                    client.track_trace_nowait('Example', {'thread': str(index)})
+
+            loop = asyncio.get_event_loop()
+            with ThreadPoolExecutor(8) as executor:
+                await asyncio.gather(*[loop.run_in_executor(executor, produce, index) for index in range(8)])
+
+            await client.dispose()
+            self.assertEqual(8000, len(channel.sent_items))
+
+        run(go())
+
+    def test_track_exceptions_from_threads(self):
+        switch_interval = sys.getswitchinterval()
+        # NB: frequent thread switches, to interleave counting and collection of exceptions
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None, max_batch_size=1000000)
+            client = AsyncTelemetryClient('<KEY>', channel, exceptions=ExceptionThrottle(max_per_window=1))
+            channel.bind()
+            errors = [type(f'Error{index}', (Exception,), {}) for index in range(500)]
+
+            def produce(offset):
+                for i in range(offset, offset + 1000):
+                    try:
+                        raise errors[i % len(errors)]()
+                    except Exception:
+                        client.track_exception_nowait(*sys.exc_info())
+
+            loop = asyncio.get_event_loop()
+            with ThreadPoolExecutor(8) as executor:
+                producers = asyncio.gather(*[loop.run_in_executor(executor, produce, index * 50)
+                                             for index in range(8)])
+                # summaries are collected while exceptions are counted
+                while not producers.done():
+                    await client.flush_exceptions_summary()
+                    await asyncio.sleep(0)
+                await producers
+
+            await client.dispose()
+            summaries = [item for item in channel.sent_items if item.data_type_name == 'MessageData']
+            self.assertEqual(500, get_type_names(channel.sent_items).count('ExceptionData'))
+            self.assertEqual(7500, sum(int(item.data.properties['suppressedCount']) for item in summaries))
+
+        run(go())
+
+    def test_track_from_another_loop(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            client = AsyncTelemetryClient('<KEY>', channel)
+            channel.bind()
+
+            async def background_job():
+                await client.track_event('Example')
+                await client.flush()
+
+            # a second loop, running in another thread
+            await asyncio.get_event_loop().run_in_executor(None, lambda: run(background_job()))
+
+            self.assertEqual(['EventData'], get_type_names(channel.sent_items))
+            await client.dispose()
+
+        run(go())
+
+    def test_track_from_thread_requires_bound_channel(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            client = AsyncTelemetryClient('<KEY>', channel)
+            loop = asyncio.get_event_loop()
+
+            with self.assertRaises(InvalidOperation):
+                await loop.run_in_executor(None, client.track_event_nowait, 'Example')
+            self.assertIsNone(channel.loop)
+
+            channel.bind()
+            await loop.run_in_executor(None, client.track_event_nowait, 'Example')
+            await client.dispose()
+            self.assertEqual(['EventData'], get_type_names(channel.sent_items))
+
+        run(go())
+
+    def test_put_threadsafe_requires_bound_channel(self):
+        with self.assertRaises(InvalidOperation):
+            InMemoryTelemetryChannel().put_threadsafe('Example')
+
+    def test_unhandled_exception_while_loop_is_running(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            client = AsyncTelemetryClient('<KEY>', channel)
+            excepthook = sys.excepthook
+            sys.excepthook = lambda *args: None
+            try:
+                client.handle_unhandled_exceptions(asyncio.get_event_loop())
+                try:
+                    raise ValueError('Example')
+                except ValueError:
+                    sys.excepthook(*sys.exc_info())
+            finally:
+                sys.excepthook = excepthook
+
+            await asyncio.sleep(0.01)
+            self.assertEqual(['ExceptionData'], get_type_names(channel.sent_items))
+            await client.dispose()
+
+        run(go())
@@ -0,0 +1,114 @@
+import sys
+import unittest
+from .test_channel import InMemoryTelemetryChannel, run
+from ..serialization import envelope_to_dict
+from ..telemetry import AsyncTelemetryClient
+from ..throttling import ExceptionThrottle, get_exception_fingerprint
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def fail_deep(depth, other_line=False):
+    if depth:
+        return fail_deep(depth - 1, other_line)
+    if other_line:
+        raise ValueError('second')
+    raise ValueError('first')
+
+
+def get_exc_info(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        return sys.exc_info()
+
+
+class TestExceptionFingerprint(unittest.TestCase):
+
+    def test_same_location_same_fingerprint(self):
+        first = get_exc_info(fail, 'first')
+        second = get_exc_info(fail, 'second')
+
+        self.assertEqual(get_exception_fingerprint(first[0], first[2]),
+                         get_exception_fingerprint(second[0], second[2]))
+
+    def test_different_location_different_fingerprint(self):
+        first = get_exc_info(fail, 'first')
+        second = get_exc_info(int, 'x')
+
+        self.assertNotEqual(get_exception_fingerprint(first[0], first[2]),
+                            get_exception_fingerprint(second[0], second[2]))
+
+    def test_max_depth(self):
+        type, _, tb = get_exc_info(fail, 'first')
+        locations = get_exception_fingerprint(type, tb, max_depth=1)[1]
+        self.assertEqual(1, len(locations))
+        self.assertEqual(fail.__code__.co_firstlineno + 1, locations[0][1])
+
+    def test_stack_deeper_than_max_depth(self):
+        first = get_exc_info(fail_deep, 80)
+        second = get_exc_info(fail_deep, 80, True)
+        first_fingerprint = get_exception_fingerprint(first[0], first[2], max_depth=50)
+
+        # the innermost frames are kept, including the one where the exception was raised
+        self.assertEqual(50, len(first_fingerprint[1]))
+        self.assertNotEqual(first_fingerprint, get_exception_fingerprint(second[0], second[2], max_depth=50))
+        self.assertEqual(first[2].tb_frame.f_code.co_filename, first_fingerprint[1][-1][0])
+        self.assertEqual(fail_deep.__code__.co_firstlineno + 5, first_fingerprint[1][-1][1])
+
+
+class TestExceptionThrottle(unittest.TestCase):
+
+    def test_window(self):
+        throttle = ExceptionThrottle(max_per_window=2, window=60)
+        fingerprint = ('ValueError', (('example.py', 1),))
+
+        self.assertEqual([True, True, False, False],
+                         [throttle.should_send(fingerprint, now=i) for i in range(4)])
+
+        summaries = throttle.collect(now=10)
+        self.assertEqual(1, len(summaries))
+        self.assertEqual(2, summaries[0].count)
+        self.assertEqual('example.py:1', summaries[0].location)
+
+        # a new window starts
+        self.assertTrue(throttle.should_send(fingerprint, now=70))
+        self.assertEqual([], throttle.collect(now=80))
+        self.assertEqual(0, len(throttle.collect(now=140)) + len(throttle))
+
+    def test_max_fingerprints(self):
+        throttle = ExceptionThrottle(max_fingerprints=2)
+
+        self.assertTrue(throttle.should_send(('A', ()), now=0))
+        self.assertTrue(throttle.should_send(('B', ()), now=0))
+        self.assertFalse(throttle.should_send(('C', ()), now=0))
+        self.assertFalse(throttle.should_send(('D', ()), now=0))
+
+        summaries = throttle.collect(now=0)
+        self.assertEqual([('*', 2)], [(summary.type_name, summary.count) for summary in summaries])
+
+
+class TestTelemetryClientExceptions(unittest.TestCase):
+
+    def test_exception_storm(self):
+        async def go():
+            channel = InMemoryTelemetryChannel(flush_interval=None)
+            client = AsyncTelemetryClient('<KEY>', channel, exceptions=ExceptionThrottle(max_per_window=3))
+
+            for i in range(100):
+                try:
+                    fail(str(i))
+                except ValueError:
+                    client.track_exception_nowait()
+
+            await client.dispose()
+
+            self.assertEqual(['ExceptionData'] * 3 + ['MessageData'],
+                             [item.data_type_name for item in channel.sent_items])
+            summary = envelope_to_dict(channel.sent_items[-1])['data']['baseData']
+            self.assertEqual('97', summary['properties']['suppressedCount'])
+            self.assertEqual('ValueError', summary['properties']['exceptionType'])
+
+        run(go())
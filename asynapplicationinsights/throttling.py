@@ -0,0 +1,137 @@
+"""
+This module defines classes to deduplicate and rate limit exceptions: exceptions are fingerprinted by type
+and frame locations, the first ones of each fingerprint in a window of time are sent in full, and the others
+are only counted, to be reported in a periodic summary.
+"""
+import time
+import zlib
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+
+Fingerprint = Tuple[str, tuple]
+
+
+def get_exception_fingerprint(type, tb, max_depth: int = 50) -> Fingerprint:
+    """
+    Returns a fingerprint of an exception, made of its type name and the locations of its innermost frames,
+    up to max_depth, so that the frame where the exception was raised is always included;
+    frames are read directly from the traceback, without reading source files.
+    """
+    locations = deque(maxlen=max_depth)
+    while tb is not None:
+        locations.append((tb.tb_frame.f_code.co_filename, tb.tb_lineno))
+        tb = tb.tb_next
+    return type.__qualname__, tuple(locations)
+
+
+def format_fingerprint(fingerprint: Fingerprint) -> str:
+    """Returns a short text identifying a fingerprint, the same in every process."""
+    return format(zlib.crc32(repr(fingerprint).encode('utf8')), '08x')
+
+
+class SuppressedExceptions:
+    """Summary of exceptions of a fingerprint that were not sent in a window of time."""
+
+    __slots__ = ('fingerprint', 'type_name', 'location', 'count')
+
+    def __init__(self, fingerprint: Fingerprint, count: int):
+        self.fingerprint = format_fingerprint(fingerprint)
+        self.type_name = fingerprint[0]
+        locations = fingerprint[1]
+        # NB: the innermost frame is where the exception was raised
+        self.location = f'{locations[-1][0]}:{locations[-1][1]}' if locations else ''
+        self.count = count
+
+    def to_properties(self) -> dict:
+        return {
+            'fingerprint': self.fingerprint,
+            'exceptionType': self.type_name,
+            'location': self.location,
+            'suppressedCount': str(self.count)
+        }
+
+
+class ExceptionThrottle:
+    """
+    Keeps the exceptions sent in full to a maximum number per fingerprint per window of time, counting the
+    others. The number of fingerprints kept in memory is capped: once it is reached, exceptions with new
+    fingerprints are counted under a single overflow fingerprint.
+    Exceptions can be counted from any thread.
+    """
+
+    __slots__ = ('max_per_window',
+                 'window',
+                 'max_fingerprints',
+                 '_state',
+                 '_lock')
+
+    OVERFLOW = ('*', ())  # type: Fingerprint
+
+    def __init__(self,
+                 max_per_window: int = 5,
+                 window: float = 60.0,
+                 max_fingerprints: int = 1000):
+        """
+        :param max_per_window: number of exceptions of each fingerprint sent in full per window
+        :param window: duration of the window in seconds; suppressed exceptions are summarized once per window
+        :param max_fingerprints: maximum number of fingerprints kept in memory
+        """
+        self.max_per_window = max_per_window
+        self.window = window
+        self.max_fingerprints = max_fingerprints
+        # fingerprint -> [window start, sent count, suppressed count]
+        self._state = {}  # type: Dict[Fingerprint, list]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._state)
+
+    def should_send(self, fingerprint: Fingerprint, now: Optional[float] = None) -> bool:
+        """Returns a value indicating whether an exception should be sent in full, or only counted."""
+        if now is None:
+            now = time.monotonic()
+
+        with self._lock:
+            return self._count(fingerprint, now)
+
+    def _count(self, fingerprint: Fingerprint, now: float) -> bool:
+        try:
+            state = self._state[fingerprint]
+        except KeyError:
+            if len(self._state) >= self.max_fingerprints:
+                fingerprint = self.OVERFLOW
+                state = self._state.setdefault(fingerprint, [now, self.max_per_window, 0])
+            else:
+                state = self._state[fingerprint] = [now, 0, 0]
+
+        if now - state[0] >= self.window and fingerprint is not self.OVERFLOW:
+            state[0] = now
+            state[1] = 0
+
+        if state[1] < self.max_per_window:
+            state[1] += 1
+            return True
+
+        state[2] += 1
+        return False
+
+    def collect(self, now: Optional[float] = None) -> List[SuppressedExceptions]:
+        """Returns the summaries of suppressed exceptions, forgetting fingerprints whose window expired."""
+        if now is None:
+            now = time.monotonic()
+
+        suppressed = []
+        with self._lock:
+            expired = []
+            for fingerprint, state in self._state.items():
+                if state[2]:
+                    suppressed.append((fingerprint, state[2]))
+                    state[2] = 0
+                if now - state[0] >= self.window:
+                    expired.append(fingerprint)
+
+            for fingerprint in expired:
+                del self._state[fingerprint]
+        return [SuppressedExceptions(fingerprint, count) for fingerprint, count in suppressed]
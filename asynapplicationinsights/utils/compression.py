@@ -0,0 +1,43 @@
+"""
+This module defines functions to compress HTTP request bodies
+"""
+import gzip
+import zlib
+from ..exceptions import InvalidArgument
+
+
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')
+
+
+def validate_encoding(encoding: str):
+    if encoding not in SUPPORTED_ENCODINGS:
+        raise InvalidArgument(f'Unsupported content encoding: `{encoding}`; '
+                              f'supported encodings are: {", ".join(SUPPORTED_ENCODINGS)}')
+
+
+def compress(data: bytes, encoding: str, level: int = 6) -> bytes:
+    """
+    Compresses bytes for the given HTTP content encoding.
+
+    :param data: bytes to compress
+    :param encoding: content encoding, 'gzip' or 'deflate'
+    :param level: compression level, from 1 (fastest) to 9 (smallest)
+    :return: compressed bytes
+    """
+    if encoding == 'gzip':
+        return gzip.compress(data, level)
+    if encoding == 'deflate':
+        # NB: the HTTP deflate content encoding is the zlib format
+        return zlib.compress(data, level)
+    validate_encoding(encoding)
+
+
+def get_compressor(encoding: str, level: int = 6):
+    """
+    Returns an object to compress data incrementally for the given HTTP content encoding,
+    having compress and flush methods like zlib compression objects.
+    """
+    validate_encoding(encoding)
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
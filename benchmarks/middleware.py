@@ -0,0 +1,111 @@
+"""
+Load test of a local aiohttp application, reporting the latency added to each request by the
+Application Insights middleware, in its default and fast path variants. Since the latency of requests over
+the loopback interface is noisy, the time spent in the middleware itself is also measured, calling it directly.
+
+    python -m benchmarks.middleware
+"""
+import time
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+from .track import NullTelemetryChannel
+from asynapplicationinsights.aiohttp import use_application_insights
+from asynapplicationinsights.sampling import FixedRateSampler
+
+
+async def hello(request):
+    return web.Response(text='Hello')
+
+
+def create_app(middleware: bool, **options) -> web.Application:
+    app = web.Application()
+    app.router.add_get('/items/{id}', hello)
+    if middleware:
+        use_application_insights(app,
+                                 '<KEY>',
+                                 channel=NullTelemetryChannel(background_sender=True, max_batch_size=500),
+                                 **options)
+    return app
+
+
+async def measure_middleware(app: web.Application, requests: int) -> float:
+    """Returns the number of seconds spent per request by the middlewares of an application, called directly."""
+    request = make_mocked_request('GET', '/items/1', app=app)
+    # NB: make_mocked_request only accepts match info as a dictionary, with a mocked route
+    request._match_info = await app.router.resolve(request)
+    handler = hello
+    for middleware in reversed(app.middlewares):
+        handler = (lambda m, h: lambda r: m(r, h))(middleware, handler)
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await handler(request)
+        if _ % 1000 == 0:
+            # lets the background sender drain the queue
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+
+    client = getattr(app, 'ai_client', None)
+    if client is not None:
+        await client.dispose()
+    return elapsed / requests
+
+
+async def measure(app: web.Application, requests: int, concurrency: int) -> float:
+    async with TestClient(TestServer(app)) as client:
+        async def worker(count):
+            for i in range(count):
+                response = await client.get(f'/items/{i}')
+                await response.read()
+
+        # warm up
+        await worker(100)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(requests // concurrency) for _ in range(concurrency)])
+        return (time.perf_counter() - start) / requests
+
+
+def main(requests: int = 10000, concurrency: int = 10):
+    scenarios = [
+        ('no middleware', False, {}),
+        ('default middleware', True, {}),
+        ('fast path', True, {'fast_path': True}),
+        ('fast path, 10% sampled', True, {'fast_path': True, 'sampler': FixedRateSampler(10)}),
+        ('+ request metrics', True, {'fast_path': True,
+                                     'sampler': FixedRateSampler(10),
+                                     'request_metrics': True}),
+    ]
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        print('load test, over the loopback interface')
+        baseline = None
+        for name, middleware, options in scenarios:
+            # NB: the best of a few runs, to reduce noise
+            per_request = min(loop.run_until_complete(measure(create_app(middleware, **options),
+                                                              requests,
+                                                              concurrency))
+                              for _ in range(3))
+            if baseline is None:
+                baseline = per_request
+            print(f'  {name:<26}{per_request * 1e6:>9.1f} µs/request'
+                  f'{(per_request - baseline) * 1e6:>+9.1f} µs added')
+
+        print('middleware called directly')
+        baseline = None
+        for name, middleware, options in scenarios:
+            per_request = loop.run_until_complete(measure_middleware(create_app(middleware, **options),
+                                                                     requests * 10))
+            if baseline is None:
+                baseline = per_request
+            print(f'  {name:<26}{per_request * 1e6:>9.1f} µs/request'
+                  f'{(per_request - baseline) * 1e6:>+9.1f} µs added')
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
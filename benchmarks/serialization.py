@@ -0,0 +1,80 @@
+"""
+Compares the number of envelopes per second serialized by friendly_dumps and by the fast envelope serializer,
+using both the standard json module and orjson (when installed).
+
+    python -m benchmarks.serialization
+"""
+import sys
+import json
+import uuid
+import timeit
+from datetime import datetime, date
+from asynapplicationinsights.entities import (Envelope,
+                                              EnvelopeTags,
+                                              StaticTags,
+                                              EventData,
+                                              TraceData,
+                                              MetricData,
+                                              DataPoint,
+                                              RequestData,
+                                              ExceptionData,
+                                              ExceptionDetails)
+from asynapplicationinsights.serialization import default, envelope_to_dict, orjson, serialize_envelopes
+from asynapplicationinsights.utils.json import friendly_dumps
+
+
+STATIC_TAGS = StaticTags({'ai.device.id': 'example', 'ai.internal.sdkVersion': 'asynpy3:0.0.1'})
+
+TAGS = EnvelopeTags(STATIC_TAGS, {'ai.operation.id': '1'})
+
+
+def get_exception_details():
+    try:
+        raise ValueError('Example')
+    except ValueError:
+        return ExceptionDetails.from_exception(*sys.exc_info())
+
+
+def get_envelopes():
+    return [
+        Envelope('<KEY>', EventData('Example', {'when': datetime(2018, 5, 1, 10, 30), 'id': uuid.uuid4()},
+                                    {'speed': 55.5}), TAGS),
+        Envelope('<KEY>', TraceData('Example', {'day': date(2018, 5, 1)}, 2), TAGS),
+        Envelope('<KEY>', MetricData(DataPoint('Example', 10.5), None), TAGS),
+        Envelope('<KEY>', MetricData(DataPoint('Example', 10.5, count=3, min=1, max=20), {'a': 'b'}), TAGS),
+        Envelope('<KEY>', RequestData(str(uuid.uuid4()), 'Example', 'GET', 'http://localhost/like/1', 200,
+                                      True, datetime.utcnow(), 125, {'a': 'b'}, None), TAGS),
+        Envelope('<KEY>', ExceptionData([get_exception_details()], {'code_0': 'raise'}), TAGS),
+        Envelope('<KEY>', TraceData('Example'), EnvelopeTags(STATIC_TAGS)),
+    ]
+
+
+BATCH = get_envelopes() * 100
+
+
+def friendly():
+    return friendly_dumps(BATCH).encode('utf8')
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, default=default)
+
+
+def fast_json():
+    return _encoder.encode([envelope_to_dict(envelope) for envelope in BATCH]).encode('utf8')
+
+
+def main(repeat: int = 5, number: int = 20):
+    cases = [('friendly_dumps', friendly), ('fast serializer, json', fast_json)]
+    if orjson is not None:
+        cases.append(('fast serializer, orjson', lambda: serialize_envelopes(BATCH)))
+
+    baseline = None
+    for name, func in cases:
+        best = min(timeit.repeat(func, repeat=repeat, number=number))
+        rate = len(BATCH) * number / best
+        baseline = baseline or rate
+        print(f'{name:<28}{rate:>14,.0f} envelopes/s{rate / baseline:>8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
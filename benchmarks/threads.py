@@ -0,0 +1,54 @@
+"""
+Measures the throughput of tracking telemetry from many producer threads, comparing the thread-safe front end
+of channels (a deque handed off to the loop in batches) with scheduling a callback in the loop for each item.
+
+    python -m benchmarks.threads
+"""
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from .track import NullTelemetryChannel
+from asynapplicationinsights.telemetry import AsyncTelemetryClient
+
+
+async def measure(threads: int, calls: int, per_item: bool) -> float:
+    channel = NullTelemetryChannel(flush_interval=None, max_batch_size=threads * calls * 2)
+    client = AsyncTelemetryClient('<KEY>', channel)
+    channel.bind()
+    loop = asyncio.get_event_loop()
+
+    def produce():
+        for i in range(calls):
+            if per_item:
+                loop.call_soon_threadsafe(channel.put_nowait, client.create_trace('Example'))
+            else:
+                client.track_trace_nowait('Example')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        await asyncio.gather(*[loop.run_in_executor(executor, produce) for _ in range(threads)])
+
+    # waits for the loop to ingest all items
+    while channel._queue.qsize() < threads * calls:
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+
+    await client.dispose()
+    return elapsed
+
+
+def main(calls: int = 20000):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for threads in (1, 4, 16, 64):
+            for name, per_item in (('deque hand-off', False), ('call_soon_threadsafe per item', True)):
+                elapsed = loop.run_until_complete(measure(threads, calls, per_item))
+                total = threads * calls
+                print(f'{threads:>3} threads  {name:<32}{total / elapsed:>12,.0f} items/s')
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
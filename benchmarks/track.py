@@ -0,0 +1,52 @@
+"""
+Compares the per-call overhead of awaiting track_* methods and of calling their *_nowait variants.
+
+    python -m benchmarks.track
+"""
+import time
+import asyncio
+from typing import List
+from asynapplicationinsights.channel.abstractions import TelemetryChannel
+from asynapplicationinsights.telemetry import AsyncTelemetryClient
+
+
+class NullTelemetryChannel(TelemetryChannel):
+
+    async def send(self, data: List):
+        return None
+
+    async def dispose(self):
+        await self.stop()
+
+
+async def measure(calls: int):
+    client = AsyncTelemetryClient('<KEY>', NullTelemetryChannel(background_sender=True, max_batch_size=calls * 2))
+
+    start = time.perf_counter()
+    for i in range(calls):
+        await client.track_trace('Example', {'index': i})
+    awaited = time.perf_counter() - start
+    await client.flush()
+
+    start = time.perf_counter()
+    for i in range(calls):
+        client.track_trace_nowait('Example', {'index': i})
+    nowait = time.perf_counter() - start
+
+    await client.dispose()
+    return awaited, nowait
+
+
+def main(calls: int = 200000):
+    loop = asyncio.new_event_loop()
+    try:
+        awaited, nowait = loop.run_until_complete(measure(calls))
+    finally:
+        loop.close()
+
+    for name, elapsed in (('await track_trace', awaited), ('track_trace_nowait', nowait)):
+        print(f'{name:<22}{elapsed / calls * 1e6:>8.2f} µs/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,8 @@ setup(name='asynapplicationinsights',
       classifiers=[
           'Development Status :: 3 - Alpha',
           'License :: OSI Approved :: MIT License',
-          'Programming Language :: Python :: 3.6',
+          'Programming Language :: Python :: 3.7',
+          'Programming Language :: Python :: 3.8',
           'Operating System :: OS Independent',
           'Framework :: AsyncIO'
       ],
@@ -26,8 +27,13 @@ setup(name='asynapplicationinsights',
                 'asynapplicationinsights.channel',
                 'asynapplicationinsights.tests',
                 'asynapplicationinsights.utils'],
+      python_requires='>=3.7',
       install_requires=[
           'aiohttp',
       ],
+      extras_require={
+          # faster serialization of envelopes
+          'fast': ['orjson']
+      },
       include_package_data=True,
       zip_safe=False)